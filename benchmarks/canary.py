@@ -0,0 +1,161 @@
+"""
+Runs the canary apply end to end and reports time-to-verify, time-to-detect and time-to-restore.
+
+    python3 benchmarks/canary.py
+    python3 benchmarks/canary.py --scenario errors --deadline 5
+
+A fake nginx binary "reloads" by copying the main config to a live file, and a stub site answers
+according to that live config: not integrated (no /prerenderio), integrated, or failing. Scenarios
+use the token to pick how the integrated site behaves:
+
+    ok         crawlers get prerendered pages, the canary passes
+    no-header  pages come back without x-prerender, rolled back at the deadline
+    errors     the site answers 502, rolled back after the first round
+"""
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'main.py')
+RUN_TIMEOUT = 120
+
+SCENARIOS = {
+    'ok': {'token': 'canary-ok-token', 'rolled_back': False},
+    'no-header': {'token': 'canary-no-header', 'rolled_back': True},
+    'errors': {'token': 'canary-errors', 'rolled_back': True},
+}
+
+NGINX_CONF = """events {}
+http {
+    server {
+        listen 80;
+        server_name localhost;
+        location / {
+            root /usr/share/nginx/html;
+        }
+    }
+}
+"""
+
+FAKE_NGINX = """#!{python}
+import sys, shutil
+args = sys.argv[1:]
+if '-s' in args and '-c' in args:
+    shutil.copy(args[args.index('-c') + 1], {live_path!r})
+"""
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Answers like nginx would with the live config.
+    """
+    protocol_version = 'HTTP/1.1'
+    live_path = None
+
+    def do_GET(self):
+        with open(self.live_path) as file:
+            config = file.read()
+
+        status, prerendered = 200, False
+        if self.path == '/sitemap.xml':
+            status = 404
+        elif 'location /prerenderio' in config:
+            if 'canary-errors' in config:
+                status = 502
+            elif 'canary-no-header' not in config:
+                prerendered = True
+
+        body = b'<html></html>'
+        self.send_response(status)
+        if prerendered:
+            self.send_header('x-prerender', '1')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class StubServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # the CLI drops pooled keep-alive connections when it exits
+        pass
+
+def write_file(file_path: str, content: str) -> None:
+    with open(file_path, 'w') as file:
+        file.write(content)
+
+def run_scenario(name: str, deadline: float, interval: float) -> dict:
+    """
+    Integrates a fresh config against the stub site and returns the canary phase of the run's metrics.
+    """
+    work_dir = tempfile.mkdtemp(prefix=f'prerender-canary-{name}-')
+    server = None
+    try:
+        config_path = os.path.join(work_dir, 'nginx.conf')
+        live_path = os.path.join(work_dir, 'live.conf')
+        nginx_bin = os.path.join(work_dir, 'nginx')
+        metrics_path = os.path.join(work_dir, 'metrics.json')
+        write_file(config_path, NGINX_CONF)
+        shutil.copy(config_path, live_path)
+        write_file(nginx_bin, FAKE_NGINX.format(python=sys.executable, live_path=live_path))
+        os.chmod(nginx_bin, 0o755)
+
+        handler = type('Handler', (StubHandler,), {'live_path': live_path})
+        server = StubServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        site_url = f"http://127.0.0.1:{server.server_address[1]}/"
+
+        command = [sys.executable, os.path.abspath(MAIN_SCRIPT), '-f', config_path, '-m', 'True', '-t', SCENARIOS[name]['token'],
+                   '-u', site_url, '--no-cache', '--reload-method', 'nginx', '--nginx-bin', nginx_bin,
+                   '--canary-deadline', str(deadline), '--canary-interval', str(interval), '--metrics', metrics_path]
+        env = dict(os.environ, XDG_STATE_HOME=os.path.join(work_dir, 'state'))
+        process = subprocess.run(command, cwd=work_dir, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT, text=True, timeout=RUN_TIMEOUT)
+
+        with open(metrics_path) as file:
+            phases = [phase for phase in json.load(file)["phases"] if phase["phase"] == "canary"]
+        if not phases:
+            raise Exception(f"Scenario {name} exited with {process.returncode} without a canary phase:\n{process.stdout}")
+
+        with open(live_path) as file:
+            live_integrated = 'location /prerenderio' in file.read()
+
+        canary = phases[0]
+        canary.update(exit_code=process.returncode, live_integrated=live_integrated,
+                      expected=(live_integrated != SCENARIOS[name]['rolled_back']))
+        return canary
+    finally:
+        if server:
+            server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def format_seconds(value) -> str:
+    return f"{value * 1000:.0f}ms" if value is not None else "-"
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Measure canary apply: time to verify, to detect a failure and to roll back")
+    parser.add_argument('--scenario', help='Scenario to run, may be repeated (default: all)', action='append', choices=SCENARIOS.keys())
+    parser.add_argument('--deadline', help='Canary deadline in seconds', type=float, default=3)
+    parser.add_argument('--interval', help='Seconds between verification rounds', type=float, default=0.5)
+    args = parser.parse_args()
+
+    print(f"{'scenario':<12}{'status':>14}{'rounds':>8}{'verify':>10}{'detect':>10}{'restore':>10}{'exit':>6}  live config")
+    failed = 0
+    for name in args.scenario or SCENARIOS.keys():
+        canary = run_scenario(name, args.deadline, args.interval)
+        failed += not canary["expected"]
+        print(f"{name:<12}{canary['status']:>14}{canary['rounds']:>8}{format_seconds(canary['time_to_verify']):>10}"
+              f"{format_seconds(canary['time_to_detect']):>10}{format_seconds(canary['time_to_restore']):>10}{canary['exit_code']:>6}  "
+              f"{'integrated' if canary['live_integrated'] else 'restored'}{'' if canary['expected'] else ' (unexpected)'}")
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
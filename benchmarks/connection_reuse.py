@@ -0,0 +1,75 @@
+"""
+Checks that verification reuses the keep-alive connections of its pool.
+
+    python3 benchmarks/connection_reuse.py
+    python3 benchmarks/connection_reuse.py --requests 200 --concurrency 8
+
+A stub site counts the TCP connections it accepts while verify_urls checks the same page
+--requests times. Exits with status 1 when more connections are opened than --concurrency.
+"""
+
+import os
+import sys
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from verification import verify_urls
+
+# larger than a socket buffer, so an unread body can't hide in the kernel
+BODY = b'<html>' + b'x' * 256 * 1024 + b'</html>'
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Answers like an integrated site and counts the connections it is called on.
+    """
+    protocol_version = 'HTTP/1.1'
+    connections = 0
+    lock = threading.Lock()
+
+    def setup(self):
+        super().setup()
+        with StubHandler.lock:
+            StubHandler.connections += 1
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('x-prerender', '1')
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, *args):
+        pass
+
+class StubServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # connections dropped by the client when the check exits
+        pass
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Check that verification requests reuse pooled connections")
+    parser.add_argument('--requests', help='Number of URLs to verify', type=int, default=40)
+    parser.add_argument('--concurrency', help='Number of concurrent verification requests', type=int, default=4)
+    args = parser.parse_args()
+
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/"
+
+    try:
+        results = verify_urls([url] * args.requests, concurrency=args.concurrency, retries=0)
+    finally:
+        server.shutdown()
+
+    verified = sum(1 for result in results if result["ok"])
+    reused = StubHandler.connections <= args.concurrency
+    print(f"{verified}/{args.requests} verified over {StubHandler.connections} connections "
+          f"(at most {args.concurrency} expected){'' if reused else ' - connections are not reused'}")
+
+    return 0 if reused and verified == args.requests else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
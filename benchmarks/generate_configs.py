@@ -0,0 +1,111 @@
+"""
+Generates synthetic nginx config trees for benchmarking: a main nginx.conf with a large map block
+and server blocks spread over nested include files, like config-examples/confd-includes.conf.
+"""
+
+import os
+import sys
+import argparse
+
+def build_map_block(entries: int) -> str:
+    lines = ["    map $http_user_agent $synthetic_client {", "        default 0;"]
+    for i in range(entries):
+        lines.append(f"        ~*client-{i:05d}/ {i % 7};")
+    lines.append("    }")
+    return "\n".join(lines)
+
+def build_server_block(index: int) -> str:
+    return f"""server {{
+    listen 80;
+    listen 443 ssl;
+    server_name site-{index:05d}.example.com www.site-{index:05d}.example.com;
+
+    ssl_certificate /etc/ssl/site-{index:05d}.crt;
+    ssl_certificate_key /etc/ssl/site-{index:05d}.key;
+
+    root /var/www/site-{index:05d};
+    index index.html;
+
+    location / {{
+        try_files $uri $uri/ /index.html;
+    }}
+
+    location /api/ {{
+        proxy_pass http://127.0.0.1:{8000 + index % 1000};
+        proxy_set_header Host $host;
+        proxy_set_header X-Real-IP $remote_addr;
+    }}
+
+    location ~* \\.(css|js|png|jpg|svg)$ {{
+        expires 30d;
+        access_log off;
+    }}
+}}
+"""
+
+def write_file(file_path: str, content: str) -> None:
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, 'w') as file:
+        file.write(content)
+
+def write_include_level(dir_path: str, servers: list, depth: int, fan_out: int) -> None:
+    """
+    Writes servers into dir_path. Above the last level, each directory only holds an include
+    for its fan_out subdirectories, so every server sits depth includes below the main config.
+    """
+    if depth <= 0 or len(servers) <= 1:
+        for index in servers:
+            write_file(os.path.join(dir_path, f"site-{index:05d}.conf"), build_server_block(index))
+        return
+
+    chunk = -(-len(servers) // fan_out)
+    for i in range(0, len(servers), chunk):
+        sub_dir = os.path.join(dir_path, f"group-{i // chunk:03d}")
+        write_include_level(sub_dir, servers[i:i + chunk], depth - 1, fan_out)
+        write_file(os.path.join(sub_dir + '.conf'), f"include {sub_dir}/*.conf;\n")
+
+def generate_tree(out_dir: str, servers: int = 100, depth: int = 2, fan_out: int = 10, map_entries: int = 1000) -> str:
+    """
+    Writes a config tree to out_dir and returns the path of its main nginx.conf.
+    """
+    out_dir = os.path.abspath(out_dir)
+    sites_dir = os.path.join(out_dir, 'sites')
+
+    main_config = f"""user nginx;
+worker_processes auto;
+pid /var/run/nginx.pid;
+
+events {{
+    worker_connections 1024;
+}}
+
+http {{
+    default_type application/octet-stream;
+    sendfile on;
+    keepalive_timeout 65;
+
+{build_map_block(map_entries)}
+
+    include {sites_dir}/*.conf;
+}}
+"""
+    main_config_path = os.path.join(out_dir, 'nginx.conf')
+    write_file(main_config_path, main_config)
+    write_include_level(sites_dir, list(range(servers)), depth, fan_out)
+
+    return main_config_path
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Generate a synthetic nginx config tree")
+    parser.add_argument('out_dir', help='Directory to write the config tree to')
+    parser.add_argument('--servers', help='Number of server blocks', type=int, default=100)
+    parser.add_argument('--depth', help='Include levels between nginx.conf and the server files', type=int, default=2)
+    parser.add_argument('--fan-out', help='Included files per level', type=int, default=10)
+    parser.add_argument('--map-entries', help='Entries of the synthetic map block', type=int, default=1000)
+    args = parser.parse_args()
+
+    print(generate_tree(args.out_dir, args.servers, args.depth, args.fan_out, args.map_entries))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,139 @@
+"""
+Checks the latency probe against a stub site with known responses and latencies.
+
+    python3 benchmarks/probe_check.py
+    python3 benchmarks/probe_check.py --requests 200 --concurrency 8
+
+The stub answers dynamic pages to crawlers with x-prerender after BOT_DELAY and to browsers
+after BROWSER_DELAY. Of the static paths, /robots.txt is served at once and /favicon.ico fails
+with 503. probe_site must report the right requests, errors and prerendered pages for each
+class, and latencies within the stub's delays. summarize_probe is also checked on fixed
+latencies, where the percentiles are exact. Exits with status 1 on any difference.
+"""
+
+import os
+import sys
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from probe import PROBE_CLASSES, PROBE_USER_AGENTS, probe_site, summarize_probe
+
+BOT_DELAY = 0.1
+BROWSER_DELAY = 0.01
+# time the stub, the client and the scheduler may add to a delay before a latency is suspicious
+SLACK = 1.0
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Answers like an integrated site: crawlers get slower prerendered pages, one static file fails.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        status, prerendered, delay = 200, False, 0
+        if self.path == '/sitemap.xml':
+            # only the root is probed as a dynamic page
+            status = 404
+        elif self.path == '/favicon.ico':
+            status = 503
+        elif self.path != '/robots.txt':
+            prerendered = self.headers.get('User-Agent') in PROBE_USER_AGENTS["bot"]
+            delay = BOT_DELAY if prerendered else BROWSER_DELAY
+
+        time.sleep(delay)
+        body = b'<html></html>'
+        self.send_response(status)
+        if prerendered:
+            self.send_header('x-prerender', '1')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def check_summary() -> list:
+    """
+    Returns the differences of summarize_probe from the expected report for latencies 1ms to 100ms in each class.
+    """
+    results = [
+        ((agent_class, path_class), {"elapsed": ms / 1000, "error": "status 502" if ms > 90 else None, "prerendered": agent_class == "bot"})
+        for agent_class, path_class in PROBE_CLASSES for ms in range(1, 101)
+    ]
+    report = summarize_probe(results, 2.0)
+    expected = {"requests": 100, "errors": 10, "error_rate": 0.1, "p50": 0.045, "p95": 0.086, "p99": 0.09, "throughput": 50.0}
+
+    problems = []
+    for agent_class, path_class in PROBE_CLASSES:
+        stats = report[f"{agent_class}/{path_class}"]
+        for key, value in dict(expected, prerendered=100 if agent_class == "bot" else 0).items():
+            if stats[key] != value:
+                problems.append(f"summary {agent_class}/{path_class} {key}: {stats[key]}, expected {value}")
+    return problems
+
+def check_probe(report: dict, count: int) -> list:
+    """
+    Returns the differences of a probe_site report over the stub from what the stub serves.
+    """
+    per_class = count // len(PROBE_CLASSES)
+    problems = []
+
+    for agent_class, path_class in PROBE_CLASSES:
+        name = f"{agent_class}/{path_class}"
+        stats = report.get(name)
+        if stats is None:
+            problems.append(f"{name}: missing from the report")
+            continue
+
+        # static requests alternate between /robots.txt and the failing /favicon.ico
+        errors = per_class // 2 if path_class == "static" else 0
+        prerendered = per_class if name == "bot/dynamic" else 0
+        delay = {"bot/dynamic": BOT_DELAY, "browser/dynamic": BROWSER_DELAY}.get(name, 0)
+        expected = {"requests": per_class, "errors": errors, "error_rate": round(errors / per_class, 4), "prerendered": prerendered}
+
+        for key, value in expected.items():
+            if stats[key] != value:
+                problems.append(f"{name} {key}: {stats[key]}, expected {value}")
+        if not delay <= stats["p50"] <= stats["p95"] <= stats["p99"] < delay + SLACK:
+            problems.append(f"{name} latency p50 {stats['p50']:.3f}s p95 {stats['p95']:.3f}s p99 {stats['p99']:.3f}s, "
+                            f"expected ordered between {delay}s and {delay + SLACK}s")
+        if not stats["throughput"]:
+            problems.append(f"{name} throughput: {stats['throughput']}")
+
+    return problems
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Check the latency probe against a stub site")
+    parser.add_argument('--requests', help='Number of probe requests, a multiple of 8 so every class and path gets the same share', type=int, default=80)
+    parser.add_argument('--concurrency', help='Number of concurrent probe requests', type=int, default=4)
+    args = parser.parse_args()
+
+    if args.requests <= 0 or args.requests % (2 * len(PROBE_CLASSES)):
+        parser.error(f"--requests must be a positive multiple of {2 * len(PROBE_CLASSES)}")
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/"
+
+    try:
+        report = probe_site(url, args.requests, concurrency=args.concurrency, timeout=10)
+    finally:
+        server.shutdown()
+
+    problems = check_summary() + check_probe(report, args.requests)
+
+    for name, stats in report.items():
+        print(f"{name}: {stats['requests']} requests, {stats['errors']} errors, {stats['prerendered']} prerendered, "
+              f"p50 {stats['p50'] * 1000:.0f}ms p95 {stats['p95'] * 1000:.0f}ms p99 {stats['p99'] * 1000:.0f}ms, {stats['throughput']} req/s")
+    for problem in problems:
+        print(f"  {problem}")
+    print(f"{len(problems)} problems")
+
+    return 1 if problems else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
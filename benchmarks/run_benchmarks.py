@@ -0,0 +1,195 @@
+"""
+Times the phases of an integration on synthetic config trees and compares them with a stored baseline.
+
+    python3 benchmarks/run_benchmarks.py --save-baseline   # record benchmarks/baseline.json on this host
+    python3 benchmarks/run_benchmarks.py                   # fails if a phase regressed past the baseline
+
+Comparing also fails when there is no baseline for a scenario that ran, so a missing baseline can't pass silently.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from crossplane_adapter import load_nginx_config, save_nginx_config
+from generate_configs import generate_tree
+from prerender import add_location_prerenderio, add_map_section, get_all_server_blocks_with_attrs, rewrite_root_location
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+DEFAULT_REPEAT = 3
+DEFAULT_TOLERANCE = 0.25
+# absolute slack so phases taking microseconds don't fail on timer noise
+MIN_TIME_DELTA = 0.005
+MIN_MEMORY_DELTA_KB = 256
+
+SCENARIOS = {
+    'servers-1': {'servers': 1, 'depth': 0, 'fan_out': 1, 'map_entries': 10},
+    'servers-100': {'servers': 100, 'depth': 2, 'fan_out': 10, 'map_entries': 1000},
+    'servers-1000': {'servers': 1000, 'depth': 3, 'fan_out': 10, 'map_entries': 5000},
+    'servers-10000': {'servers': 10000, 'depth': 4, 'fan_out': 10, 'map_entries': 10000},
+}
+
+PHASES = ('load', 'server_blocks', 'add_map_section', 'rewrite_root_location', 'add_location_prerenderio', 'save')
+
+def measure(function, trace_memory: bool) -> tuple:
+    """
+    Runs function once. Returns (result, seconds, peak memory in KB or None).
+    """
+    if not trace_memory:
+        started = time.perf_counter()
+        result = function()
+        return (result, time.perf_counter() - started, None)
+
+    tracemalloc.start()
+    try:
+        result = function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return (result, None, peak // 1024)
+
+def run_once(main_config_path: str, work_dir: str, trace_memory: bool = False) -> dict:
+    """
+    Runs every phase once on the tree, in the order the CLI does.
+    Returns {phase: seconds}, or {phase: peak KB} with trace_memory (tracing slows everything down, so it is a separate run).
+    """
+    metrics = {}
+
+    def record(phase, function):
+        result, elapsed, memory = measure(function, trace_memory)
+        metrics[phase] = memory if trace_memory else elapsed
+        return result
+
+    payload = record('load', lambda: load_nginx_config(main_config_path))
+
+    server_blocks = record('server_blocks', lambda: [
+        (config, server_block) for config in payload['config']
+        for server_block in get_all_server_blocks_with_attrs(config['parsed'])
+    ])
+
+    # the last server is the worst case for lookups
+    config, server_block = server_blocks[-1]
+    main_config = payload['config'][0]['parsed']
+    block = server_block[0]
+
+    record('add_map_section', lambda: add_map_section(main_config))
+    record('rewrite_root_location', lambda: rewrite_root_location(block))
+    record('add_location_prerenderio', lambda: add_location_prerenderio(block, 'benchmark-token'))
+
+    main_output = os.path.join(work_dir, 'nginx.conf')
+    server_output = os.path.join(work_dir, 'server.conf')
+    for path in (main_output, server_output):
+        if os.path.exists(path):
+            os.remove(path)
+
+    def save():
+        save_nginx_config(main_config, main_output)
+        save_nginx_config(config['parsed'], server_output)
+
+    record('save', save)
+
+    return metrics
+
+def run_scenario(name: str, params: dict, repeat: int = DEFAULT_REPEAT) -> dict:
+    """
+    Generates the scenario tree and returns the best time over repeat runs and the peak memory of each phase.
+    """
+    temp_dir = tempfile.mkdtemp(prefix=f"prerender-bench-{name}-")
+    try:
+        main_config_path = generate_tree(os.path.join(temp_dir, 'tree'), **params)
+        work_dir = os.path.join(temp_dir, 'out')
+        os.makedirs(work_dir)
+
+        peaks = run_once(main_config_path, work_dir, trace_memory=True)
+        runs = [run_once(main_config_path, work_dir) for _ in range(repeat)]
+
+        return {
+            phase: {'time': round(min(run[phase] for run in runs), 6), 'peak_kb': peaks[phase]}
+            for phase in PHASES
+        }
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def find_regressions(results: dict, baseline: dict, tolerance: float = DEFAULT_TOLERANCE) -> list:
+    """
+    Returns a message for every phase slower or bigger than its baseline by more than tolerance.
+    """
+    regressions = []
+
+    for scenario, phases in results.items():
+        for phase, metrics in phases.items():
+            expected = baseline.get(scenario, {}).get(phase)
+            if not expected:
+                continue
+
+            time_limit = max(expected['time'] * (1 + tolerance), expected['time'] + MIN_TIME_DELTA)
+            if metrics['time'] > time_limit:
+                regressions.append(f"{scenario} {phase}: {metrics['time']:.4f}s, baseline {expected['time']:.4f}s")
+
+            memory_limit = max(expected['peak_kb'] * (1 + tolerance), expected['peak_kb'] + MIN_MEMORY_DELTA_KB)
+            if metrics['peak_kb'] > memory_limit:
+                regressions.append(f"{scenario} {phase}: peak {metrics['peak_kb']}KB, baseline {expected['peak_kb']}KB")
+
+    return regressions
+
+def print_results(results: dict) -> None:
+    print(f"{'scenario':<16}{'phase':<28}{'time (s)':>12}{'peak (KB)':>12}")
+    for scenario, phases in results.items():
+        for phase in PHASES:
+            metrics = phases[phase]
+            print(f"{scenario:<16}{phase:<28}{metrics['time']:>12.4f}{metrics['peak_kb']:>12}")
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark config parsing, modification and saving on synthetic trees")
+    parser.add_argument('--scenario', help='Scenario to run, may be repeated (default: all)', action='append', choices=SCENARIOS.keys())
+    parser.add_argument('--repeat', help='Runs per scenario, the best one is kept', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('--baseline', help='Baseline JSON file', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', help='Store the results as the new baseline instead of comparing', action='store_true')
+    parser.add_argument('--tolerance', help='Allowed relative regression', type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.scenario or SCENARIOS.keys():
+        results[name] = run_scenario(name, SCENARIOS[name], args.repeat)
+
+    print_results(results)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, 'r') as file:
+                baseline = json.load(file)
+        baseline.update(results)
+        with open(args.baseline, 'w') as file:
+            json.dump(baseline, file, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    # without a baseline nothing could fail, which would pass every regression
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, record one on this host with --save-baseline (make bench-baseline)")
+        return 1
+
+    with open(args.baseline, 'r') as file:
+        baseline = json.load(file)
+
+    missing = [name for name in results if name not in baseline]
+    if missing:
+        print(f"No baseline for {', '.join(missing)} in {args.baseline}, record it with --save-baseline")
+        return 1
+
+    regressions = find_regressions(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"Regression: {regression}")
+
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,140 @@
+"""
+Measures time-to-first-prompt and time-to-exit of the CLI for --help, the verify flow and the restore flow.
+
+    python3 benchmarks/startup.py                                  # the script
+    python3 benchmarks/startup.py --command bin/prerender-nginx-linux
+    python3 benchmarks/startup.py --command "python3 bin/prerender-nginx.pyz"
+
+Verification runs against a local stub server. The restore flow reloads with `true` as the nginx binary,
+so run it as root (or with passwordless sudo) to avoid a sudo prompt.
+"""
+
+import os
+import sys
+import time
+import shlex
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'main.py')
+DEFAULT_RUNS = 5
+RUN_TIMEOUT = 60
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Answers every request like an integrated site: 200 with the x-prerender header.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = b'<html></html>'
+        self.send_response(200 if self.path != '/sitemap.xml' else 404)
+        self.send_header('x-prerender', '1')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def start_stub_server() -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def write_file(file_path: str, content: str) -> None:
+    with open(file_path, 'w') as file:
+        file.write(content)
+
+def prepare_verify(work_dir: str, site_url: str) -> tuple:
+    write_file(os.path.join(work_dir, '.prerender_site_url'), site_url)
+    return ([], "Do you want to verify integration", "y")
+
+def prepare_restore(work_dir: str, site_url: str) -> tuple:
+    config_path = os.path.join(work_dir, 'nginx.conf')
+    write_file(config_path, "events {}\nhttp {\n    server {\n        listen 80;\n    }\n}\n")
+    write_file(f"{config_path}.prerender.backup", "events {}\nhttp {\n}\n")
+    write_file(os.path.join(work_dir, '.prerender_nginx_conf'), config_path)
+    write_file(os.path.join(work_dir, '.prerender_server_conf'), config_path)
+    return (['--reload-method', 'nginx', '--nginx-bin', 'true'], "Do you want to restore", "y")
+
+def prepare_help(work_dir: str, site_url: str) -> tuple:
+    return (['--help'], None, None)
+
+SCENARIOS = {
+    'help': prepare_help,
+    'verify': prepare_verify,
+    'restore': prepare_restore,
+}
+
+def run_scenario(command: list, prepare, site_url: str) -> tuple:
+    """
+    Runs the command once in a fresh working directory. Returns (seconds to the first prompt or None, seconds to exit).
+    """
+    work_dir = tempfile.mkdtemp(prefix='prerender-startup-')
+    try:
+        args, prompt, answer = prepare(work_dir, site_url)
+
+        started = time.perf_counter()
+        # keep state and snapshots of the runs out of the user's state directory
+        env = dict(os.environ, XDG_STATE_HOME=os.path.join(work_dir, 'state'))
+        process = subprocess.Popen(command + args, cwd=work_dir, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT, text=True)
+        first_prompt = None
+
+        if prompt:
+            for line in process.stdout:
+                if prompt in line:
+                    first_prompt = time.perf_counter() - started
+                    process.stdin.write(f"{answer}\n")
+                    process.stdin.flush()
+                    break
+
+        process.communicate(timeout=RUN_TIMEOUT)
+        elapsed = time.perf_counter() - started
+
+        if prompt and first_prompt is None:
+            raise Exception(f"{' '.join(command + args)} exited with {process.returncode} without prompting \"{prompt}\"")
+
+        return (first_prompt, elapsed)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def format_seconds(values: list) -> str:
+    if not values:
+        return "-"
+    return f"{min(values) * 1000:.0f}/{statistics.median(values) * 1000:.0f}ms"
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Measure CLI startup for --help, verify and restore runs")
+    parser.add_argument('--command', help='Command to start the CLI (default: this python running src/main.py)', default=None)
+    parser.add_argument('--scenario', help='Scenario to run, may be repeated (default: all)', action='append', choices=SCENARIOS.keys())
+    parser.add_argument('--runs', help='Runs per scenario', type=int, default=DEFAULT_RUNS)
+    args = parser.parse_args()
+
+    command = [sys.executable, os.path.abspath(MAIN_SCRIPT)]
+    if args.command:
+        # runs happen in temp dirs, so relative paths like bin/prerender-nginx.pyz are resolved here
+        command = [os.path.abspath(part) if os.path.exists(part) else part for part in shlex.split(args.command)]
+    server = start_stub_server()
+    site_url = f"http://127.0.0.1:{server.server_address[1]}/"
+
+    print(f"{'scenario':<12}{'first prompt min/median':>24}{'exit min/median':>20}")
+    try:
+        for name in args.scenario or SCENARIOS.keys():
+            results = [run_scenario(command, SCENARIOS[name], site_url) for _ in range(args.runs)]
+            first_prompts = [first_prompt for first_prompt, _ in results if first_prompt is not None]
+            exits = [elapsed for _, elapsed in results]
+            print(f"{name:<12}{format_seconds(first_prompts):>24}{format_seconds(exits):>20}")
+    finally:
+        server.shutdown()
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
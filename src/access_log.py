@@ -0,0 +1,316 @@
+"""
+Access log analysis before enabling Prerender: how many requests the generated maps would send to
+/prerenderio, how many distinct pages that is, and how well a prerender_cache of a given size would do.
+
+Logs in the common or combined format are streamed, memory-mapped when plain and decompressed in
+chunks when gzipped, and a single bytes regex picks the fields of every line. Each request is
+classified with the map chain add_map_section emits, evaluated like nginx by map_check.MapEmulator.
+Map lookups are cached per source value and consecutive regex keys with the same value are tried as
+one alternation, so the per-bot user agent list costs one search per distinct user agent.
+
+Unique URLs and cache hit ratios come from a spatially hashed sample of URLs (SHARDS): only URLs whose
+hash falls under a threshold are tracked, and cache sizes are scaled by the same rate. The threshold
+is lowered whenever more than max_tracked URLs are tracked, so memory stays constant for any log size.
+"""
+
+import re
+import gzip
+import mmap
+import zlib
+import calendar
+from collections import OrderedDict
+from urllib.parse import unquote
+from map_check import MapEmulator
+from prerender import PROXY_CACHE_AVERAGE_PAGE_KB, build_map_directives, parse_nginx_size
+
+# $remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent ["$http_referer" "$http_user_agent"]
+# nginx logs quotes in variables as \x22, so quoted fields end at the first quote
+LOG_LINE_PATTERN = re.compile(
+    rb'^\S+ \S+ \S+ \[([^\]]+)\] "(?:[A-Z]+ )?([^" ]*)[^"]*" \d{3} \S+(?: "[^"]*" "([^"]*)")?', re.MULTILINE)
+
+MONTHS = {month.encode(): index for index, month in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'], 1)}
+
+GZIP_MAGIC = b'\x1f\x8b'
+CHUNK_SIZE = 4 * 1024 * 1024
+DEFAULT_CACHE_SIZES = "100m,1g,10g"
+DEFAULT_MAX_TRACKED_URLS = 65536
+# map lookups and request classifications are cached per value, a cache is dropped when it gets bigger
+MAX_CACHED_LOOKUPS = 65536
+# proxy_cache_valid and inactive of the generated cache directives
+CACHE_VALID_SECONDS = 600
+CACHE_INACTIVE_SECONDS = 24 * 3600
+HASH_SPACE = 1 << 32
+
+class CachedMapEmulator(MapEmulator):
+    """
+    MapEmulator with lookups cached per map and source value, and runs of regex keys with the same
+    value (like the per-bot user agent list) merged into one alternation, which matches if any of them does.
+    """
+    def __init__(self, maps: list):
+        super().__init__(maps)
+        self.lookups = {variable: {} for variable in self.maps}
+
+        for variable, (source, exact, regexes, default) in self.maps.items():
+            merged = []
+            for regex, value in regexes:
+                # backreferences would point at other groups once merged
+                mergeable = not re.search(r'\\[1-9]', regex.pattern)
+                if merged and merged[-1][1] == value and merged[-1][2] == regex.flags and mergeable and merged[-1][3]:
+                    merged[-1][0].append(regex.pattern)
+                else:
+                    merged.append(([regex.pattern], value, regex.flags, mergeable))
+            regexes = [(re.compile('|'.join(f'(?:{pattern})' for pattern in patterns), flags) if len(patterns) > 1
+                        else re.compile(patterns[0], flags), value)
+                       for patterns, value, flags, _ in merged]
+            self.maps[variable] = (source, exact, regexes, default)
+
+    def lookup(self, variable: str, value: str) -> str:
+        cache = self.lookups[variable]
+        result = cache.get(value)
+        if result is None:
+            if len(cache) >= MAX_CACHED_LOOKUPS:
+                cache.clear()
+            result = cache[value] = super().lookup(variable, value)
+        return result
+
+class CacheSimulator:
+    """
+    Simulates the prerender_cache zone for several sizes at once on a hash sample of the URLs.
+    A request is a hit when its page is cached and younger than CACHE_VALID_SECONDS, anything else
+    makes nginx fetch it from Prerender. Entries unused for CACHE_INACTIVE_SECONDS are dropped, and each
+    size (in pages, None for unlimited) evicts the least recently used page when full.
+    """
+    def __init__(self, sizes: list, max_tracked: int = DEFAULT_MAX_TRACKED_URLS):
+        self.sizes = sizes
+        self.max_tracked = max_tracked
+        self.threshold = HASH_SPACE
+        # one LRU per size: url -> (fetched, last used)
+        self.caches = [OrderedDict() for _ in sizes]
+        self.tracked = {}
+        self.requests = 0
+        self.hits = [0] * len(sizes)
+
+    @property
+    def rate(self) -> float:
+        return self.threshold / HASH_SPACE
+
+    def _capacity(self, size: int) -> int:
+        return None if size is None else max(1, int(size * self.rate))
+
+    def _lower_threshold(self) -> None:
+        """
+        Halves the sample, dropping the tracked URLs over the new threshold, and shrinks the caches with it.
+        """
+        self.threshold //= 2
+        self.tracked = {url: url_hash for url, url_hash in self.tracked.items() if url_hash < self.threshold}
+        for size, cache in zip(self.sizes, self.caches):
+            for url in [url for url in cache if url not in self.tracked]:
+                del cache[url]
+            capacity = self._capacity(size)
+            while capacity is not None and len(cache) > capacity:
+                cache.popitem(last=False)
+
+    def request(self, url: bytes, timestamp: float) -> None:
+        url_hash = self.tracked.get(url)
+        if url_hash is None:
+            url_hash = zlib.crc32(url) * 2654435761 % HASH_SPACE
+            if url_hash >= self.threshold:
+                return
+            self.tracked[url] = url_hash
+            if len(self.tracked) > self.max_tracked:
+                self._lower_threshold()
+                if url_hash >= self.threshold:
+                    return
+
+        self.requests += 1
+        for index, (size, cache) in enumerate(zip(self.sizes, self.caches)):
+            entry = cache.get(url)
+            if entry is not None and timestamp - entry[1] <= CACHE_INACTIVE_SECONDS:
+                cache.move_to_end(url)
+                if timestamp - entry[0] <= CACHE_VALID_SECONDS:
+                    self.hits[index] += 1
+                    cache[url] = (entry[0], timestamp)
+                    continue
+            cache[url] = (timestamp, timestamp)
+            cache.move_to_end(url)
+            capacity = self._capacity(size)
+            if capacity is not None and len(cache) > capacity:
+                cache.popitem(last=False)
+
+    def hit_ratios(self) -> list:
+        return [hits / self.requests if self.requests else None for hits in self.hits]
+
+    def unique_urls(self) -> int:
+        return round(len(self.tracked) / self.rate)
+
+def parse_size(size: str) -> int:
+    """
+    Parses an nginx size like 100m or 1g into kilobytes.
+    """
+    return parse_nginx_size(size) // 1024
+
+def parse_time_local(value: bytes) -> float:
+    """
+    Parses $time_local (10/Oct/2000:13:55:36 -0700) into a Unix timestamp.
+    """
+    day, month, year = int(value[0:2]), MONTHS[value[3:6]], int(value[7:11])
+    hour, minute, second = int(value[12:14]), int(value[15:17]), int(value[18:20])
+    offset = (int(value[22:24]) * 3600 + int(value[24:26]) * 60) * (-1 if value[21:22] == b'-' else 1)
+    return calendar.timegm((year, month, day, hour, minute, second)) - offset
+
+def count_lines(buffer) -> int:
+    if isinstance(buffer, bytes):
+        return buffer.count(b'\n')
+    # mmap has no count(), it is counted in slices so the file is never copied whole
+    return sum(buffer[start:start + CHUNK_SIZE].count(b'\n') for start in range(0, len(buffer), CHUNK_SIZE))
+
+def iter_chunks(file_path: str):
+    """
+    Yields the log as buffers ending at line boundaries: the whole memory-mapped file when it is plain,
+    decompressed chunks when it is gzipped.
+    """
+    with open(file_path, 'rb') as file:
+        gzipped = file.read(2) == GZIP_MAGIC
+        file.seek(0, 2)
+        if file.tell() == 0:
+            return
+
+        if not gzipped:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                yield mapped
+            return
+
+    with gzip.open(file_path, 'rb') as file:
+        rest = b''
+        while True:
+            chunk = file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            chunk = rest + chunk
+            end = chunk.rfind(b'\n') + 1
+            rest = chunk[end:]
+            if end:
+                yield chunk[:end]
+        if rest:
+            yield rest
+
+class AccessLogAnalyzer:
+    """
+    Accumulates the classification, rates and cache simulation of access log lines.
+    """
+    def __init__(self, cache_sizes: list, compact_ua: bool = False, page_size_kb: int = PROXY_CACHE_AVERAGE_PAGE_KB,
+                 max_tracked: int = DEFAULT_MAX_TRACKED_URLS):
+        self.maps = CachedMapEmulator(build_map_directives(compact_ua))
+        self.cache_sizes = cache_sizes
+        self.page_size_kb = page_size_kb
+        self.classified = {}
+        self.simulator = CacheSimulator([size // page_size_kb if size is not None else None for size in cache_sizes], max_tracked)
+
+        self.lines = 0
+        self.requests = 0
+        self.bots = 0
+        self.prerendered = 0
+        self.first = None
+        self.last = None
+        self.second = None
+        self.second_count = 0
+        self.peak = 0
+        self._time_key = None
+        self._time = None
+
+    def _timestamp(self, time_local: bytes) -> float:
+        # most lines share their second with the previous one
+        if time_local != self._time_key:
+            self._time_key = time_local
+            self._time = parse_time_local(time_local)
+        return self._time
+
+    def classify(self, request_uri: bytes, user_agent: bytes) -> tuple:
+        """
+        Returns (bot, prerendered) for a request, as the $prerender_ua and $prerender maps would set them.
+        """
+        key = (request_uri, user_agent)
+        result = self.classified.get(key)
+        if result is None:
+            path, _, args = request_uri.partition(b'?')
+            uri = path.decode('utf-8', 'replace')
+            if '%' in uri:
+                uri = unquote(uri)
+            variables = {
+                "$uri": uri,
+                "$args": args.decode('utf-8', 'replace'),
+                "$http_user_agent": user_agent.decode('utf-8', 'replace') if user_agent else "",
+                # the X-Prerender header is not logged, requests from Prerender itself can't be told apart
+                "$http_x_prerender": "",
+            }
+            if len(self.classified) >= MAX_CACHED_LOOKUPS:
+                self.classified.clear()
+            result = self.classified[key] = (self.maps.lookup("$prerender_ua", variables["$http_user_agent"]) == "1",
+                                             self.maps.evaluate("$prerender", variables) == "1")
+        return result
+
+    def add(self, buffer) -> None:
+        self.lines += count_lines(buffer)
+
+        for match in LOG_LINE_PATTERN.finditer(buffer):
+            time_local, request_uri, user_agent = match.groups()
+            self.requests += 1
+
+            timestamp = self._timestamp(time_local)
+            if self.first is None:
+                self.first = timestamp
+            self.last = timestamp
+
+            bot, prerendered = self.classify(request_uri, user_agent)
+            self.bots += bot
+            if not prerendered:
+                continue
+
+            self.prerendered += 1
+            if timestamp == self.second:
+                self.second_count += 1
+            else:
+                self.second = timestamp
+                self.second_count = 1
+            self.peak = max(self.peak, self.second_count)
+
+            self.simulator.request(request_uri, timestamp)
+
+    def add_file(self, file_path: str) -> None:
+        for buffer in iter_chunks(file_path):
+            self.add(buffer)
+
+    def report(self) -> dict:
+        duration = (self.last - self.first) if self.first is not None else 0
+        return {
+            "lines": self.lines,
+            "requests": self.requests,
+            "unparsed": self.lines - self.requests,
+            "bot_requests": self.bots,
+            "prerender_requests": self.prerendered,
+            "duration": duration,
+            "bot_rps": round(self.bots / duration, 3) if duration else None,
+            "prerender_rps": round(self.prerendered / duration, 3) if duration else None,
+            "prerender_peak_rps": self.peak,
+            "unique_urls": self.simulator.unique_urls(),
+            "sample_rate": self.simulator.rate,
+            "cache": [
+                {"size_kb": size, "pages": pages, "hit_ratio": round(ratio, 4) if ratio is not None else None}
+                for size, pages, ratio in zip(self.cache_sizes, self.simulator.sizes, self.simulator.hit_ratios())
+            ],
+        }
+
+def analyze_access_logs(file_paths: list, cache_sizes: str = DEFAULT_CACHE_SIZES, compact_ua: bool = False,
+                        page_size_kb: int = PROXY_CACHE_AVERAGE_PAGE_KB, max_tracked: int = DEFAULT_MAX_TRACKED_URLS) -> dict:
+    """
+    Analyzes the logs, oldest first (e.g. access.log.2.gz access.log.1 access.log), and returns the report.
+    cache_sizes is a comma separated list of nginx sizes (max_size of the cache), an unlimited cache is added.
+    """
+    analyzer = AccessLogAnalyzer([parse_size(size) for size in cache_sizes.split(',') if size.strip()] + [None],
+                                 compact_ua, page_size_kb, max_tracked)
+    for file_path in file_paths:
+        analyzer.add_file(file_path)
+    return analyzer.report()
@@ -0,0 +1,93 @@
+import os
+import stat
+import hashlib
+import logging
+import tempfile
+from instrumentation import record_write
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODE = 0o644
+
+def file_digest(file_path: str) -> str:
+    """
+    Returns the sha256 of the file content or None if the file does not exist.
+    """
+    digest = hashlib.sha256()
+    try:
+        with open(file_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                digest.update(chunk)
+    except FileNotFoundError:
+        return None
+
+    return digest.hexdigest()
+
+def _fsync_dir(dir_path: str) -> None:
+    try:
+        fd = os.open(dir_path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def write_atomic(file_path: str, data: bytes, mode: int = None) -> None:
+    """
+    Replaces the file with data so readers see either the old or the new content, never a partial one:
+    the data is written to a temp file in the same directory, fsynced and renamed over the original.
+    Symlinks are followed (sites-enabled -> sites-available) and mode/ownership of the original are kept.
+    A new file gets mode, or 0644 minus the umask.
+    """
+    file_path = os.path.realpath(file_path)
+    dir_path = os.path.dirname(file_path)
+
+    try:
+        original_stat = os.stat(file_path)
+    except FileNotFoundError:
+        original_stat = None
+
+    fd, temp_path = tempfile.mkstemp(dir=dir_path, prefix=f".{os.path.basename(file_path)}.", suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+
+        if original_stat:
+            os.chmod(temp_path, stat.S_IMODE(original_stat.st_mode))
+            try:
+                os.chown(temp_path, original_stat.st_uid, original_stat.st_gid)
+            except OSError as e:
+                logger.debug("Failed to preserve ownership of %s: %s", file_path, e)
+        elif mode is not None:
+            os.chmod(temp_path, mode)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temp_path, DEFAULT_MODE & ~umask)
+
+        os.replace(temp_path, file_path)
+        record_write(len(data))
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+    _fsync_dir(dir_path)
+
+def write_if_changed(file_path: str, data: bytes) -> bool:
+    """
+    Writes the file atomically unless it already has exactly this content.
+    Returns True if the file was written.
+    """
+    if file_digest(file_path) == hashlib.sha256(data).hexdigest():
+        return False
+
+    write_atomic(file_path, data)
+    return True
@@ -0,0 +1,96 @@
+"""
+Canary apply: once the new config is live, the site is verified in rounds until the integration is
+confirmed or the deadline passes. If the deadline passes first, or a round has clearly more failing
+requests than before the change, the rollback callback restores the previous config.
+"""
+
+import time
+import logging
+from defaults import DEFAULT_CANARY_DEADLINE, DEFAULT_CANARY_INTERVAL, DEFAULT_CANARY_MAX_ERROR_RATE, DEFAULT_TIMEOUT
+from verification import verify_site
+
+logger = logging.getLogger(__name__)
+
+# a round never waits less than this for responses, even right before the deadline
+MIN_ROUND_TIMEOUT = 1.0
+
+def get_error_rate(results: list) -> float:
+    """
+    Fraction of verification results that failed to connect or got a 5xx response.
+    """
+    if not results:
+        return 0.0
+    errors = sum(1 for result in results if result["error"] or (result["status"] or 0) >= 500)
+    return errors / len(results)
+
+def measure_error_rate(site_url: str, verification_options: dict = None) -> float:
+    """
+    Error rate of one verification round, taken before the change as the baseline of run_canary.
+    """
+    _, results = verify_site(site_url, retries=0, **(verification_options or {}))
+    return get_error_rate(results)
+
+def run_canary(site_url: str, rollback, verification_options: dict = None, deadline: float = DEFAULT_CANARY_DEADLINE,
+               interval: float = DEFAULT_CANARY_INTERVAL, max_error_rate: float = DEFAULT_CANARY_MAX_ERROR_RATE,
+               baseline_error_rate: float = 0.0, live_since: float = None) -> dict:
+    """
+    Verifies site_url every interval seconds, without retries, until all sampled URLs are prerendered.
+    live_since is the time.monotonic() at which the new config went live (default: now), the deadline counts from it.
+    rollback() is called when the deadline passes first, or when a round's error rate exceeds
+    baseline_error_rate + max_error_rate.
+    Returns {"status": "passed", "rolled_back" or "rollback_failed", "reason", "rounds", "results" (of the last round),
+    "time_to_verify", "time_to_detect", "time_to_restore" (seconds), "error"}.
+    """
+    verification_options = dict(verification_options or {})
+    timeout = verification_options.pop("timeout", DEFAULT_TIMEOUT)
+    live_since = time.monotonic() if live_since is None else live_since
+
+    report = {"status": None, "reason": None, "rounds": 0, "results": [], "time_to_verify": None,
+              "time_to_detect": None, "time_to_restore": None, "error": None}
+
+    while True:
+        round_started = time.monotonic()
+        remaining = live_since + deadline - round_started
+        verified, results = verify_site(site_url, timeout=max(MIN_ROUND_TIMEOUT, min(timeout, remaining)), retries=0,
+                                        **verification_options)
+        detected = time.monotonic()
+        report["rounds"] += 1
+        report["results"] = results
+
+        error_rate = get_error_rate(results)
+        logger.debug("Canary round %d: verified %s, error rate %.2f", report['rounds'], verified, error_rate)
+
+        if error_rate > baseline_error_rate + max_error_rate:
+            report["reason"] = f"{error_rate:.0%} of requests failed, {baseline_error_rate:.0%} before the change"
+            break
+        if verified:
+            report["status"] = "passed"
+            report["time_to_verify"] = round(detected - live_since, 3)
+            return report
+        if detected - live_since >= deadline:
+            report["reason"] = f"integration not verified within {deadline:g}s"
+            break
+
+        time.sleep(max(0, min(interval - (detected - round_started), live_since + deadline - detected)))
+
+    report["time_to_detect"] = round(detected - live_since, 3)
+    logger.info(f"Canary failed: {report['reason']}, rolling back")
+
+    try:
+        rollback()
+        report["status"] = "rolled_back"
+    except Exception as e:
+        report["status"] = "rollback_failed"
+        report["error"] = str(e)
+    report["time_to_restore"] = round(time.monotonic() - detected, 3)
+
+    return report
+
+def log_canary_report(report: dict) -> None:
+    if report["status"] == "passed":
+        logger.info(f"Canary passed in {report['time_to_verify']}s ({report['rounds']} verification rounds)")
+    elif report["status"] == "rolled_back":
+        logger.info(f"Configuration rolled back: {report['reason']}. "
+                    f"Detected after {report['time_to_detect']}s, restored in {report['time_to_restore']}s")
+    else:
+        logger.error(f"Rollback failed after {report['time_to_detect']}s: {report['error']}")
@@ -0,0 +1,183 @@
+"""
+In-memory model of parsed nginx config files.
+
+crossplane represents every directive as a dict with a list of args and a list of child dicts, and
+finding a directive means scanning a whole block. Here each file is converted once into Directive and
+Block objects with __slots__, interned names and tuple args, which take about a third of the memory.
+Every larger Block indexes its directives by name and by (name, args) the first time it is searched,
+so repeated lookups in big http or server blocks don't rescan them. Directives point to the block
+containing them and blocks to the directive owning them. to_crossplane() gives back the crossplane
+format for crossplane.build.
+"""
+
+import sys
+
+# smaller blocks are scanned, an index would cost more memory than it saves time
+INDEX_MIN_DIRECTIVES = 32
+
+class Directive:
+    __slots__ = ("name", "args", "line", "block", "parent", "comment", "includes")
+
+    def __init__(self, name: str, args=(), block: list = None, line: int = None, comment: str = None, includes: list = None):
+        self.name = sys.intern(name)
+        self.args = tuple(args)
+        self.line = line
+        self.comment = comment
+        self.includes = includes
+        self.parent = None
+        self.block = Block(block, owner=self) if block is not None else None
+
+    @classmethod
+    def from_crossplane(cls, stmt: dict) -> "Directive":
+        block = stmt.get("block")
+        return cls(
+            stmt["directive"],
+            stmt.get("args", ()),
+            [cls.from_crossplane(child) for child in block] if block is not None else None,
+            stmt.get("line"),
+            stmt.get("comment"),
+            stmt.get("includes"),
+        )
+
+    def to_crossplane(self) -> dict:
+        stmt = {"directive": self.name, "line": self.line, "args": list(self.args)}
+        if self.includes is not None:
+            stmt["includes"] = list(self.includes)
+        if self.comment is not None:
+            stmt["comment"] = self.comment
+        if self.block is not None:
+            stmt["block"] = self.block.to_crossplane()
+        return stmt
+
+    def replace(self, new_directive: "Directive") -> None:
+        """
+        Puts new_directive in this directive's place in its block.
+        """
+        if self.parent is None:
+            raise Exception(f"Directive {self.name} is not part of a block")
+        self.parent.replace(self, new_directive)
+
+    def __repr__(self) -> str:
+        return f"<Directive {' '.join((self.name,) + self.args)}{' {...}' if self.block is not None else ''}>"
+
+class Block:
+    """
+    Ordered directives of a config file or of a block directive, with lazily built lookup indexes.
+    """
+    __slots__ = ("directives", "owner", "_by_name", "_by_args")
+
+    def __init__(self, directives: list = None, owner: Directive = None):
+        self.directives = []
+        self.owner = owner
+        self._by_name = None
+        self._by_args = None
+
+        for directive in directives or []:
+            directive.parent = self
+            self.directives.append(directive)
+
+    @classmethod
+    def from_crossplane(cls, parsed: list, owner: Directive = None) -> "Block":
+        return cls([Directive.from_crossplane(stmt) for stmt in parsed], owner)
+
+    def to_crossplane(self) -> list:
+        return [directive.to_crossplane() for directive in self.directives]
+
+    def __iter__(self):
+        return iter(self.directives)
+
+    def __len__(self) -> int:
+        return len(self.directives)
+
+    def __repr__(self) -> str:
+        return f"<Block of {len(self.directives)} directives{f' in {self.owner.name}' if self.owner else ''}>"
+
+    def _build_index(self) -> None:
+        self._by_name = {}
+        self._by_args = {}
+        for directive in self.directives:
+            self._by_name.setdefault(directive.name, []).append(directive)
+
+    def _index_add(self, directive: Directive, position: int) -> None:
+        if self._by_name is None:
+            return
+
+        # keep the bucket in config order, only positions of directives with the same name are looked up
+        bucket = self._by_name.setdefault(directive.name, [])
+        low, high = 0, len(bucket)
+        while low < high:
+            middle = (low + high) // 2
+            if self.index(bucket[middle]) < position:
+                low = middle + 1
+            else:
+                high = middle
+        bucket.insert(low, directive)
+        self._by_args.pop(directive.name, None)
+
+    def _index_remove(self, directive: Directive) -> None:
+        if self._by_name is None:
+            return
+
+        bucket = self._by_name[directive.name]
+        del bucket[bucket.index(directive)]
+        self._by_args.pop(directive.name, None)
+
+    def find_all(self, name: str, args: tuple = None) -> list:
+        """
+        Returns the directives called name, in config order, only those with exactly args if given.
+        """
+        if self._by_name is None:
+            if len(self.directives) < INDEX_MIN_DIRECTIVES:
+                return [directive for directive in self.directives
+                        if directive.name == name and (args is None or directive.args == tuple(args))]
+            self._build_index()
+
+        bucket = self._by_name.get(name, [])
+        if args is None:
+            return list(bucket)
+
+        by_args = self._by_args.get(name)
+        if by_args is None:
+            by_args = self._by_args[name] = {}
+            for directive in bucket:
+                by_args.setdefault(directive.args, []).append(directive)
+
+        return list(by_args.get(tuple(args), []))
+
+    def find(self, name: str, args: tuple = None) -> Directive:
+        """
+        Returns the first directive called name (with exactly args if given), or None.
+        """
+        found = self.find_all(name, args)
+        return found[0] if found else None
+
+    def index(self, directive: Directive) -> int:
+        # Directive has no __eq__, so this compares identities
+        try:
+            return self.directives.index(directive)
+        except ValueError:
+            raise Exception(f"Directive {directive.name} is not in this block")
+
+    def insert(self, index: int, directive: Directive) -> Directive:
+        index = min(max(index, 0), len(self.directives))
+        directive.parent = self
+        self.directives.insert(index, directive)
+        self._index_add(directive, index)
+        return directive
+
+    def append(self, directive: Directive) -> Directive:
+        return self.insert(len(self.directives), directive)
+
+    def replace(self, old_directive: Directive, new_directive: Directive) -> Directive:
+        index = self.index(old_directive)
+        self._index_remove(old_directive)
+        self.directives[index] = new_directive
+        self._index_add(new_directive, index)
+        new_directive.parent = self
+        old_directive.parent = None
+        return new_directive
+
+    def remove(self, directive: Directive) -> None:
+        self._index_remove(directive)
+        del self.directives[self.index(directive)]
+        directive.parent = None
@@ -1,24 +1,18 @@
 import crossplane
 import logging
+from atomic_file import write_if_changed
+from config_model import Block
+from diagnostics import capture_config
+from nginx_parser import parse_tree
+from parse_cache import ParseCache
 
 logger = logging.getLogger(__name__)
 
-def log_config(config):
-    path = config['file']
-    
-    with open(path, 'r') as file:
-        content = file.read()
-        logger.debug(f"Configuration from {path}:\n{content}")
-        
-
-def load_nginx_config(file_path):
-    payload = crossplane.parse(file_path,comments=True, single=False, strict=False)
-    
-    for config in payload['config']:
-        try:
-            log_config(config)
-        except Exception as e:
-            logger.debug(f"Failed to log configuration: {e}")                
+def load_nginx_config(file_path, cache_dir=None, workers=1):
+    # with a cache dir, files that did not change since the previous run are not parsed again,
+    # with several workers the others are parsed in parallel
+    cache = ParseCache(cache_dir) if cache_dir else None
+    payload = parse_tree(file_path, comments=True, strict=False, cache=cache, workers=workers)
 
     if not payload:
         raise Exception("Failed to parse configuration.")
@@ -27,20 +21,33 @@ def load_nginx_config(file_path):
         logger.error(payload['config'][0]['errors'])
         raise Exception("Failed to parse configuration.")
 
+    # the mutation functions work on the indexed model, the crossplane dicts are not kept
+    for config in payload['config']:
+        config['parsed'] = Block.from_crossplane(config['parsed'])
+
     return payload
 
-def save_nginx_config(config, file_path):
-    config_str = crossplane.build(config)
-    
-    logger.debug(f"Saving configuration to {file_path}")
-    logger.debug('\n' + config_str)
+def save_nginx_config(config: Block, file_path):
+    """
+    Builds the config and atomically replaces file_path with it.
+    Returns False without touching the file when its content is already the same.
+    """
+    config_str = crossplane.build(config.to_crossplane())
 
     if not config_str:
         raise Exception("Failed to build configuration with crossplane")
 
+    data = config_str.encode('utf-8')
+    capture_config(file_path, data, section="saved")
+
     try:
-        with open(file_path, 'w') as f:
-            f.write(config_str)
-    except IOError as e:
+        written = write_if_changed(file_path, data)
+    except OSError as e:
         raise Exception(f"Failed to save configuration to {file_path}: {e}")
-    
\ No newline at end of file
+
+    if written:
+        logger.debug("Saved configuration to %s", file_path)
+    else:
+        logger.debug("Configuration %s is unchanged, not saving", file_path)
+
+    return written
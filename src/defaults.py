@@ -0,0 +1,30 @@
+"""
+Defaults shared by the CLI and the subsystems it imports lazily, so building the
+argument parser doesn't import requests or the fleet machinery.
+"""
+
+import os
+
+# HTTP requests (site_url, verification, probe)
+DEFAULT_TIMEOUT = 10
+DEFAULT_RETRIES = 2
+DEFAULT_BACKOFF = 0.5
+DEFAULT_CONCURRENCY = 10
+
+# processes parsing the files of large include trees
+DEFAULT_PARSE_WORKERS = os.cpu_count() or 1
+
+# manifest mode (fleet)
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+# snapshots kept besides the original one of each integration
+DEFAULT_KEEP_SNAPSHOTS = 20
+
+# seconds without config file changes before watch mode checks the config
+DEFAULT_DEBOUNCE = 2.0
+
+# canary apply: seconds to get the integration verified, between verification rounds,
+# and how many more failing requests than before the change trigger a rollback
+DEFAULT_CANARY_DEADLINE = 60
+DEFAULT_CANARY_INTERVAL = 2.0
+DEFAULT_CANARY_MAX_ERROR_RATE = 0.1
@@ -0,0 +1,138 @@
+"""
+Diagnostics bundle for support requests.
+
+The config files are captured from the bytes the parser already read (no second read of the include
+tree) and the configs the run saved from the bytes it wrote. The log records of the run are kept
+unformatted in a bounded buffer. Only when a bundle is
+requested with --diagnostics, or the run fails, are they formatted and written into one tar.gz with
+the environment and the metrics of the run. Prerender tokens are masked in everything written.
+"""
+
+import io
+import os
+import re
+import sys
+import json
+import time
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# the include tree is captured up to this size, larger trees are listed without content
+MAX_CAPTURED_BYTES = 32 * 1024 * 1024
+MAX_LOG_RECORDS = 20000
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
+TOKEN_HEADER_PATTERN = re.compile(rb'(X-Prerender-Token["\']?\s+["\']?)([^"\'\s;]+)', re.IGNORECASE)
+
+# (section, file path) -> bytes read by the parser ("configs") or saved ("saved"), None when over MAX_CAPTURED_BYTES
+CAPTURED_CONFIGS = {}
+CAPTURED_BYTES = {"total": 0}
+FAILURES = []
+
+class BufferHandler(logging.Handler):
+    """
+    Keeps the last records of the run, formatted only when a bundle is written.
+    """
+    def __init__(self, capacity: int = MAX_LOG_RECORDS):
+        super().__init__(logging.DEBUG)
+        self.records = deque(maxlen=capacity)
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def format_records(self) -> str:
+        formatter = logging.Formatter(LOG_FORMAT)
+        lines = []
+        for record in self.records:
+            try:
+                lines.append(formatter.format(record))
+            except Exception as e:
+                lines.append(f"Unformattable record {record.msg!r}: {e}")
+        return '\n'.join(lines) + '\n'
+
+log_buffer = BufferHandler()
+
+def capture_config(file_path: str, data: bytes, section: str = "configs") -> None:
+    """
+    Remembers the content of a config file the parser read or the run saved. Keeps a reference, the bytes are not copied.
+    """
+    key = (section, os.path.abspath(file_path))
+    previous = CAPTURED_CONFIGS.get(key)
+    total = CAPTURED_BYTES["total"] - (len(previous) if previous is not None else 0)
+    if total + len(data) <= MAX_CAPTURED_BYTES:
+        CAPTURED_CONFIGS[key] = data
+        CAPTURED_BYTES["total"] = total + len(data)
+    else:
+        CAPTURED_CONFIGS[key] = None
+        CAPTURED_BYTES["total"] = total
+
+def record_failure(message: str) -> None:
+    """
+    Marks the run as failed, so a bundle is written at exit even without --diagnostics.
+    """
+    FAILURES.append(message)
+
+def get_default_bundle_path() -> str:
+    return os.path.abspath(time.strftime('prerender-diagnostics-%Y%m%d-%H%M%S.tar.gz'))
+
+def mask_secret(secret: str) -> str:
+    return f"...{secret[-4:]}" if len(secret) > 8 else "..."
+
+def redact(data: bytes, secrets: set) -> bytes:
+    for secret in secrets:
+        data = data.replace(secret.encode('utf-8'), mask_secret(secret).encode('utf-8'))
+    return data
+
+def find_tokens(data: bytes) -> set:
+    return set(match.group(2).decode('utf-8', 'replace') for match in TOKEN_HEADER_PATTERN.finditer(data))
+
+def get_member_name(section: str, file_path: str) -> str:
+    return os.path.join(section, file_path.lstrip(os.sep))
+
+def get_environment(version: str, metrics_summary: dict = None) -> dict:
+    return {
+        "version": version,
+        "created": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        "argv": sys.argv[1:],
+        "python": sys.version,
+        "platform": sys.platform,
+        "uname": list(os.uname()) if hasattr(os, 'uname') else None,
+        "frozen": bool(getattr(sys, 'frozen', False)),
+        "cwd": os.getcwd(),
+        "failures": list(FAILURES),
+        "configs": {get_member_name(section, file_path): len(data) if data is not None else None
+                    for (section, file_path), data in CAPTURED_CONFIGS.items()},
+        "metrics": metrics_summary,
+    }
+
+def write_bundle(file_path: str, version: str, metrics_summary: dict = None, secrets=()) -> str:
+    """
+    Writes the captured configs, the log of the run and the environment into a tar.gz at file_path.
+    secrets (e.g. the token given on the command line) and tokens found in the configs are masked.
+    """
+    import tarfile
+
+    secrets = set(secret for secret in secrets if secret)
+    for data in CAPTURED_CONFIGS.values():
+        if data is not None:
+            secrets |= find_tokens(data)
+
+    members = [("environment.json", json.dumps(get_environment(version, metrics_summary), indent=2, default=str).encode('utf-8')),
+               ("prerender.log", log_buffer.format_records().encode('utf-8'))]
+    for (section, config_path), data in CAPTURED_CONFIGS.items():
+        if data is not None:
+            members.append((get_member_name(section, config_path), data))
+
+    with tarfile.open(file_path, 'w:gz') as bundle:
+        for name, data in members:
+            data = redact(data, secrets)
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            info.mode = 0o600
+            bundle.addfile(info, io.BytesIO(data))
+
+    os.chmod(file_path, 0o600)
+    return file_path
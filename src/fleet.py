@@ -0,0 +1,235 @@
+import os
+import json
+import time
+import logging
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from defaults import DEFAULT_WORKERS
+from crossplane_adapter import load_nginx_config, save_nginx_config
+from nginx import reload_nginx, test_config
+from prerender import apply_integration, get_integration_drift, get_server_blocks, select_server_block, select_server_blocks
+from server_index import ServerIndex
+from site_url import check_integration, create_session
+from snapshots import SnapshotStore
+
+logger = logging.getLogger(__name__)
+
+def load_manifest(manifest_path: str) -> list:
+    """
+    Loads a fleet manifest. The manifest is a JSON list of entries (or an object with an "entries" list).
+    Each entry has "file" (nginx.conf path), "url", "token", optional "server" (1-based index or server_name,
+    resolved from "url" with nginx server_name rules when omitted)
+    and optional "output" (save modified main config to another file).
+    """
+    with open(manifest_path, 'r') as file:
+        manifest = json.load(file)
+
+    entries = manifest.get("entries", []) if isinstance(manifest, dict) else manifest
+
+    if not isinstance(entries, list):
+        raise Exception(f"Manifest {manifest_path} must contain a list of entries")
+
+    for i, entry in enumerate(entries):
+        if not isinstance(entry, dict) or not entry.get("file"):
+            raise Exception(f"Manifest entry {i + 1} must be an object with a \"file\" key")
+        if not entry.get("token"):
+            raise Exception(f"Manifest entry {i + 1} ({entry['file']}) is missing a Prerender token")
+
+    return entries
+
+def new_result(entry: dict, error: str = None) -> dict:
+    """
+    Returns the report result of an entry before integration, failed until integrate_entry succeeds.
+    """
+    return {
+        "file": entry["file"],
+        "url": entry.get("url"),
+        "server": None,
+        "server_config": None,
+        "resolved_by": None,
+        "status": "failed",
+        "error": error,
+        "verified": None,
+        "changed": [],
+        "snapshot": None,
+        "drift": None,
+        "already_integrated": False,
+        "files": [],
+        "elapsed": 0.0,
+    }
+
+def restore_entry(result: dict, snapshot_options: dict = None) -> None:
+    """
+    Restores the files of a failed entry from the snapshot taken before they were saved.
+    """
+    try:
+        SnapshotStore(**(snapshot_options or {})).restore(result["snapshot"])
+        result["changed"] = []
+    except Exception as restore_error:
+        result["error"] += f"; restoring snapshot {result['snapshot']} failed: {restore_error}"
+
+def integrate_entry(entry: dict, cache_dir: str = None, options: dict = None, snapshot_options: dict = None) -> dict:
+    """
+    Parses, modifies and saves one manifest entry. Never raises, failures are reported in the result.
+    """
+    started = time.perf_counter()
+    main_config_path = entry["file"]
+    result = new_result(entry)
+    try:
+        parsed_configs = load_nginx_config(main_config_path, cache_dir)
+        main_config = parsed_configs['config'][0]['parsed']
+        result["files"] = [config['file'] for config in parsed_configs['config']]
+
+        server_blocks = get_server_blocks(parsed_configs)
+        if len(server_blocks) == 0:
+            raise Exception("No server blocks found in the nginx configuration")
+
+        if entry.get("server") is not None:
+            selected_server_blocks = select_server_blocks(server_blocks, entry["server"])
+            result["resolved_by"] = "server"
+        elif entry.get("url") and len(server_blocks) > 1:
+            server_block, result["resolved_by"] = ServerIndex(server_blocks).resolve(entry["url"])
+            # a default or first block serves the URL without naming it, it is most likely another site
+            if result["resolved_by"] not in ('exact', 'wildcard', 'regex'):
+                served_by = f", nginx serves it from {server_block['name']} ({result['resolved_by']})" if server_block else ""
+                raise Exception(f"No server_name matches {entry['url']}{served_by}. Set \"server\" to integrate a block anyway")
+            selected_server_blocks = [server_block]
+        else:
+            selected_server_blocks = [select_server_block(server_blocks, None)]
+            result["resolved_by"] = "only" if len(server_blocks) == 1 else "first"
+        result["server"] = ", ".join(server_block['name'] for server_block in selected_server_blocks)
+        result["server_config"] = selected_server_blocks[0]['config']['file']
+
+        output_path = entry.get("output") or main_config_path
+        result["drift"] = get_integration_drift(main_config, selected_server_blocks, entry["token"], options)
+        if not result["drift"] and output_path == main_config_path:
+            # nothing to write, so no snapshot and no reload
+            result["status"] = "ok"
+            result["already_integrated"] = True
+            result["elapsed"] = round(time.perf_counter() - started, 4)
+            return result
+
+        apply_integration(main_config, selected_server_blocks, entry["token"], options)
+
+        # an output path that doesn't exist yet is recorded as absent, so a restore removes it
+        snapshot_paths = [config['file'] for config in parsed_configs['config']] + [output_path]
+        result["snapshot"] = SnapshotStore(**(snapshot_options or {})).create(snapshot_paths, main_config=main_config_path)["id"]
+
+        if save_nginx_config(main_config, output_path):
+            result["changed"].append(output_path)
+        # several blocks of one included file are saved with it, once
+        server_configs = {server_block['config']['file']: server_block['config']['parsed'] for server_block in selected_server_blocks}
+        for server_config_path, server_config in server_configs.items():
+            if server_config_path != main_config_path and save_nginx_config(server_config, server_config_path):
+                result["changed"].append(server_config_path)
+
+        result["status"] = "ok"
+    except Exception as e:
+        result["error"] = str(e)
+        logger.debug("Fleet entry %s failed", main_config_path, exc_info=True)
+
+        if result["changed"]:
+            restore_entry(result, snapshot_options)
+
+    result["elapsed"] = round(time.perf_counter() - started, 4)
+
+    return result
+
+def verify_entry(result: dict, session=None) -> dict:
+    try:
+        result["verified"] = check_integration(result["url"], session=session)
+    except Exception as e:
+        result["verified"] = False
+        result["error"] = f"Verification error: {e}"
+
+    return result
+
+def run_fleet(manifest_path: str, workers: int = DEFAULT_WORKERS, reload: bool = True, verify: bool = True, cache_dir: str = None,
+              reload_options: dict = None, options: dict = None, snapshot_options: dict = None) -> dict:
+    """
+    Integrates all manifest entries with a worker pool, reloads nginx once and verifies the sites concurrently.
+    Returns a JSON serializable report with one result per entry, in manifest order.
+    """
+    started = time.perf_counter()
+    entries = load_manifest(manifest_path)
+
+    results = [None] * len(entries)
+    pending = []
+    seen_files = set()
+
+    for i, entry in enumerate(entries):
+        # two workers writing the same config tree would clobber each other
+        file_path = os.path.abspath(entry["file"])
+        if file_path in seen_files:
+            results[i] = new_result(entry, error="Duplicate config file in manifest")
+            continue
+        seen_files.add(file_path)
+        pending.append(i)
+
+    logger.info(f"Integrating {len(pending)} nginx configurations with {workers} workers...")
+
+    # parsing and building is CPU bound, so use processes rather than threads
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for i, result in zip(pending, executor.map(partial(integrate_entry, cache_dir=cache_dir, options=options, snapshot_options=snapshot_options), [entries[i] for i in pending])):
+            results[i] = result
+
+    integrated = [result for result in results if result["status"] == "ok"]
+
+    reloaded = False
+    if reload and any(result["changed"] for result in integrated):
+        reload_options = reload_options or {}
+
+        # one invalid config must not take the others down with it, so it is restored and the rest reloaded
+        for i in pending:
+            if results[i]["status"] != "ok" or not results[i]["changed"]:
+                continue
+            try:
+                test_config(entries[i].get("output") or entries[i]["file"], reload_options.get("nginx_bin", "nginx"))
+            except Exception as e:
+                results[i]["status"] = "failed"
+                results[i]["error"] = str(e)
+                restore_entry(results[i], snapshot_options)
+        integrated = [result for result in results if result["status"] == "ok"]
+
+        if any(result["changed"] for result in integrated):
+            try:
+                reload_nginx(**reload_options)
+                reloaded = True
+            except Exception as e:
+                logger.info(f"Error reloading nginx: {e}")
+                for result in integrated:
+                    if result["changed"]:
+                        result["error"] = f"Error reloading nginx: {e}"
+
+    # changed entries are only live once nginx reloaded, checking them before would test the old config
+    to_verify = [result for result in integrated if result.get("url") and (reloaded or not result["changed"])]
+    if verify and to_verify:
+        session = create_session(pool_size=workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda result: verify_entry(result, session), to_verify))
+
+    # saved but not live (the reload failed) or not prerendered counts as failed too
+    failed = len(entries) - len(integrated) + sum(1 for result in integrated if result["verified"] is False or result["error"])
+
+    report = {
+        "manifest": manifest_path,
+        "total": len(entries),
+        "integrated": len(integrated),
+        "failed": failed,
+        "already_integrated": sum(1 for result in integrated if result.get("already_integrated")),
+        "reloaded": reloaded,
+        "elapsed": round(time.perf_counter() - started, 4),
+        "results": results,
+    }
+
+    return report
+
+def write_report(report: dict, report_path: str = None) -> None:
+    report_json = json.dumps(report, indent=2)
+
+    if report_path:
+        with open(report_path, 'w') as file:
+            file.write(report_json)
+        logger.info(f"Fleet report saved to {report_path}")
+    else:
+        print(report_json)
@@ -0,0 +1,108 @@
+import os
+import sys
+import json
+import time
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# updated by the modules doing file I/O (nginx_parser, atomic_file)
+IO_COUNTERS = {"files_read": 0, "bytes_read": 0, "files_written": 0, "bytes_written": 0}
+
+def record_read(nbytes: int) -> None:
+    IO_COUNTERS["files_read"] += 1
+    IO_COUNTERS["bytes_read"] += nbytes
+
+def record_write(nbytes: int) -> None:
+    IO_COUNTERS["files_written"] += 1
+    IO_COUNTERS["bytes_written"] += nbytes
+
+def count_directives(block) -> int:
+    """
+    Returns the number of directives in a config_model Block, including nested blocks.
+    """
+    count = 0
+    stack = [block]
+    while stack:
+        for directive in stack.pop():
+            count += 1
+            if directive.block is not None:
+                stack.append(directive.block)
+    return count
+
+class Metrics:
+    """
+    Collects wall and CPU time, file I/O and caller supplied counts for each phase of a run.
+    """
+    def __init__(self):
+        self.phases = []
+        self.started = time.perf_counter()
+        self.cpu_started = time.process_time()
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        Measures the enclosed code as phase name. Yields a dict the caller can add counts to, e.g. directives.
+        """
+        io_before = dict(IO_COUNTERS)
+        wall_started = time.perf_counter()
+        cpu_started = time.process_time()
+        extra = {}
+        status = "ok"
+
+        try:
+            yield extra
+        except SystemExit:
+            raise
+        except BaseException:
+            status = "failed"
+            raise
+        finally:
+            phase = {
+                "phase": name,
+                "status": status,
+                "wall": round(time.perf_counter() - wall_started, 6),
+                "cpu": round(time.process_time() - cpu_started, 6),
+            }
+            phase.update({key: IO_COUNTERS[key] - io_before[key] for key in IO_COUNTERS})
+            phase.update(extra)
+            self.phases.append(phase)
+            logger.debug("Phase %s: %.4fs wall, %.4fs cpu", name, phase['wall'], phase['cpu'])
+
+    def summary(self) -> dict:
+        return {
+            "pid": os.getpid(),
+            "argv": sys.argv[1:],
+            "wall": round(time.perf_counter() - self.started, 6),
+            "cpu": round(time.process_time() - self.cpu_started, 6),
+            "io": dict(IO_COUNTERS),
+            "phases": self.phases,
+        }
+
+    def write(self, file_path: str) -> None:
+        with open(file_path, 'w') as file:
+            json.dump(self.summary(), file, indent=2)
+        logger.debug("Metrics written to %s", file_path)
+
+metrics = Metrics()
+
+@contextmanager
+def profiled(file_path: str = None):
+    """
+    Profiles the enclosed code with cProfile and dumps pstats data to file_path. Does nothing without a path.
+    """
+    if not file_path:
+        yield
+        return
+
+    import cProfile
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(file_path)
+        logger.debug("Profile written to %s, inspect it with: python3 -m pstats %s", file_path, file_path)
@@ -1,28 +1,31 @@
 import os
 import sys
+import time
 import argparse
+import diagnostics
 import traceback
-from conf_backup import create_all_backups, get_backup_path, restore_all_backups, validate_backup
-from crossplane_adapter import load_nginx_config, save_nginx_config
-from nginx import restart_nginx
-from prerender import add_map_section, add_location_prerenderio, rewrite_root_location, get_all_server_blocks_with_attrs
-from site_url import check_access, check_integration
+from conf_backup import get_backup_path, restore_all_backups, validate_backup
+from defaults import (DEFAULT_CANARY_DEADLINE, DEFAULT_CANARY_INTERVAL, DEFAULT_CANARY_MAX_ERROR_RATE, DEFAULT_CONCURRENCY, DEFAULT_DEBOUNCE,
+                      DEFAULT_KEEP_SNAPSHOTS, DEFAULT_PARSE_WORKERS, DEFAULT_TIMEOUT, DEFAULT_WORKERS)
+from parse_cache import get_default_cache_dir
+from nginx import DEFAULT_NGINX_BINARY, RELOAD_METHODS, get_pid_file, reload_nginx
+from prerender import DEFAULT_PROXY_CACHE_PATH, apply_integration, get_integration_drift, get_server_blocks, select_server_blocks
+from server_index import ServerIndex
 import logging
-from temp_file_utils import temp_file_factory
 
 logger = logging.getLogger(__name__)
-site_url_data = temp_file_factory("./.prerender_site_url")
-token_data = temp_file_factory("./.prerender_token")
-nginx_conf_data = temp_file_factory("./.prerender_nginx_conf")
-server_conf_data = temp_file_factory("./.prerender_server_conf")
 
 DEFAULT_NGINX_CONFIG_PATH = '/etc/nginx/nginx.conf'
 
+LOG_FILE = 'prerender.log'
+LOG_MAX_BYTES = 1024 * 1024
+LOG_BACKUPS = 3
+
 MSG_VERIFICATION_FAILED_WITH_REASONS = "Verification failed. Possible reasons :\n" \
 "- Firewall rules blocking access.\n" \
 "- Wrong server block picked.\n" \
 "- Invalid Prerender token.\n" \
-"Please check your configuration and try again. If the issue persists, contact support. Attach file prerender.log to your support request.\n" \
+"Please check your configuration and try again. If the issue persists, contact support. Attach the diagnostics bundle written below to your support request.\n" \
 "To retry verification or restore backup, please run the script once again."
 
 VERSION = '0.0.6'
@@ -34,10 +37,280 @@ def parse_args():
     parser.add_argument('-m', '--modify', help='Modify the nginx configuration', default=False)
     parser.add_argument('-t', '--token', help='Prerender token', default=None)
     parser.add_argument('-u', '--url', help='URL of the site to integrate with Prerender.io', default=None)
+    parser.add_argument('-s', '--server', help='Server blocks to integrate: all, or comma separated 1-based indexes and server_name globs, e.g. "example.com,*.example.com" (default: the block serving the URL)', default=None)
     parser.add_argument('-v', '--verbose', help='Enable verbose output', action='store_true')
+    parser.add_argument('--compact-ua-map', help='Match all bot user agents with a single regex in the generated map', action='store_true')
+    parser.add_argument('--keepalive-upstream', help='Proxy to Prerender through a keepalive upstream (nginx 1.27.3+ or NGINX Plus)', action='store_true')
+    parser.add_argument('--proxy-cache', help='Cache prerendered pages locally in nginx', action='store_true')
+    parser.add_argument('--proxy-cache-path', help='Directory of the nginx cache of prerendered pages', default=DEFAULT_PROXY_CACHE_PATH)
+    parser.add_argument('--proxy-cache-zone-size', help='Size of the cache keys zone, e.g. 10m (default: derived from free disk space)', default=None)
+    parser.add_argument('--proxy-cache-max-size', help='Maximum size of the cache on disk, e.g. 1g (default: derived from free disk space)', default=None)
+    parser.add_argument('--proxy-buffering', help='Buffer prerendered pages in memory instead of temp files (proxy_buffers in /prerenderio)', action='store_true')
+    parser.add_argument('--proxy-buffer-size', help='proxy_buffer_size, e.g. 16k (implies --proxy-buffering)', default=None)
+    parser.add_argument('--proxy-buffers', help='proxy_buffers, e.g. "32 16k" (implies --proxy-buffering, default: sized for a 256k page or the measured pages)', default=None)
+    parser.add_argument('--proxy-busy-buffers-size', help='proxy_busy_buffers_size, e.g. 32k (implies --proxy-buffering)', default=None)
+    parser.add_argument('--proxy-max-temp-file-size', help='proxy_max_temp_file_size, e.g. 1m (implies --proxy-buffering, default: 0, no temp files)', default=None)
+    parser.add_argument('--proxy-buffers-sample', help='Size the proxy buffers from this many prerendered pages of the site, fetched from Prerender (each one is a render)', type=int, default=0)
+    parser.add_argument('--gzip-prerendered', help='Gzip prerendered pages sent to crawlers', action='store_true')
+    parser.add_argument('--pass-accept-encoding', help="Pass the crawler's Accept-Encoding to Prerender, so it sends compressed pages", action='store_true')
+    parser.add_argument('--state-dir', help='Directory of the state of integrations done on this host (default: ~/.local/state/prerender-nginx)', default=None)
+    parser.add_argument('--snapshot-dir', help='Directory of the config snapshots (default: snapshots in the state directory)', default=None)
+    parser.add_argument('--compress-snapshots', help='Store new snapshot contents gzipped', action='store_true')
+    parser.add_argument('--keep-snapshots', help='Number of snapshots to keep, older ones are pruned', type=int, default=DEFAULT_KEEP_SNAPSHOTS)
+    parser.add_argument('--list-snapshots', help='List config snapshots and exit', action='store_true')
+    parser.add_argument('--restore-snapshot', help='Restore the config snapshot with this id, reload nginx and exit', default=None)
+    parser.add_argument('--cache-dir', help='Directory of the parse cache', default=None)
+    parser.add_argument('--no-cache', help='Parse all nginx configuration files without using the parse cache', action='store_true')
+    parser.add_argument('--parse-workers', help='Number of processes parsing the config files of large include trees (1 parses sequentially)', type=int, default=DEFAULT_PARSE_WORKERS)
+    parser.add_argument('--sample', help='Number of site URLs (root first, then sitemap) to verify', type=int, default=1)
+    parser.add_argument('--urls-file', help='File with URLs to verify, one per line, instead of the sitemap', default=None)
+    parser.add_argument('--concurrency', help='Number of concurrent verification requests', type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument('--canary-deadline', help='Seconds after the reload within which the integration must be verified, or the config is rolled back', type=float, default=DEFAULT_CANARY_DEADLINE)
+    parser.add_argument('--canary-interval', help='Seconds between verification rounds after the reload', type=float, default=DEFAULT_CANARY_INTERVAL)
+    parser.add_argument('--canary-max-error-rate', help='Roll back when this fraction of verification requests more than before the change fail (connection errors, 5xx)', type=float, default=DEFAULT_CANARY_MAX_ERROR_RATE)
+    parser.add_argument('--no-rollback', help='Verify once after the reload and keep the config even if verification fails', action='store_true')
+    parser.add_argument('--probe', help='Number of requests of a bot/browser latency probe run after verification (0 disables it)', type=int, default=0)
+    parser.add_argument('--metrics', help='Write per-phase timing, I/O and directive counts as JSON to this file', default=None)
+    parser.add_argument('--profile', help='Write a cProfile dump of the run to this file', default=None)
+    parser.add_argument('--diagnostics', help='Write a diagnostics bundle (configs, debug log, environment) for support to this file at the end of the run. Failed runs always write one', nargs='?', const='', default=None)
+    parser.add_argument('--timeout', help='Timeout in seconds for each HTTP request', type=float, default=DEFAULT_TIMEOUT)
+    parser.add_argument('--nginx-bin', help='Path to the nginx binary used to test and reload the configuration', default=DEFAULT_NGINX_BINARY)
+    parser.add_argument('--pid-file', help='Path to the nginx pid file (default: pid directive or /run/nginx.pid)', default=None)
+    parser.add_argument('--reload-method', help='How to reload nginx', choices=RELOAD_METHODS, default='auto')
+    parser.add_argument('--manifest', help='Path to a JSON manifest to integrate many nginx configurations non-interactively', default=None)
+    parser.add_argument('--workers', help='Number of parallel workers in manifest mode', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--report', help='Path to save the JSON report in manifest mode (default: stdout)', default=None)
+    parser.add_argument('--no-reload', help='Do not reload nginx after saving in manifest mode', action='store_true')
+    parser.add_argument('--no-verify', help='Do not verify integrations in manifest mode', action='store_true')
+    parser.add_argument('--watch', help='Keep running and re-apply the integration whenever the config files change and drop it', action='store_true')
+    parser.add_argument('--debounce', help='Seconds without file changes to wait for before checking the config in watch mode', type=float, default=DEFAULT_DEBOUNCE)
+    parser.add_argument('--analyze-access-log', help='Report how much traffic of these nginx access logs (common/combined, plain or gzipped, oldest first) the maps would send to Prerender and exit', nargs='+', default=None)
+    parser.add_argument('--cache-sizes', help='Comma separated cache sizes to project the hit ratio of in --analyze-access-log, e.g. "100m,1g,10g"', default=None)
     return parser.parse_args()
 
+def get_cache_dir(args):
+    if args.no_cache:
+        return None
+    return args.cache_dir or get_default_cache_dir()
+
+def get_reload_options(args, main_config=None):
+    return {
+        "nginx_bin": args.nginx_bin,
+        "pid_file": args.pid_file or (get_pid_file(main_config) if main_config else None),
+        "method": args.reload_method,
+    }
+
+def get_proxy_cache_options(args):
+    if not args.proxy_cache:
+        return None
+
+    # sizes that are not given are kept from the existing config or derived from free disk space
+    return {
+        "path": args.proxy_cache_path,
+        "zone_size": args.proxy_cache_zone_size,
+        "max_size": args.proxy_cache_max_size,
+    }
+
+def get_proxy_buffer_options(args):
+    sizes = {
+        "buffer_size": args.proxy_buffer_size,
+        "buffers": args.proxy_buffers,
+        "busy_buffers_size": args.proxy_busy_buffers_size,
+        "max_temp_file_size": args.proxy_max_temp_file_size,
+    }
+    if not args.proxy_buffering and not args.proxy_buffers_sample and not any(sizes.values()):
+        return None
+
+    # sizes that are not given are derived from measured pages, or kept from the existing location
+    return dict(sizes, page_size_kb=None)
+
+def measure_proxy_buffers(args, options, site_url, prerender_token):
+    """
+    Sets the page size the proxy buffers are derived from to the measured size of prerendered pages of the site.
+    """
+    if not options["buffers"] or args.proxy_buffers_sample <= 0:
+        return
+
+    from instrumentation import metrics
+    from page_sizes import measure_page_sizes
+
+    logger.info(f"Measuring {args.proxy_buffers_sample} prerendered pages of {site_url}...")
+    with metrics.phase("page_sizes") as phase:
+        sizes = measure_page_sizes(site_url, prerender_token, args.proxy_buffers_sample, args.urls_file, compressed=args.pass_accept_encoding,
+                                   concurrency=args.concurrency, timeout=args.timeout)
+        phase.update(urls=sizes["urls"], measured=sizes["measured"])
+
+    if not sizes["page_size_kb"]:
+        logger.info("No prerendered page could be measured, proxy buffers keep their sizes")
+        return
+
+    logger.info(f"Measured {sizes['measured']} of {sizes['urls']} pages: median {sizes['p50'] // 1024}k, 95th percentile {sizes['p95'] // 1024}k, "
+                f"largest {sizes['max'] // 1024}k")
+    options["buffers"]["page_size_kb"] = sizes["page_size_kb"]
+
+def get_snapshot_store(args):
+    from snapshots import SnapshotStore
+
+    return SnapshotStore(args.snapshot_dir, compress=args.compress_snapshots)
+
+def snapshot_config_tree(args, state, parsed_configs, main_config_path, site_url, extra_paths=()):
+    """
+    Snapshots every file of the parsed include tree and records it in the state. The first snapshot
+    of an integration is kept as its original configuration, which the restore flow brings back.
+    """
+    store = get_snapshot_store(args)
+    file_paths = [config['file'] for config in parsed_configs['config']]
+    # extra paths that don't exist yet are recorded as absent, so a restore removes them
+    file_paths += list(extra_paths)
+    snapshot = store.create(file_paths, main_config=main_config_path)
+
+    original_snapshot = state.get(main_config_path, site_url).get("original_snapshot") or snapshot["id"]
+    state.record(main_config_path, site_url, snapshot=snapshot["id"], original_snapshot=original_snapshot)
+    prune_snapshots(args, state, store)
+
+    return snapshot
+
+def prune_snapshots(args, state, store):
+    # snapshots the state refers to are kept, whatever their age
+    protected = [integration.get(key) for integration in state.state["integrations"] for key in ("snapshot", "original_snapshot")]
+    store.prune(args.keep_snapshots, protect=protected)
+
+def restore_snapshot(args, snapshot_id, paths=None):
+    """
+    Restores a snapshot, only the files in paths if given, and reloads nginx with its main config. Exits the script.
+    """
+    from instrumentation import metrics
+
+    store = get_snapshot_store(args)
+    manifest = store.get(snapshot_id)
+    changed = store.restore(snapshot_id, paths)
+
+    if not changed:
+        logger.info(f"Configuration already matches snapshot {snapshot_id}.")
+        sys.exit(0)
+
+    try:
+        with metrics.phase("reload"):
+            reload_nginx(manifest["main_config"], **get_reload_options(args))
+    except Exception as e:
+        logger.info(f"Error reloading nginx: {e}")
+        logger.info("Please reload the nginx service manually to complete restore from snapshot.")
+        sys.exit(1)
+
+    logger.info(f"Nginx configuration restored from snapshot {snapshot_id}.")
+    sys.exit(0)
+
+def get_integration_paths(integration):
+    """
+    Files an integration of the state wrote: the main config, the output path and the server configs.
+    """
+    paths = [integration.get("main_config"), integration.get("output")]
+    paths += integration.get("server_configs") or [integration.get("server_config")]
+    return [path for path in dict.fromkeys(paths) if path]
+
+def rollback_config(args, snapshot_id, main_config_path, main_config):
+    """
+    Restores the config tree from the snapshot taken before saving and reloads nginx with the restored main config.
+    """
+    get_snapshot_store(args).restore(snapshot_id)
+    reload_nginx(main_config_path, **get_reload_options(args, main_config))
+
+def get_integration_options(args):
+    return {
+        "compact_ua": args.compact_ua_map,
+        "upstream": args.keepalive_upstream,
+        "cache": get_proxy_cache_options(args),
+        "buffers": get_proxy_buffer_options(args),
+        "gzip": args.gzip_prerendered,
+        "accept_encoding": args.pass_accept_encoding,
+    }
+
+def get_verification_options(args):
+    return {
+        "sample": args.sample,
+        "urls_file": args.urls_file,
+        "concurrency": args.concurrency,
+        "timeout": args.timeout,
+    }
+
+def run_probe(args, site_url):
+    if args.probe <= 0:
+        return
+
+    from instrumentation import metrics
+    from probe import log_probe_report, probe_site
+
+    try:
+        with metrics.phase("probe"):
+            log_probe_report(probe_site(site_url, args.probe, concurrency=args.concurrency, timeout=args.timeout, urls_file=args.urls_file))
+    except Exception as e:
+        logger.info(f"Error running latency probe: {e}")
+
+def run_watch(args):
+    """
+    Keeps the integration of the nginx config in place until interrupted, see watch.py. Exits the script.
+    """
+    from state_store import StateStore
+    from watch import watch_integration
+
+    state = StateStore(args.state_dir)
+    main_config_path = args.file or state.last().get("main_config") or DEFAULT_NGINX_CONFIG_PATH
+    saved_state = state.last(main_config_path)
+    entry = {
+        "file": main_config_path,
+        "url": args.url or saved_state.get("site_url"),
+        "token": args.token or saved_state.get("token"),
+        "server": args.server,
+    }
+
+    if not entry["token"]:
+        raise Exception("Watch mode needs the Prerender token (--token)")
+    if not entry["server"] and not entry["url"]:
+        raise Exception("Watch mode needs --server or --url to select the server blocks")
+
+    snapshot_options = {"store_dir": args.snapshot_dir, "compress": args.compress_snapshots}
+
+    def record_change(result):
+        state.record(result["file"], result["url"], server_config=result["server_config"], snapshot=result["snapshot"],
+                     original_snapshot=state.get(result["file"], result["url"]).get("original_snapshot") or result["snapshot"])
+        prune_snapshots(args, state, get_snapshot_store(args))
+
+    logger.info(f"Watching the configuration of {main_config_path}, press Ctrl+C to stop.")
+    try:
+        # the parse cache is what makes re-checks cheap, so it is used even with --no-cache
+        watch_integration(entry, args.cache_dir or get_default_cache_dir(), get_integration_options(args), get_reload_options(args),
+                          snapshot_options, debounce=args.debounce, on_change=record_change)
+    except KeyboardInterrupt:
+        logger.info("Stopped watching.")
+    sys.exit(0)
+
+def run_access_log_analysis(args):
+    """
+    Classifies the access logs with the maps the integration would add and logs the projected load. Exits the script.
+    """
+    from access_log import DEFAULT_CACHE_SIZES, analyze_access_logs
+    from instrumentation import metrics
+
+    with metrics.phase("access_log") as phase:
+        report = analyze_access_logs(args.analyze_access_log, args.cache_sizes or DEFAULT_CACHE_SIZES,
+                                     compact_ua=args.compact_ua_map)
+        phase["requests"] = report["requests"]
+
+    unparsed = f" ({report['unparsed']} lines not in common/combined format)" if report["unparsed"] else ""
+    logger.info(f"Analyzed {report['requests']} requests over {report['duration']:.0f}s{unparsed}")
+    logger.info(f"Bot requests: {report['bot_requests']} ({report['bot_rps'] or 0} per second)")
+    logger.info(f"Sent to Prerender: {report['prerender_requests']} ({report['prerender_rps'] or 0} per second, peak {report['prerender_peak_rps']})")
+    sampled = f" (estimated from a {report['sample_rate']:.2%} sample)" if report["sample_rate"] < 1 else ""
+    logger.info(f"Unique prerendered URLs: {report['unique_urls']}{sampled}")
+    for cache in report["cache"]:
+        size = f"{cache['size_kb'] // 1024}m ({cache['pages']} pages)" if cache["size_kb"] is not None else "unlimited"
+        hit_ratio = f"{cache['hit_ratio']:.1%}" if cache["hit_ratio"] is not None else "-"
+        logger.info(f"Projected cache hit ratio with {size}: {hit_ratio}")
+    sys.exit(0)
+
 def setup_logging(verbose):
+    from logging.handlers import RotatingFileHandler
+
     log_level = logging.DEBUG if verbose else logging.INFO
     logging.basicConfig(level=logging.DEBUG, format='%(message)s')
     
@@ -49,20 +322,21 @@ def setup_logging(verbose):
     console_handler.setLevel(log_level)
     console_handler.setFormatter(logging.Formatter('%(message)s'))
     
-    # Create a file handler with a different log level
-    file_handler = logging.FileHandler('prerender.log', mode='a')
-    file_handler.setLevel(logging.DEBUG)
+    # The log file gets debug records only with -v and is rotated at LOG_MAX_BYTES
+    file_handler = RotatingFileHandler(LOG_FILE, mode='a', maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, delay=True)
+    file_handler.setLevel(log_level)
     file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
     
-    # Add both handlers to the root logger
+    # Add the handlers to the root logger, the diagnostics buffer keeps debug records unformatted for a bundle
     logging.getLogger().addHandler(console_handler)
     logging.getLogger().addHandler(file_handler)
+    logging.getLogger().addHandler(diagnostics.log_buffer)
     
 def prompt_yes_no(prompt):
     logger.info(prompt)
     while True:
         response = input().lower()
-        logger.debug(f"User input for {prompt}: {response}")
+        logger.debug("User input for %s: %s", prompt, response)
         if response == 'y':
             return True
         elif response == 'n':
@@ -77,11 +351,52 @@ def setup():
     return args
 
 def main(args):    
-    logger.debug(f"Version: {VERSION}")
-    logger.debug(f"Arguments: {args}")
-    logger.debug(f"Operating System: {os.name}")
-    logger.debug(f"Platform: {sys.platform}")
-    logger.debug(f"Version: {os.uname()}")
+    logger.debug("Version: %s", VERSION)
+    logger.debug("Arguments: %s", args)
+    logger.debug("Operating System: %s", os.name)
+    logger.debug("Platform: %s", sys.platform)
+    logger.debug("Version: %s", os.uname())
+
+    from instrumentation import count_directives, metrics
+    from state_store import StateStore
+
+    if args.list_snapshots:
+        for manifest in get_snapshot_store(args).list():
+            created = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(manifest["created"]))
+            logger.info(f"{manifest['id']}  {created}  {len(manifest['files'])} files  {manifest['main_config']}")
+        sys.exit(0)
+
+    if args.restore_snapshot:
+        restore_snapshot(args, args.restore_snapshot)
+
+    if args.analyze_access_log:
+        run_access_log_analysis(args)
+
+    # non-interactive fleet flow
+
+    # requests, crossplane and the fleet machinery are imported by the flows that use them,
+    # so --help, verify and restore runs start faster
+
+    if args.watch:
+        run_watch(args)
+
+    if args.manifest:
+        from fleet import run_fleet, write_report
+
+        with metrics.phase("fleet") as phase:
+            report = run_fleet(args.manifest, workers=args.workers, cache_dir=get_cache_dir(args), reload_options=get_reload_options(args),
+                               options=get_integration_options(args), reload=not args.no_reload, verify=not args.no_verify,
+                               snapshot_options={"store_dir": args.snapshot_dir, "compress": args.compress_snapshots})
+            phase.update(entries=len(report["results"]), failed=report["failed"])
+        write_report(report, args.report)
+        state = StateStore(args.state_dir)
+        state.record_many([
+            {"main_config": result["file"], "site_url": result["url"], "server_config": result["server_config"],
+             "snapshot": result["snapshot"],
+             "original_snapshot": state.get(result["file"], result["url"]).get("original_snapshot") or result["snapshot"]}
+            for result in report["results"] if result["status"] == "ok"
+        ])
+        sys.exit(0 if report["failed"] == 0 else 1)
         
     main_config_path = None
     server_config_path = None
@@ -91,62 +406,77 @@ def main(args):
     site_available = False
     prerender_token = None
     
+    with metrics.phase("state_load"):
+        state = StateStore(args.state_dir)
+        saved_state = state.last()
+        saved_site_url = saved_state.get("site_url")
+        saved_nginx_config_path = saved_state.get("main_config")
+        saved_server_conf_path = saved_state.get("server_config")
+
     # verify integration flow
     
-    saved_site_url = site_url_data.get_data()
-    
-    if not args.modify and site_url_data.get_data():
+    if not args.modify and saved_site_url:
         if prompt_yes_no(f"Do you want to verify integration of {saved_site_url}? (y/n):"):            
+            from verification import log_verification_report, verify_site
+
+            prerender_verified = False
             try:
-                prerender_verified = check_integration(saved_site_url)
+                with metrics.phase("verification"):
+                    prerender_verified, results = verify_site(saved_site_url, **get_verification_options(args))
+                log_verification_report(results)
                 if prerender_verified:
                     logger.info(f"Prerender integration successfully verified for {saved_site_url}")
+                    run_probe(args, saved_site_url)
             except Exception as e:
                 logger.info(f"Error verifying Prerender integration: {e}")
             
             if not prerender_verified:
+                diagnostics.record_failure(f"Verification of {saved_site_url} failed")
                 logger.info(MSG_VERIFICATION_FAILED_WITH_REASONS)
             
             sys.exit(0)
     
-    # todo move backup flow to separate function / module
-    
-    saved_nginx_config_path = nginx_conf_data.get_data()
-    saved_server_conf_path = server_conf_data.get_data() 
-    
-    saved_nginx_backup_ready = False
-    saved_server_backup_ready = False
-    
-    saved_nginx_backup_path = get_backup_path(saved_nginx_config_path)
-    if validate_backup(saved_nginx_backup_path):
-        logger.info(f"Backup of the saved nginx configuration file found at {saved_nginx_backup_path}")
-        saved_nginx_backup_ready = True
-        
-    saved_server_backup_path = get_backup_path(saved_server_conf_path)
-    if validate_backup(saved_server_backup_path):
-        logger.info(f"Backup of the saved server configuration file found at {saved_server_backup_path}")
-        saved_server_backup_ready = True        
-    
-    if not args.modify and (saved_nginx_backup_ready or saved_server_backup_ready):
+    # restore flow
+
+    saved_snapshot_id = saved_state.get("original_snapshot")
+
+    if not args.modify and saved_snapshot_id:
+        if prompt_yes_no(f"Do you want to restore the original nginx configuration of {saved_nginx_config_path} from snapshot {saved_snapshot_id}? (y/n): "):
+            # only the files the integration wrote, edits made since to the rest of the tree are kept
+            restore_snapshot(args, saved_snapshot_id, get_integration_paths(saved_state))
+
+    # .prerender.backup files written by earlier versions
+    saved_backups = [path for path in (saved_nginx_config_path, saved_server_conf_path) if path and validate_backup(get_backup_path(path))]
+
+    if not args.modify and not saved_snapshot_id and saved_backups:
+        for path in saved_backups:
+            logger.info(f"Backup of {path} found at {get_backup_path(path)}")
+
         if prompt_yes_no(f"Do you want to restore the original nginx configuration from backup? (y/n): "):    
-            restore_all_backups(main_config_path, server_config_path)
+            restore_all_backups(saved_nginx_config_path, saved_server_conf_path or saved_nginx_config_path)
                         
             try:        
-                restart_nginx()
+                with metrics.phase("reload"):
+                    reload_nginx(saved_nginx_config_path, **get_reload_options(args))
             except Exception as e:
+                logger.info(f"Error reloading nginx: {e}")
                 logger.info("Please reload the nginx service manually to complete restore from backup.")                    
                 sys.exit(1)
                 
             print("Original nginx configuration restored successfully.")
             sys.exit(0)     
     
+    from crossplane_adapter import load_nginx_config, save_nginx_config
+    from site_url import check_access
+    from verification import log_verification_report, verify_site
+
     # decide which nginx configuration file to use
     
     if args.file:
         main_config_path = args.file
     elif saved_nginx_config_path and os.path.exists(saved_nginx_config_path):
         if prompt_yes_no(f"Continue with {saved_nginx_config_path} (y) or try another file? (y/n):"):
-            main_config_path = nginx_conf_data.get_data()
+            main_config_path = saved_nginx_config_path
     elif os.path.exists(DEFAULT_NGINX_CONFIG_PATH):
         if prompt_yes_no(f"Default nginx configuration found at {DEFAULT_NGINX_CONFIG_PATH}. Do you want to use it? (y/n):"):
             main_config_path = DEFAULT_NGINX_CONFIG_PATH
@@ -161,21 +491,24 @@ def main(args):
             
     # Load and parse the nginx configuration
     try:
-        parsed_configs = load_nginx_config(main_config_path)
+        with metrics.phase("parse") as phase:
+            parsed_configs = load_nginx_config(main_config_path, get_cache_dir(args), workers=args.parse_workers)
+            phase.update(files=len(parsed_configs['config']),
+                         directives=sum(count_directives(config['parsed']) for config in parsed_configs['config']))
         logger.info("Nginx configuration loaded successfully.") 
     except Exception as e:
         logger.info(f"Error loading nginx configuration: {e}")
         logger.debug(traceback.format_exc())
         sys.exit(1)
         
-    logger.debug(f"Parsed configs: {parsed_configs}")                   
+    logger.debug("Parsed %d config files", len(parsed_configs['config']))
     
     # decide on site URL
         
     if args.url:
         site_url = args.url
     else:
-        site_url = site_url_data.get_data()
+        site_url = state.last(main_config_path).get("site_url")
         
         if site_url:
             if not prompt_yes_no(f"Do you want to integrate \"{site_url}\"? (y/n):"):
@@ -187,11 +520,11 @@ def main(args):
             site_url = input()
             
         logger.info(f"Checking if the site at {site_url} is accessible...")
-        site_available = check_access(site_url)
+        site_available = check_access(site_url, timeout=args.timeout)
         if not site_available:
             site_url = None
             
-    site_url_data.save_data(site_url)
+    state.record(main_config_path, site_url)
 
     if args.output:
         # todo – remove this option to avaoid extra flow branching
@@ -205,7 +538,8 @@ def main(args):
     if args.token:
         prerender_token = args.token
     else:
-        saved_token = token_data.get_data()
+        # the token belongs to the Prerender account, so one saved for another site is offered too
+        saved_token = state.get(main_config_path, site_url).get("token") or state.last().get("token")
         if saved_token:
             if prompt_yes_no(f"A saved Prerender token \"{saved_token}\" was found. Do you want to use it? (y/n): "):
                 prerender_token = saved_token
@@ -217,112 +551,238 @@ def main(args):
         raise Exception("Prerender token is required to proceed.")
     
     try:
-        token_data.save_data(prerender_token)
+        state.record(main_config_path, site_url, token=prerender_token)
     except Exception as e:
         # non-critical 
-        logger.debug(f"Error saving Prerender token to file: {e}")    
+        logger.debug("Error saving Prerender token to state: %s", e)    
         
     # Get all server blocks with their server names
-    selected_server_block = None
+    selected_server_blocks = None
     main_config = parsed_configs['config'][0]['parsed']
     
-    server_blocks = []
-    
-    def get_server_name(server_block):
-        (server_block, server_name, server_listening) = server_block
-        
-        server_name = server_name if server_name else "(no server_name)"
-        
-        return f"{server_name} {server_listening}"
-    
-    for i, (config) in enumerate(parsed_configs['config']):
-        if not config['status'] == 'ok':
-            logger.warning(f"Skipping config {i} due to parsing error")
-            continue                
-
-        for server_block in get_all_server_blocks_with_attrs(config['parsed']):
-            server_blocks.append({
-                "block": server_block,
-                "config": config,
-                "name": get_server_name(server_block)
-            })
-
-    logger.info("Following server configurations were found:")
-    for i, (server_block) in enumerate(server_blocks):
-        logger.info(f"  {i + 1}. {server_block['name']}")
+    with metrics.phase("server_discovery") as phase:
+        server_blocks = get_server_blocks(parsed_configs)
+        resolved_server_block, reason = (None, None)
+        if len(server_blocks) > 1 and not args.server:
+            # pick the block nginx would serve for the site URL, same rules as nginx server_name matching
+            resolved_server_block, reason = ServerIndex(server_blocks).resolve(site_url)
+        phase.update(server_blocks=len(server_blocks), resolved_by=reason)
 
     if len(server_blocks) == 0:
         raise Exception("No server blocks found in the nginx configuration")
     
-    if len(server_blocks) == 1:
-        selected_server_block = server_blocks[0]        
+    if args.server:
+        selected_server_blocks = select_server_blocks(server_blocks, args.server)
+    elif len(server_blocks) == 1:
+        selected_server_blocks = server_blocks
     else:
-        while not selected_server_block:
+        if resolved_server_block and reason in ('exact', 'wildcard', 'regex'):
+            logger.info(f"Server configuration for {site_url} found by {reason} server_name match.")
+            selected_server_blocks = [resolved_server_block]
+        elif resolved_server_block:
+            # a default or first block serves the URL without naming it, it is most likely another site (fleet.py fails this case too)
+            if args.modify:
+                raise Exception(f"No server_name matches {site_url}, nginx serves it from {resolved_server_block['name']} ({reason}). "
+                                f"Pass --server to select the server blocks to integrate")
+            logger.info(f"No server_name matches {site_url}, nginx serves it from {resolved_server_block['name']} ({reason}).")
+            if prompt_yes_no(f"Do you want to integrate {resolved_server_block['name']}? (y/n):"):
+                selected_server_blocks = [resolved_server_block]
+
+    if not selected_server_blocks:
+        logger.info("Following server configurations were found:")
+        for i, (server_block) in enumerate(server_blocks):
+            logger.info(f"  {i + 1}. {server_block['name']}")
+
+        while not selected_server_blocks:
             try:
-                selected_server_block_index = int(input("Which server do you want to integrate? (1,2,3...): "))
-                selected_server_block = server_blocks[selected_server_block_index - 1]
+                selector = input("Which servers do you want to integrate? (1 / 1,3 / *.example.com / all): ")
+                selected_server_blocks = select_server_blocks(server_blocks, selector)
             except Exception as e:
                 logger.info(f"Invalid input: {e}")
-                selected_server_block = None    
+                selected_server_blocks = None    
         
-    server_config_path = selected_server_block['config']['file']
+    server_config_paths = list(dict.fromkeys(server_block['config']['file'] for server_block in selected_server_blocks))
     
-    logger.info(f"Selected server configuration: {selected_server_block['name']} from {server_config_path}")
+    for server_block in selected_server_blocks:
+        logger.info(f"Selected server configuration: {server_block['name']} from {server_block['config']['file']}")
     
+    #skip the write and reload when the configuration already matches
+
+    options = get_integration_options(args)
+    measure_proxy_buffers(args, options, site_url, prerender_token)
+
+    with metrics.phase("drift") as phase:
+        drift = get_integration_drift(main_config, selected_server_blocks, prerender_token, options)
+        phase["drift"] = len(drift)
+
+    # an -o output still has to be written, even when the config it is built from is integrated already
+    if not drift and output_path == main_config_path:
+        logger.info(f"Prerender is already integrated in {', '.join(server_block['name'] for server_block in selected_server_blocks)}, nothing to change.")
+        sys.exit(0)
+
+    if drift:
+        logger.info("Changes needed:")
+        for item in drift:
+            logger.info(f"  {item}")
+
     #make changes to the configuration
-    
-    add_map_section(main_config)
-    rewrite_root_location(selected_server_block['block'][0])
-    add_location_prerenderio(selected_server_block['block'][0], prerender_token)
+
+    touched_configs = {main_config_path: main_config}
+    for server_block in selected_server_blocks:
+        touched_configs.setdefault(server_block['config']['file'], server_block['config']['parsed'])
+
+    with metrics.phase("mutation") as phase:
+        directives_before = sum(count_directives(config) for config in touched_configs.values())
+        apply_integration(main_config, selected_server_blocks, prerender_token, options)
+        phase["directives_added"] = sum(count_directives(config) for config in touched_configs.values()) - directives_before
+        phase["server_blocks"] = len(selected_server_blocks)
                 
     if not args.modify and not prompt_yes_no("We're ready to modify the nginx configuration. Continue? (y/n): "):
         logger.info("Modifications were not saved.")
         sys.exit(0)
         
-    # make backups, store state
+    # snapshot the config tree, store state
     
-    nginx_conf_data.save_data(main_config_path)
-    server_conf_data.save_data(server_config_path)
-    create_all_backups(main_config_path, server_config_path)
+    with metrics.phase("backup") as phase:
+        state.record(main_config_path, site_url, server_config=server_config_paths[0], server_configs=server_config_paths,
+                     output=output_path, servers=[server_block['name'] for server_block in selected_server_blocks])
+        snapshot = snapshot_config_tree(args, state, parsed_configs, main_config_path, site_url, extra_paths=[output_path])
+        phase.update(snapshot=snapshot["id"], files=len(snapshot["files"]))
     
     # save the modified configuration
         
+    config_changed = False
     try:
-        save_nginx_config(main_config, output_path)
-        if server_config_path != main_config_path:
-            save_nginx_config(selected_server_block['config']['parsed'], server_config_path)            
+        with metrics.phase("save") as phase:
+            for config_path, config in touched_configs.items():
+                # the main config goes to the output path, included files are saved in place
+                saved_path = output_path if config_path == main_config_path else config_path
+                config_changed = save_nginx_config(config, saved_path) or config_changed
+            phase.update(changed=config_changed, files=len(touched_configs))
     except Exception as e:
         logger.error(f"Error saving configuration : {e}")
         logger.debug(traceback.format_exc())
         
-        logger.info(f"Restoring the original nginx configuration from backup") 
-        restore_all_backups(main_config_path, server_config_path)
+        logger.info(f"Restoring the nginx configuration from snapshot {snapshot['id']}") 
+        get_snapshot_store(args).restore(snapshot["id"])
             
         sys.exit(1)
 
-    try:        
-        restart_nginx()
-    except Exception as e:
-        logger.info("Please reload the nginx service manually and re-run the script to verify the installation.")
-        sys.exit(0)
+    if not config_changed:
+        logger.info("Nginx configuration is unchanged, skipping reload.")
+    else:
+        # the error rate before the change is what the canary compares with
+        baseline_error_rate = 0.0
+        if not args.no_rollback:
+            from canary import measure_error_rate
+            try:
+                baseline_error_rate = measure_error_rate(site_url, get_verification_options(args))
+            except Exception as e:
+                # the new config is saved but not live yet, so putting the files back is enough
+                logger.error(f"Error measuring the error rate before the reload: {e}")
+                diagnostics.record_failure(f"Baseline verification of {site_url} failed: {e}")
+                logger.info(f"Restoring the nginx configuration from snapshot {snapshot['id']}")
+                get_snapshot_store(args).restore(snapshot["id"])
+                sys.exit(1)
+
+        try:        
+            with metrics.phase("reload"):
+                reload_nginx(output_path, **get_reload_options(args, main_config))
+        except Exception as e:
+            # a config nginx rejected must not stay on disk for the next reload to pick up
+            logger.error(f"Error reloading nginx: {e}")
+            diagnostics.record_failure(f"Reload of {output_path} failed: {e}")
+            logger.info(f"Restoring the nginx configuration from snapshot {snapshot['id']}")
+            get_snapshot_store(args).restore(snapshot["id"])
+            try:
+                # nginx may have applied the config before the reload failed, bring it back to the restored one
+                reload_nginx(main_config_path, **get_reload_options(args, main_config))
+            except Exception as e:
+                logger.info(f"Error reloading the restored configuration: {e}")
+                logger.info("Please reload the nginx service manually.")
+            sys.exit(1)
+        live_since = time.monotonic()
+
+        if not args.no_rollback:
+            from canary import log_canary_report, run_canary
+
+            # verify until the deadline, a failed integration is rolled back instead of staying live
+            with metrics.phase("canary") as phase:
+                report = run_canary(site_url, lambda: rollback_config(args, snapshot["id"], main_config_path, main_config),
+                                    get_verification_options(args), deadline=args.canary_deadline, interval=args.canary_interval,
+                                    max_error_rate=args.canary_max_error_rate, baseline_error_rate=baseline_error_rate,
+                                    live_since=live_since)
+                phase.update(status=report["status"], rounds=report["rounds"], time_to_verify=report["time_to_verify"],
+                             time_to_detect=report["time_to_detect"], time_to_restore=report["time_to_restore"])
+            log_verification_report(report["results"])
+            log_canary_report(report)
+
+            if report["status"] != "passed":
+                diagnostics.record_failure(f"Canary of {site_url} failed: {report['reason']}")
+                logger.info(MSG_VERIFICATION_FAILED_WITH_REASONS)
+                sys.exit(1)
+
+            logger.info(f"Prerender integration successfully verified for {site_url}")
+            run_probe(args, site_url)
+            return
     
     # Verify that the site is accessible and Prerender integration is installed
     try:
-        integration_successful = check_integration(site_url)
+        with metrics.phase("verification") as phase:
+            integration_successful, results = verify_site(site_url, **get_verification_options(args))
+            phase["urls"] = len(results)
+        log_verification_report(results)
         if integration_successful:
             logger.info(f"Prerender integration successfully verified for {site_url}")
+            run_probe(args, site_url)
         else:
             logger.info(f"Prerender integration not found for {site_url}")
     except Exception as e:
         logger.info(f"Error verifying Prerender integration: {e}")
+        diagnostics.record_failure(f"Verification of {site_url} failed: {e}")
         logger.info(MSG_VERIFICATION_FAILED_WITH_REASONS)
         
-if __name__ == "__main__":
+def write_diagnostics(args):
+    """
+    Writes the diagnostics bundle requested with --diagnostics or needed because the run failed.
+    """
+    from instrumentation import metrics
+
+    bundle_path = args.diagnostics or diagnostics.get_default_bundle_path()
+    try:
+        diagnostics.write_bundle(bundle_path, VERSION, metrics.summary(), secrets=[args.token])
+        logger.info(f"Diagnostics bundle written to {bundle_path}")
+    except Exception as e:
+        logger.error(f"Failed to write diagnostics bundle {bundle_path}: {e}")
+
+def run():
+    """
+    Entry point of the script, the PyInstaller executable and the zipapp.
+    """
     args = setup()
-    
+
+    from instrumentation import metrics, profiled
+
     try :
-        main(args)
+        with profiled(args.profile):
+            main(args)
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            diagnostics.record_failure(f"Exited with status {e.code}")
+        raise
     except Exception as e:
         logger.error(f"Error : {e}")
         logger.debug(traceback.format_exc())
-        sys.exit(1)
\ No newline at end of file
+        diagnostics.record_failure(str(e))
+        sys.exit(1)
+    finally:
+        if args.metrics:
+            metrics.write(args.metrics)
+        if args.diagnostics is not None or diagnostics.FAILURES:
+            write_diagnostics(args)
+
+if __name__ == "__main__":
+    # required for worker processes in the PyInstaller executable
+    from multiprocessing import freeze_support
+    freeze_support()
+    run()
@@ -0,0 +1,281 @@
+"""
+Evaluates generated map blocks the way nginx does, to prove that alternative map
+forms classify requests identically and to compare their matching cost.
+The generated map chain is also compared with the chain earlier versions wrote, so
+sites integrated before keep the same $prerender for every request.
+"""
+
+import re
+import sys
+import timeit
+import argparse
+import logging
+from prerender import build_map_directives, build_user_agent_map
+
+logger = logging.getLogger(__name__)
+
+MAP_SPECIAL_KEYS = ('default', 'hostnames', 'include', 'volatile')
+
+# real-world user agents: crawlers that must be prerendered and browsers/tools that must not
+SAMPLE_USER_AGENTS = [
+    "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)",
+    "Googlebot/2.1 (+http://www.google.com/bot.html)",
+    "Mozilla/5.0 (Linux; Android 6.0.1; Nexus 5X Build/MMB29P) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Mobile Safari/537.36 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)",
+    "Mozilla/5.0 (compatible; Google-InspectionTool/1.0)",
+    "Mozilla/5.0 (compatible; bingbot/2.0; +http://www.bing.com/bingbot.htm)",
+    "Mozilla/5.0 (compatible; Yahoo! Slurp; http://help.yahoo.com/help/us/ysearch/slurp)",
+    "Mozilla/5.0 (compatible; YandexBot/3.0; +http://yandex.com/bots)",
+    "Mozilla/5.0 (compatible; Baiduspider/2.0; +http://www.baidu.com/search/spider.html)",
+    "facebookexternalhit/1.1 (+http://www.facebook.com/externalhit_uatext.php)",
+    "Twitterbot/1.0",
+    "LinkedInBot/1.0 (compatible; Mozilla/5.0; Apache-HttpClient +http://www.linkedin.com)",
+    "Mozilla/5.0 (compatible; Embedly/0.2; +http://support.embed.ly/)",
+    "Pinterest/0.2 (+http://www.pinterest.com/)",
+    "Mozilla/5.0 (compatible; Pinterestbot/1.0; +http://www.pinterest.com/bot.html)",
+    "Slackbot-LinkExpanding 1.0 (+https://api.slack.com/robots)",
+    "WhatsApp/2.23.20.0",
+    "Mozilla/5.0 (compatible; Discordbot/2.0; +https://discordapp.com)",
+    "TelegramBot (like TwitterBot)",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Safari/605.1.15 (Applebot/0.1; +http://www.apple.com/go/applebot)",
+    "Mozilla/5.0 (Linux; Android 7.0;) AppleWebKit/537.36 (KHTML, like Gecko) Mobile Safari/537.36 (compatible; PetalBot;+https://webmaster.petalsearch.com/site/petalbot)",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36 Chrome-Lighthouse",
+    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36 Prerender (+https://github.com/prerender/prerender)",
+    "Mozilla/5.0 (compatible; Googlebot/2.1) Prerender",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 Safari/605.1.15",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:121.0) Gecko/20100101 Firefox/121.0",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 17_1 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 Mobile/15E148 Safari/604.1",
+    "Mozilla/5.0 (Linux; Android 14) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.6099.43 Mobile Safari/537.36",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36 Edg/120.0.0.0",
+    "curl/8.4.0",
+    "Wget/1.21.4",
+    "python-requests/2.32.3",
+    "Pinterest for Android/11.0",
+    "Google Page Speed Insights",
+    "",
+]
+
+# paths around the static extension match: extensions at the end, in the middle and as a prefix of a longer one
+SAMPLE_URIS = [
+    "/", "/about", "/blog/post-1", "/index.html", "/page.php",
+    "/app.js", "/APP.JS", "/app.js.map", "/static/main.css", "/data.json", "/feed.rss", "/sitemap.xml", "/sitemap.xml.gz",
+    "/logo.png", "/img/photo.JPEG", "/fonts/font.woff2", "/docs/node.js-guide", "/javascript", "/blog/.well-known",
+    "/files/report.pdf", "/a.docx", "/video.mp4", "/download.exe", "/aifile", "/x.ai", "/search.txt/results",
+]
+
+SAMPLE_ARGS = ["", "page=2", "_escaped_fragment_=", "a=1&_escaped_fragment_=/about", "x_escaped_fragment_=1"]
+
+SAMPLE_X_PRERENDER = ["", "1", "0"]
+
+# the chain as written by every version before the map builders, kept to check the generated one against
+LEGACY_MAP_CHAIN = [
+    {"directive": "map", "args": ["$http_user_agent", "$prerender_ua"], "block": [
+        {"directive": "default", "args": ["0"]},
+        {"directive": "~*Prerender", "args": ["0"]},
+        {"directive": "~*googlebot", "args": ["1"]},
+        {"directive": "~*yahoo!\\ slurp", "args": ["1"]},
+        {"directive": "~*bingbot", "args": ["1"]},
+        {"directive": "~*yandex", "args": ["1"]},
+        {"directive": "~*baiduspider", "args": ["1"]},
+        {"directive": "~*facebookexternalhit", "args": ["1"]},
+        {"directive": "~*twitterbot", "args": ["1"]},
+        {"directive": "~*rogerbot", "args": ["1"]},
+        {"directive": "~*linkedinbot", "args": ["1"]},
+        {"directive": "~*embedly", "args": ["1"]},
+        {"directive": "~*quora\\ link\\ preview", "args": ["1"]},
+        {"directive": "~*showyoubot", "args": ["1"]},
+        {"directive": "~*outbrain", "args": ["1"]},
+        {"directive": "~*pinterest\\/0\\.", "args": ["1"]},
+        {"directive": "~*developers.google.com\\/\\+\\/web\\/snippet", "args": ["1"]},
+        {"directive": "~*slackbot", "args": ["1"]},
+        {"directive": "~*vkshare", "args": ["1"]},
+        {"directive": "~*w3c_validator", "args": ["1"]},
+        {"directive": "~*redditbot", "args": ["1"]},
+        {"directive": "~*applebot", "args": ["1"]},
+        {"directive": "~*whatsapp", "args": ["1"]},
+        {"directive": "~*flipboard", "args": ["1"]},
+        {"directive": "~*tumblr", "args": ["1"]},
+        {"directive": "~*bitlybot", "args": ["1"]},
+        {"directive": "~*skypeuripreview", "args": ["1"]},
+        {"directive": "~*nuzzel", "args": ["1"]},
+        {"directive": "~*discordbot", "args": ["1"]},
+        {"directive": "~*google\\ page\\ speed", "args": ["1"]},
+        {"directive": "~*qwantify", "args": ["1"]},
+        {"directive": "~*pinterestbot", "args": ["1"]},
+        {"directive": "~*bitrix\\ link\\ preview", "args": ["1"]},
+        {"directive": "~*xing-contenttabreceiver", "args": ["1"]},
+        {"directive": "~*chrome-lighthouse", "args": ["1"]},
+        {"directive": "~*telegrambot", "args": ["1"]},
+        {"directive": "~*google-inspectiontool", "args": ["1"]},
+        {"directive": "~*petalbot", "args": ["1"]},
+    ]},
+    {"directive": "map", "args": ["$args", "$prerender_args"], "block": [
+        {"directive": "default", "args": ["$prerender_ua"]},
+        {"directive": "~(^|&)_escaped_fragment_=", "args": ["1"]},
+    ]},
+    {"directive": "map", "args": ["$http_x_prerender", "$x_prerender"], "block": [
+        {"directive": "default", "args": ["$prerender_args"]},
+        {"directive": "1", "args": ["0"]},
+    ]},
+    {"directive": "map", "args": ["$uri", "$prerender"], "block": [
+        {"directive": "default", "args": ["$x_prerender"]},
+        {"directive": "~*\\.(js|css|xml|less|png|jpg|jpeg|gif|pdf|txt|ico|rss|zip|mp3|rar|exe|wmv|doc|avi|ppt|mpg|mpeg|tif|wav|mov|psd|ai|xls|mp4|m4a|swf|dat|dmg|iso|flv|m4v|torrent|ttf|woff|woff2|svg|eot)", "args": ["0"]},
+    ]},
+]
+
+def _compile_key(key: str):
+    if key.startswith('~*'):
+        return re.compile(key[2:], re.IGNORECASE)
+    if key.startswith('~'):
+        return re.compile(key[1:])
+    return None
+
+class MapEmulator:
+    """
+    Evaluates a set of crossplane map directives like nginx: exact keys are compared
+    case-insensitively via a hash, then regex keys are tried in order, otherwise default.
+    Values starting with $ are resolved recursively, so a whole map chain can be evaluated.
+    """
+    def __init__(self, maps: list):
+        self.maps = {}
+        for map_directive in maps:
+            source, target = map_directive["args"]
+            exact = {}
+            regexes = []
+            default = ""
+            for entry in map_directive["block"]:
+                key, value = entry["directive"], entry["args"][0]
+                if key == 'default':
+                    default = value
+                elif key in MAP_SPECIAL_KEYS:
+                    continue
+                elif key.startswith('~'):
+                    regexes.append((_compile_key(key), value))
+                else:
+                    exact.setdefault(key.lstrip('\\').lower(), value)
+            self.maps[target] = (source, exact, regexes, default)
+
+    def lookup(self, variable: str, value: str) -> str:
+        """
+        Returns what the map setting $variable gives for the value of its source, before resolving $ references.
+        """
+        _, exact, regexes, default = self.maps[variable]
+
+        result = exact.get(value.lower())
+        if result is None:
+            result = default
+            for regex, regex_value in regexes:
+                if regex.search(value):
+                    result = regex_value
+                    break
+        return result
+
+    def evaluate(self, variable: str, variables: dict) -> str:
+        """
+        Returns the value of $variable given request variables like {"$http_user_agent": "..."}.
+        """
+        if variable not in self.maps:
+            return variables.get(variable, "")
+
+        result = self.lookup(variable, variables.get(self.maps[variable][0], ""))
+
+        if result.startswith('$'):
+            return self.evaluate(result, variables)
+        return result
+
+def find_mismatches(expected_maps: list, actual_maps: list, variable: str, requests: list) -> list:
+    """
+    Returns the requests (dicts of variables) for which both map sets give a different value of variable.
+    """
+    expected = MapEmulator(expected_maps)
+    actual = MapEmulator(actual_maps)
+    mismatches = []
+
+    for request in requests:
+        expected_value = expected.evaluate(variable, request)
+        actual_value = actual.evaluate(variable, request)
+        if expected_value != actual_value:
+            mismatches.append((request, expected_value, actual_value))
+
+    return mismatches
+
+def benchmark(maps: list, variable: str, requests: list, repeat: int = 5, number: int = 200) -> float:
+    """
+    Returns the best average time in microseconds to evaluate variable for one request.
+    """
+    emulator = MapEmulator(maps)
+
+    def run():
+        for request in requests:
+            emulator.evaluate(variable, request)
+
+    best = min(timeit.repeat(run, repeat=repeat, number=number))
+    return best / (number * len(requests)) * 1e6
+
+def load_user_agents(file_path: str) -> list:
+    with open(file_path, 'r', errors='replace') as file:
+        return [line.rstrip('\n') for line in file]
+
+def check_compact_user_agent_map(user_agents: list) -> tuple:
+    """
+    Compares the compact user agent map with the per-bot one.
+    Returns (mismatches, list_cost_us, compact_cost_us).
+    """
+    requests = [{"$http_user_agent": user_agent} for user_agent in user_agents]
+    list_map = [build_user_agent_map(compact=False)]
+    compact_map = [build_user_agent_map(compact=True)]
+
+    mismatches = find_mismatches(list_map, compact_map, "$prerender_ua", requests)
+    list_cost = benchmark(list_map, "$prerender_ua", requests)
+    compact_cost = benchmark(compact_map, "$prerender_ua", requests)
+
+    return (mismatches, list_cost, compact_cost)
+
+def check_map_chain(user_agents: list, uris: list) -> tuple:
+    """
+    Compares $prerender of the generated map chain, with each user agent map form, with the legacy chain
+    over every combination of user agent, URI, args and X-Prerender header.
+    Returns (requests, mismatches), mismatches being (compact_ua, request, legacy_value, generated_value) tuples.
+    """
+    requests = [
+        {"$http_user_agent": user_agent, "$uri": uri, "$args": request_args, "$http_x_prerender": x_prerender}
+        for user_agent in user_agents for uri in uris for request_args in SAMPLE_ARGS for x_prerender in SAMPLE_X_PRERENDER
+    ]
+    mismatches = []
+
+    for compact_ua in (False, True):
+        for request, expected_value, actual_value in find_mismatches(LEGACY_MAP_CHAIN, build_map_directives(compact_ua), "$prerender", requests):
+            mismatches.append((compact_ua, request, expected_value, actual_value))
+
+    return (requests, mismatches)
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Check that the generated maps classify requests like the per-bot map and the legacy chain")
+    parser.add_argument('--corpus', help='File with one user agent per line (default: built-in sample)', default=None)
+    parser.add_argument('--uris', help='File with one URI path per line (default: built-in sample)', default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    user_agents = load_user_agents(args.corpus) if args.corpus else SAMPLE_USER_AGENTS
+    mismatches, list_cost, compact_cost = check_compact_user_agent_map(user_agents)
+
+    for request, expected_value, actual_value in mismatches:
+        logger.info(f"Mismatch for {request['$http_user_agent']!r}: per-bot map {expected_value}, compact map {actual_value}")
+
+    logger.info(f"{len(user_agents)} user agents, {len(mismatches)} mismatches")
+    logger.info(f"Per-bot map: {list_cost:.2f}us per request, compact map: {compact_cost:.2f}us per request")
+
+    uris = load_user_agents(args.uris) if args.uris else SAMPLE_URIS
+    requests, chain_mismatches = check_map_chain(user_agents, uris)
+
+    for compact_ua, request, expected_value, actual_value in chain_mismatches:
+        logger.info(f"Mismatch for {request['$uri']!r}?{request['$args']} (X-Prerender {request['$http_x_prerender']!r}, "
+                    f"{request['$http_user_agent']!r}): legacy chain {expected_value}, "
+                    f"{'compact' if compact_ua else 'per-bot'} chain {actual_value}")
+
+    logger.info(f"{len(requests)} requests, {len(chain_mismatches)} $prerender mismatches with the legacy map chain")
+
+    return 1 if mismatches or chain_mismatches else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,158 @@
 import os
+import time
+import shutil
+import signal
 import logging
+import subprocess
 
 logger = logging.getLogger(__name__)
 
-def restart_nginx():
+DEFAULT_NGINX_BINARY = 'nginx'
+DEFAULT_PID_FILES = ['/run/nginx.pid', '/var/run/nginx.pid', '/usr/local/nginx/logs/nginx.pid']
+DEFAULT_RELOAD_TIMEOUT = 10
+RELOAD_METHODS = ('auto', 'systemctl', 'signal', 'nginx')
+
+def _sudo() -> list:
+    if os.geteuid() != 0 and shutil.which('sudo'):
+        return ['sudo']
+    return []
+
+def _run(command: list) -> subprocess.CompletedProcess:
+    logger.debug("Running %s", ' '.join(command))
+    return subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+def test_config(config_path: str, nginx_bin: str = DEFAULT_NGINX_BINARY) -> None:
+    """
+    Runs nginx -t against the given main config file and raises if it is invalid.
+    """
+    result = _run(_sudo() + [nginx_bin, '-t', '-c', os.path.abspath(config_path)])
+    if result.returncode != 0:
+        raise Exception(f"Nginx configuration test failed:\n{result.stderr.strip()}")
+    logger.debug("Nginx configuration test passed: %s", result.stderr.strip())
+
+def get_master_pid(pid_file: str = None) -> int:
+    """
+    Returns the pid of a running nginx master from the pid file, or None.
+    """
+    for path in [pid_file] if pid_file else DEFAULT_PID_FILES:
+        try:
+            with open(path, 'r') as file:
+                pid = int(file.read().strip())
+            os.kill(pid, 0)
+            return pid
+        except PermissionError:
+            # process exists but belongs to root
+            return pid
+        except (OSError, ValueError):
+            continue
+    return None
+
+def get_worker_pids(master_pid: int) -> set:
+    """
+    Returns pids of the children of the nginx master, read from /proc. Empty if /proc is not available.
+    """
+    workers = set()
+    try:
+        entries = os.listdir('/proc')
+    except OSError:
+        return workers
+
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", 'r') as file:
+                stat = file.read()
+        except OSError:
+            continue
+        # the command name may contain spaces and parentheses, fields after it are fixed
+        fields = stat.rsplit(')', 1)[-1].split()
+        if len(fields) > 1 and fields[1] == str(master_pid):
+            workers.add(int(entry))
+
+    return workers
+
+def detect_reload_method(nginx_bin: str = DEFAULT_NGINX_BINARY, pid_file: str = None) -> str:
+    if shutil.which('systemctl') and _run(['systemctl', 'is-active', '--quiet', 'nginx']).returncode == 0:
+        return 'systemctl'
+    if get_master_pid(pid_file):
+        return 'signal'
+    if shutil.which(nginx_bin):
+        return 'nginx'
+    raise Exception("Could not find a running nginx to reload.")
+
+def send_reload(method: str, nginx_bin: str = DEFAULT_NGINX_BINARY, pid_file: str = None, config_path: str = None) -> None:
+    if method == 'systemctl':
+        result = _run(_sudo() + ['systemctl', 'reload', 'nginx'])
+    elif method == 'signal':
+        master_pid = get_master_pid(pid_file)
+        if not master_pid:
+            raise Exception(f"Nginx master process not found (pid file {pid_file or ', '.join(DEFAULT_PID_FILES)}).")
+        try:
+            os.kill(master_pid, signal.SIGHUP)
+            return
+        except PermissionError:
+            result = _run(_sudo() + ['kill', '-HUP', str(master_pid)])
+    elif method == 'nginx':
+        command = [nginx_bin, '-s', 'reload']
+        if config_path:
+            command += ['-c', os.path.abspath(config_path)]
+        result = _run(_sudo() + command)
+    else:
+        raise Exception(f"Unknown reload method {method}")
+
+    if result.returncode != 0:
+        raise Exception(f"Failed to reload nginx service: {result.stderr.strip()}")
+
+def wait_for_new_workers(master_pid: int, old_workers: set, pid_file: str = None, timeout: float = DEFAULT_RELOAD_TIMEOUT) -> bool:
+    """
+    Waits until the master has spawned a worker that was not there before the reload.
+    Old workers keep running until their connections finish, so their exit is not awaited.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        current_master = get_master_pid(pid_file) or master_pid
+        if get_worker_pids(current_master) - old_workers:
+            return True
+        time.sleep(0.05)
+    return False
+
+def reload_nginx(config_path: str = None, nginx_bin: str = DEFAULT_NGINX_BINARY, pid_file: str = None,
+                 method: str = 'auto', timeout: float = DEFAULT_RELOAD_TIMEOUT, validate: bool = True) -> float:
+    """
+    Validates the config with nginx -t (unless validate is False, for callers that just did),
+    gracefully reloads nginx (in-flight connections are kept) and waits for the new worker generation.
+    Returns the elapsed time in seconds.
+    """
     logger.info("Reloading nginx service, you may be prompted to enter your sudo password...")
-    result = os.system("sudo systemctl restart nginx")
-    if result != 0:
-        raise Exception("Failed to reload nginx service.")
\ No newline at end of file
+    started = time.perf_counter()
+
+    if config_path and validate:
+        test_config(config_path, nginx_bin)
+
+    if not method or method == 'auto':
+        method = detect_reload_method(nginx_bin, pid_file)
+    logger.debug("Reloading nginx with %s", method)
+
+    master_pid = get_master_pid(pid_file)
+    old_workers = get_worker_pids(master_pid) if master_pid else set()
+
+    send_reload(method, nginx_bin, pid_file, config_path)
+
+    if master_pid and old_workers:
+        if not wait_for_new_workers(master_pid, old_workers, pid_file, timeout):
+            raise Exception(f"Nginx did not start new workers within {timeout}s after reload.")
+
+    elapsed = time.perf_counter() - started
+    logger.info(f"Nginx reloaded in {elapsed:.2f}s")
+
+    return elapsed
+
+def get_pid_file(main_config) -> str:
+    """
+    Returns the path of the pid directive in the main config (a config_model Block), if any.
+    """
+    for directive in main_config.find_all("pid"):
+        if directive.args:
+            return directive.args[0]
+    return None
@@ -0,0 +1,277 @@
+"""
+Per-file front-end for crossplane.
+
+crossplane.parse walks the whole include tree in one call. Here every file is lexed and parsed
+on its own (so results can be cached or computed in parallel) and include directives are
+resolved afterwards, producing the same payload as crossplane.parse(single=False, combine=False).
+"""
+
+import io
+import os
+import glob
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from crossplane.analyzer import analyze, enter_block_ctx
+from crossplane.errors import NgxParserDirectiveError
+# private, but crossplane.lex only lexes a file it opens itself and the bytes here were already read,
+# so requirements.txt pins crossplane exactly
+from crossplane.lexer import _balance_braces, _lex_file_object
+from diagnostics import capture_config
+from instrumentation import record_read
+
+logger = logging.getLogger(__name__)
+
+# include levels with fewer files to parse are parsed in this process, starting workers would take longer
+PARALLEL_MIN_FILES = 16
+
+def read_file(file_path: str) -> bytes:
+    with open(file_path, 'rb') as file:
+        data = file.read()
+    record_read(len(data))
+    capture_config(file_path, data)
+    return data
+
+def _prepare_if_args(stmt):
+    """Removes parentheses from an "if" directive's arguments, same as crossplane"""
+    args = stmt['args']
+    if args and args[0].startswith('(') and args[-1].endswith(')'):
+        args[0] = args[0][1:].lstrip()
+        args[-1] = args[-1][:-1].rstrip()
+        start = int(not args[0])
+        end = len(args) - int(not args[-1])
+        args[:] = args[start:end]
+
+def _lex(file_path: str, data: bytes):
+    # decode exactly like crossplane.lexer.lex does when it opens the file itself
+    file_obj = io.TextIOWrapper(io.BytesIO(data), encoding='utf-8', errors='replace')
+    return _balance_braces(_lex_file_object(file_obj), file_path)
+
+def parse_file(file_path: str, ctx: tuple = (), data: bytes = None, comments: bool = True, strict: bool = False) -> dict:
+    """
+    Parses a single config file in the given context without following includes.
+    Returns a crossplane "config" item: {'file', 'status', 'errors', 'parsed'}.
+    """
+    parsing = {
+        'file': file_path,
+        'status': 'ok',
+        'errors': [],
+        'parsed': []
+    }
+
+    def _handle_error(e):
+        parsing['status'] = 'failed'
+        parsing['errors'].append({'error': str(e), 'line': getattr(e, 'lineno', None)})
+
+    def _parse(tokens, ctx=(), consume=False):
+        parsed = []
+
+        for token, lineno, quoted in tokens:
+            comments_in_args = []
+
+            if token == '}' and not quoted:
+                break
+
+            if consume:
+                if token == '{' and not quoted:
+                    _parse(tokens, consume=True)
+                continue
+
+            directive = token
+            stmt = {
+                'directive': directive,
+                'line': lineno,
+                'args': []
+            }
+
+            if directive.startswith('#') and not quoted:
+                if comments:
+                    stmt['directive'] = '#'
+                    stmt['comment'] = token[1:]
+                    parsed.append(stmt)
+                continue
+
+            token, __, quoted = next(tokens)
+            while token not in ('{', ';', '}') or quoted:
+                if token.startswith('#') and not quoted:
+                    comments_in_args.append(token[1:])
+                else:
+                    stmt['args'].append(token)
+
+                token, __, quoted = next(tokens)
+
+            if stmt['directive'] == 'if':
+                _prepare_if_args(stmt)
+
+            try:
+                analyze(fname=file_path, stmt=stmt, term=token, ctx=ctx, strict=strict)
+            except NgxParserDirectiveError as e:
+                _handle_error(e)
+
+                if e.strerror.endswith(' is not terminated by ";"'):
+                    if token != '}' and not quoted:
+                        _parse(tokens, consume=True)
+                    else:
+                        break
+
+                continue
+
+            if token == '{' and not quoted:
+                inner = enter_block_ctx(stmt, ctx)
+                stmt['block'] = _parse(tokens, ctx=inner)
+
+            parsed.append(stmt)
+
+            for comment in comments_in_args:
+                parsed.append({
+                    'directive': '#',
+                    'line': stmt['line'],
+                    'args': [],
+                    'comment': comment
+                })
+
+        return parsed
+
+    try:
+        if data is None:
+            data = read_file(file_path)
+        parsing['parsed'] = _parse(_lex(file_path, data), ctx=ctx)
+    except Exception as e:
+        _handle_error(e)
+
+    return parsing
+
+def resolve_includes(parsing: dict, ctx: tuple, config_dir: str, includes: list, included: dict) -> None:
+    """
+    Adds "includes" indexes to include directives of a parsed file, registering newly found files
+    in includes/included the same way crossplane does. Missing explicit includes are reported as errors.
+    """
+    include_errors = []
+
+    def _walk(block, ctx):
+        for stmt in block:
+            if stmt['directive'] == 'include':
+                pattern = stmt['args'][0]
+                if not os.path.isabs(pattern):
+                    pattern = os.path.join(config_dir, pattern)
+
+                stmt['includes'] = []
+
+                if glob.has_magic(pattern):
+                    fnames = glob.glob(pattern)
+                    fnames.sort()
+                else:
+                    try:
+                        open(str(pattern)).close()
+                        fnames = [pattern]
+                    except Exception as e:
+                        fnames = []
+                        include_errors.append({'error': str(e), 'line': stmt['line']})
+
+                for fname in fnames:
+                    if fname not in included:
+                        included[fname] = len(includes)
+                        includes.append((fname, ctx))
+                    stmt['includes'].append(included[fname])
+
+            if 'block' in stmt:
+                _walk(stmt['block'], enter_block_ctx(stmt, ctx))
+
+    _walk(parsing['parsed'], ctx)
+
+    if include_errors:
+        parsing['status'] = 'failed'
+        # keep errors in line order, as they would be reported while parsing
+        parsing['errors'] = sorted(parsing['errors'] + include_errors, key=lambda error: error['line'] or 0)
+
+def _parse_file_args(args: tuple) -> dict:
+    return parse_file(*args)
+
+def _parse_files(files: list, comments: bool, strict: bool, executor: ProcessPoolExecutor = None, chunksize: int = 1) -> list:
+    """
+    Parses the (file_path, ctx, data) files, in the executor's worker processes if given.
+    Returns the parsings in the order of files.
+    """
+    tasks = [(fname, ctx, data, comments, strict) for fname, ctx, data in files]
+    if executor is None:
+        return [_parse_file_args(task) for task in tasks]
+    return list(executor.map(_parse_file_args, tasks, chunksize=chunksize))
+
+def parse_tree(file_path: str, comments: bool = True, strict: bool = False, cache=None, workers: int = 1) -> dict:
+    """
+    Parses the config file and everything it includes.
+    With a ParseCache, files whose fingerprint did not change are not parsed again.
+    With workers > 1, the files found on each include level are parsed in a pool of worker processes.
+    Files are still read, and their includes resolved, here in include order, so the payload is the
+    same as when parsing sequentially.
+    """
+    config_dir = os.path.dirname(file_path)
+
+    payload = {
+        'status': 'ok',
+        'errors': [],
+        'config': [],
+    }
+
+    includes = [(file_path, ())]
+    included = {file_path: 0}
+    executor = None
+    start = 0
+
+    try:
+        # the includes list grows while include directives are resolved,
+        # each wave is the files the previous one included
+        while start < len(includes):
+            wave = includes[start:]
+            start = len(includes)
+            parsings = [None] * len(wave)
+            misses = []
+
+            for index, (fname, ctx) in enumerate(wave):
+                try:
+                    data = read_file(fname)
+                except Exception as e:
+                    parsings[index] = {'file': fname, 'status': 'failed', 'errors': [{'error': str(e), 'line': None}], 'parsed': []}
+                    continue
+
+                if cache is not None:
+                    parsings[index] = cache.get(fname, ctx, data, comments, strict)
+                if parsings[index] is None:
+                    misses.append((index, fname, ctx, data))
+
+            files = [(fname, ctx, data) for _, fname, ctx, data in misses]
+            if workers > 1 and len(files) >= PARALLEL_MIN_FILES:
+                try:
+                    if executor is None:
+                        executor = ProcessPoolExecutor(max_workers=workers)
+                    # a few chunks per worker, so a worker that got big files doesn't hold up the level
+                    parsed = _parse_files(files, comments, strict, executor, chunksize=max(1, len(files) // (workers * 4)))
+                except (BrokenProcessPool, OSError) as e:
+                    logger.debug("Parsing in worker processes failed, parsing sequentially: %s", e)
+                    workers = 1
+                    parsed = _parse_files(files, comments, strict)
+            else:
+                parsed = _parse_files(files, comments, strict)
+
+            for (index, fname, ctx, data), parsing in zip(misses, parsed):
+                parsings[index] = parsing
+                if cache is not None:
+                    cache.put(fname, ctx, data, comments, strict, parsing)
+
+            for (fname, ctx), parsing in zip(wave, parsings):
+                resolve_includes(parsing, ctx, config_dir, includes, included)
+
+                for error in parsing['errors']:
+                    payload['status'] = 'failed'
+                    payload['errors'].append({'file': fname, 'error': error['error'], 'line': error['line']})
+
+                payload['config'].append(parsing)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if cache is not None:
+        cache.evict()
+        logger.debug("Parse cache: %d hits, %d misses", cache.hits, cache.misses)
+
+    return payload
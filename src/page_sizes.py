@@ -0,0 +1,69 @@
+import math
+import logging
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from defaults import DEFAULT_CONCURRENCY, DEFAULT_TIMEOUT
+from probe import percentile
+from site_url import BOT_USER_AGENT, create_session
+from verification import get_sample_urls
+
+logger = logging.getLogger(__name__)
+
+PRERENDER_SERVICE_URL = "https://service.prerender.io/"
+
+# buffers are sized for the 95th percentile page plus this margin
+PAGE_SIZE_MARGIN = 1.25
+
+def measure_page(session: requests.Session, url: str, prerender_token: str, compressed: bool = False,
+                 service_url: str = PRERENDER_SERVICE_URL, timeout: float = DEFAULT_TIMEOUT) -> dict:
+    """
+    Fetches the prerendered page from the Prerender service like nginx does and returns its status
+    and body size as sent over the wire (gzipped if compressed).
+    """
+    result = {"url": url, "status": None, "size": None, "error": None}
+    headers = {
+        "User-Agent": BOT_USER_AGENT,
+        "X-Prerender-Token": prerender_token,
+        "Accept-Encoding": "gzip" if compressed else "identity",
+    }
+
+    try:
+        with session.get(f"{service_url}{url}", headers=headers, timeout=timeout, stream=True) as response:
+            result["status"] = response.status_code
+            # count the raw bytes, that's what the proxy buffers hold
+            result["size"] = sum(len(chunk) for chunk in response.raw.stream(64 * 1024, decode_content=False))
+    except requests.exceptions.RequestException as e:
+        result["error"] = str(e)
+
+    return result
+
+def measure_page_sizes(site_url: str, prerender_token: str, sample: int = 10, urls_file: str = None, compressed: bool = False,
+                       concurrency: int = DEFAULT_CONCURRENCY, timeout: float = DEFAULT_TIMEOUT,
+                       service_url: str = PRERENDER_SERVICE_URL) -> dict:
+    """
+    Measures up to `sample` prerendered pages of the site (root, then sitemap URLs or urls_file).
+    Each page counts as a render of the Prerender account.
+    Returns {"urls", "measured", "p50", "p95", "max" (bytes), "page_size_kb"}, page_size_kb is None when nothing could be measured.
+    """
+    session = create_session(pool_size=concurrency)
+    urls = list(get_sample_urls(site_url, session, sample, urls_file, timeout))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda url: measure_page(session, url, prerender_token, compressed, service_url, timeout), urls))
+
+    sizes = []
+    for result in results:
+        if result["status"] == 200 and result["size"]:
+            sizes.append(result["size"])
+        else:
+            logger.debug("Page size of %s not measured: %s", result['url'], result['error'] or f"status {result['status']}")
+
+    p95 = percentile(sizes, 0.95)
+    return {
+        "urls": len(urls),
+        "measured": len(sizes),
+        "p50": percentile(sizes, 0.50),
+        "p95": p95,
+        "max": max(sizes) if sizes else None,
+        "page_size_kb": math.ceil(p95 * PAGE_SIZE_MARGIN / 1024) if p95 else None,
+    }
@@ -0,0 +1,110 @@
+import os
+import json
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_ENTRIES = 20000
+CACHE_VERSION = 1
+
+def get_default_cache_dir() -> str:
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'prerender-nginx', 'parse')
+
+class ParseCache:
+    """
+    On-disk cache of per-file parse results.
+
+    Entries are keyed by file path, include context and parser flags, and are only reused when
+    the file's mtime, size and content hash all match. Least recently used entries are evicted
+    once the cache holds more than max_entries files.
+    """
+    def __init__(self, cache_dir: str = None, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.cache_dir = cache_dir or get_default_cache_dir()
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.enabled = True
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        except OSError as e:
+            logger.debug("Parse cache disabled, can't create %s: %s", self.cache_dir, e)
+            self.enabled = False
+
+    def _entry_path(self, file_path: str, ctx: tuple, comments: bool, strict: bool) -> str:
+        key = json.dumps([CACHE_VERSION, os.path.abspath(file_path), list(ctx), comments, strict])
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.json')
+
+    def _fingerprint(self, file_path: str, data: bytes) -> dict:
+        stat = os.stat(file_path)
+        return {
+            'mtime_ns': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'sha256': hashlib.sha256(data).hexdigest(),
+        }
+
+    def get(self, file_path: str, ctx: tuple, data: bytes, comments: bool, strict: bool) -> dict:
+        """
+        Returns the cached parse result or None if there is no entry or the file changed.
+        """
+        if not self.enabled:
+            return None
+
+        entry_path = self._entry_path(file_path, ctx, comments, strict)
+
+        try:
+            with open(entry_path, 'r') as file:
+                entry = json.load(file)
+            if entry['fingerprint'] == self._fingerprint(file_path, data):
+                self.hits += 1
+                # mark as recently used for eviction
+                os.utime(entry_path)
+                return entry['parsing']
+        except (OSError, ValueError, KeyError):
+            pass
+
+        self.misses += 1
+        return None
+
+    def put(self, file_path: str, ctx: tuple, data: bytes, comments: bool, strict: bool, parsing: dict) -> None:
+        if not self.enabled:
+            return
+
+        entry_path = self._entry_path(file_path, ctx, comments, strict)
+        temp_path = f"{entry_path}.{os.getpid()}.tmp"
+
+        try:
+            entry = {'fingerprint': self._fingerprint(file_path, data), 'parsing': parsing}
+            with open(temp_path, 'w') as file:
+                json.dump(entry, file)
+            os.replace(temp_path, entry_path)
+            self.writes += 1
+        except OSError as e:
+            logger.debug("Failed to write parse cache entry for %s: %s", file_path, e)
+
+    def evict(self) -> None:
+        """
+        Removes least recently used entries above max_entries.
+        """
+        if not self.enabled or not self.writes:
+            return
+
+        try:
+            entries = [entry for entry in os.scandir(self.cache_dir) if entry.name.endswith('.json')]
+        except OSError:
+            return
+
+        if len(entries) <= self.max_entries:
+            return
+
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[:len(entries) - self.max_entries]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+        logger.debug("Parse cache: evicted %d entries", len(entries) - self.max_entries)
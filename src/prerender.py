@@ -1,14 +1,21 @@
-def get_http_section(config: list) -> dict:
+import os
+import json
+import math
+import hashlib
+import shutil
+import fnmatch
+import logging
+from config_model import Block, Directive
+
+logger = logging.getLogger(__name__)
+
+def get_http_section(config: Block) -> Directive:
     """
     Returns the http section from the configuration.
     """
-    for section in config:
-        if section.get("directive") == "http":
-            return section
-    
-    return None
+    return config.find("http")
 
-def get_all_server_blocks_with_attrs(config: list) -> list:
+def get_all_server_blocks_with_attrs(config: Block) -> list:
     """
     Returns a list of server blocks with their server names.
     If a server block does not have a server name, it will be None.
@@ -18,87 +25,253 @@ def get_all_server_blocks_with_attrs(config: list) -> list:
     http_section = get_http_section(config)    
     
     if http_section is not None:
-        iterable_section = http_section.get("block", [])
+        iterable_section = http_section.block
     else:
         iterable_section = config
     
-    for directive in iterable_section:
-        if directive.get("directive") == "server":
-            server_name = None
-            server_listening = None
-            
-            for server_directive in directive.get("block", []):
-                if server_directive.get("directive") == "server_name":
-                    server_name = server_directive.get("args", [None])[0]
-                elif server_directive.get("directive") == "listen":
-                    server_listening = server_directive.get("args", [None])[0]
-
-            server_blocks_with_names.append((directive, server_name, server_listening))
+    for directive in iterable_section.find_all("server"):
+        server_name = None
+        server_listening = None
+
+        for server_directive in directive.block:
+            if server_directive.name == "server_name":
+                server_name = (server_directive.args or (None,))[0]
+            elif server_directive.name == "listen":
+                server_listening = (server_directive.args or (None,))[0]
+
+        server_blocks_with_names.append((directive, server_name, server_listening))
     return server_blocks_with_names
 
+def get_server_block_name(server_block: tuple) -> str:
+    """
+    Returns a human readable name for a (block, server_name, listen) tuple.
+    """
+    (_, server_name, server_listening) = server_block
+
+    server_name = server_name if server_name else "(no server_name)"
+
+    return f"{server_name} {server_listening}"
+
+def get_server_blocks(parsed_configs: dict) -> list:
+    """
+    Returns all server blocks found in successfully parsed config files.
+    Each item is a dict with the block tuple, the config it belongs to and a display name.
+    """
+    server_blocks = []
+
+    for i, (config) in enumerate(parsed_configs['config']):
+        if not config['status'] == 'ok':
+            logger.warning(f"Skipping config {i} due to parsing error")
+            continue
+
+        for server_block in get_all_server_blocks_with_attrs(config['parsed']):
+            server_blocks.append({
+                "block": server_block,
+                "config": config,
+                "name": get_server_block_name(server_block)
+            })
+
+    return server_blocks
+
+def select_server_block(server_blocks: list, selector) -> dict:
+    """
+    Returns the server block matching the selector.
+    Selector is either a 1-based index (as shown to the user) or a server_name.
+    """
+    if selector is None:
+        if len(server_blocks) == 1:
+            return server_blocks[0]
+        raise Exception("Server block selector is required when more than one server block is found")
+
+    selector = str(selector)
+
+    if selector.isdigit():
+        index = int(selector)
+        if index < 1 or index > len(server_blocks):
+            raise Exception(f"Server block index {index} is out of range (1-{len(server_blocks)})")
+        return server_blocks[index - 1]
+
+    for server_block in server_blocks:
+        if server_block['block'][1] == selector:
+            return server_block
+
+    raise Exception(f"No server block found for server_name {selector}")
+
+def get_server_names(server_block: dict) -> list:
+    """
+    Returns all names of the server_name directives of a get_server_blocks item.
+    """
+    return [name for directive in server_block['block'][0].block.find_all("server_name") for name in directive.args]
+
+def select_server_blocks(server_blocks: list, selector) -> list:
+    """
+    Returns the server blocks matching the selector, in config order.
+    Selector is "all" or a comma separated list of 1-based indexes and server_name globs,
+    e.g. "1,3" or "example.com,*.example.com". A glob matches a block if it matches any of its names.
+    """
+    selector = str(selector).strip()
+    if selector.lower() == "all":
+        return list(server_blocks)
+
+    selected = set()
+    for item in selector.split(","):
+        item = item.strip()
+        if not item:
+            continue
+
+        if item.isdigit():
+            matches = [select_server_block(server_blocks, item)]
+        else:
+            pattern = item.lower()
+            matches = [server_block for server_block in server_blocks
+                       if any(fnmatch.fnmatchcase(name.lower(), pattern) for name in get_server_names(server_block))]
+            if not matches:
+                raise Exception(f"No server block found for server_name {item}")
+
+        selected.update(id(server_block) for server_block in matches)
+
+    if not selected:
+        raise Exception("Server block selector is empty")
+
+    return [server_block for server_block in server_blocks if id(server_block) in selected]
+
 """
     Returns the location block with the given path in the server block.
 """
-def get_location_block(server_block: dict, location: str) -> dict:
-    for directive in server_block.get("block", []):
-        if directive.get("directive") == "location":
-            args = directive.get("args", [])
-            if args and args[0] == location:
-                return directive
+def get_location_block(server_block: Directive, location: str) -> Directive:
+    for directive in server_block.block.find_all("location"):
+        if directive.args[:1] == (location,):
+            return directive
     raise Exception(f"No location block found for {location} in the server block")
 
-def add_map_section(config: list) -> None:
+# regex fragments matched case-insensitively against $http_user_agent, in map order
+BOT_USER_AGENTS = [
+    "googlebot",
+    "yahoo!\\ slurp",
+    "bingbot",
+    "yandex",
+    "baiduspider",
+    "facebookexternalhit",
+    "twitterbot",
+    "rogerbot",
+    "linkedinbot",
+    "embedly",
+    "quora\\ link\\ preview",
+    "showyoubot",
+    "outbrain",
+    "pinterest\\/0\\.",
+    "developers.google.com\\/\\+\\/web\\/snippet",
+    "slackbot",
+    "vkshare",
+    "w3c_validator",
+    "redditbot",
+    "applebot",
+    "whatsapp",
+    "flipboard",
+    "tumblr",
+    "bitlybot",
+    "skypeuripreview",
+    "nuzzel",
+    "discordbot",
+    "google\\ page\\ speed",
+    "qwantify",
+    "pinterestbot",
+    "bitrix\\ link\\ preview",
+    "xing-contenttabreceiver",
+    "chrome-lighthouse",
+    "telegrambot",
+    "google-inspectiontool",
+    "petalbot",
+]
+
+def _split_regex_atoms(pattern: str) -> list:
     """
-    Adds or updates map directives in the http section before the first server block.
+    Splits a regex fragment into atoms, keeping escape sequences like "\\ " or "\\/" together.
     """
-    http_section = get_http_section(config)    
+    atoms = []
+    i = 0
+    while i < len(pattern):
+        if pattern[i] == "\\" and i + 1 < len(pattern):
+            atoms.append(pattern[i:i + 2])
+            i += 2
+        else:
+            atoms.append(pattern[i])
+            i += 1
+    return atoms
 
-    # Build map directive: map $http_user_agent $prerender_ua { ... }
-    map_http_user_agent = {
+def build_compact_pattern(patterns: list) -> str:
+    """
+    Merges regex fragments into one prefix-factored alternation,
+    e.g. googlebot, google\\ page\\ speed -> (?:google(?:bot|\\ page\\ speed)).
+    The fragments are matched anywhere in the value, so a fragment that starts with another one is dropped.
+    """
+    trie = {}
+    for pattern in patterns:
+        node = trie
+        for atom in _split_regex_atoms(pattern):
+            # the map is case-insensitive, but escape sequences like \\S must keep their case
+            atom = atom if atom.startswith("\\") else atom.lower()
+            node = node.setdefault(atom, {})
+        node[None] = {}
+
+    def _emit(node):
+        if None in node:
+            return ""
+        branches = []
+        for atom, child in node.items():
+            # follow single-child chains to keep the output flat
+            prefix = atom
+            while None not in child and len(child) == 1:
+                (next_atom, child), = child.items()
+                prefix += next_atom
+            branches.append(prefix + _emit(child))
+        if len(branches) == 1:
+            return branches[0]
+        return "(?:" + "|".join(branches) + ")"
+
+    return "(?:" + "|".join(atom + _emit(child) for atom, child in trie.items()) + ")"
+
+def build_user_agent_map(compact: bool = False) -> dict:
+    """
+    Builds map $http_user_agent $prerender_ua { ... }.
+    The compact form matches all bots with a single regex instead of one regex per bot.
+    """
+    if compact:
+        bot_entries = [{"directive": "~*" + build_compact_pattern(BOT_USER_AGENTS), "args": ["1"]}]
+    else:
+        bot_entries = [{"directive": "~*" + pattern, "args": ["1"]} for pattern in BOT_USER_AGENTS]
+
+    return {
         "directive": "map",
         "args": ["$http_user_agent", "$prerender_ua"],
         "block": [
             {"directive": "default", "args": ["0"]},
+            # Prerender's own requests must never be sent back to Prerender, so this stays first
             {"directive": "~*Prerender", "args": ["0"]},
-            {"directive": "~*googlebot", "args": ["1"]},
-            {"directive": "~*yahoo!\\ slurp", "args": ["1"]},
-            {"directive": "~*bingbot", "args": ["1"]},
-            {"directive": "~*yandex", "args": ["1"]},
-            {"directive": "~*baiduspider", "args": ["1"]},
-            {"directive": "~*facebookexternalhit", "args": ["1"]},
-            {"directive": "~*twitterbot", "args": ["1"]},
-            {"directive": "~*rogerbot", "args": ["1"]},
-            {"directive": "~*linkedinbot", "args": ["1"]},
-            {"directive": "~*embedly", "args": ["1"]},
-            {"directive": "~*quora\\ link\\ preview", "args": ["1"]},
-            {"directive": "~*showyoubot", "args": ["1"]},
-            {"directive": "~*outbrain", "args": ["1"]},
-            {"directive": "~*pinterest\\/0\\.", "args": ["1"]},
-            {"directive": "~*developers.google.com\\/\\+\\/web\\/snippet", "args": ["1"]},
-            {"directive": "~*slackbot", "args": ["1"]},
-            {"directive": "~*vkshare", "args": ["1"]},
-            {"directive": "~*w3c_validator", "args": ["1"]},
-            {"directive": "~*redditbot", "args": ["1"]},
-            {"directive": "~*applebot", "args": ["1"]},
-            {"directive": "~*whatsapp", "args": ["1"]},
-            {"directive": "~*flipboard", "args": ["1"]},
-            {"directive": "~*tumblr", "args": ["1"]},
-            {"directive": "~*bitlybot", "args": ["1"]},
-            {"directive": "~*skypeuripreview", "args": ["1"]},
-            {"directive": "~*nuzzel", "args": ["1"]},
-            {"directive": "~*discordbot", "args": ["1"]},
-            {"directive": "~*google\\ page\\ speed", "args": ["1"]},
-            {"directive": "~*qwantify", "args": ["1"]},
-            {"directive": "~*pinterestbot", "args": ["1"]},
-            {"directive": "~*bitrix\\ link\\ preview", "args": ["1"]},
-            {"directive": "~*xing-contenttabreceiver", "args": ["1"]},
-            {"directive": "~*chrome-lighthouse", "args": ["1"]},
-            {"directive": "~*telegrambot", "args": ["1"]},
-            {"directive": "~*google-inspectiontool", "args": ["1"]},
-            {"directive": "~*petalbot", "args": ["1"]}
-        ]
+        ] + bot_entries
     }
 
+STATIC_EXTENSIONS = [
+    "js", "css", "xml", "less", "png", "jpg", "jpeg", "gif", "pdf", "txt", "ico", "rss", "zip", "mp3", "rar",
+    "exe", "wmv", "doc", "avi", "ppt", "mpg", "mpeg", "tif", "wav", "mov", "psd", "ai", "xls", "mp4", "m4a",
+    "swf", "dat", "dmg", "iso", "flv", "m4v", "torrent", "ttf", "woff", "woff2", "svg", "eot",
+]
+
+def build_static_extension_key() -> str:
+    """
+    Returns the $uri map key matching static assets. The key is unanchored, as in every earlier version, so an
+    extension anywhere in the URI (/app.js.map, /data.json) counts and existing integrations keep their $prerender.
+    """
+    return "~*\\.(" + "|".join(STATIC_EXTENSIONS) + ")"
+
+def build_map_directives(compact_ua: bool = False) -> list:
+    """
+    Builds the map chain that sets $prerender: $uri -> $http_x_prerender -> $args -> $http_user_agent.
+    nginx only evaluates the next map when the current one falls through to its default,
+    so static assets never reach the user agent regexes.
+    """
+    map_http_user_agent = build_user_agent_map(compact_ua)
+
     # Build map directive: map $args $prerender_args { ... }
     map_args = {
         "directive": "map",
@@ -125,32 +298,43 @@ def add_map_section(config: list) -> None:
         "args": ["$uri", "$prerender"],
         "block": [
             {"directive": "default", "args": ["$x_prerender"]},
-            {"directive": "~*\\.(js|css|xml|less|png|jpg|jpeg|gif|pdf|txt|ico|rss|zip|mp3|rar|exe|wmv|doc|avi|ppt|mpg|mpeg|tif|wav|mov|psd|ai|xls|mp4|m4a|swf|dat|dmg|iso|flv|m4v|torrent|ttf|woff|woff2|svg|eot)", "args": ["0"]}
+            {"directive": build_static_extension_key(), "args": ["0"]}
         ]
     }
 
+    return [map_http_user_agent, map_args, map_http_x_prerender, map_uri]
+
+def find_map(http_block: Block, variable: str) -> Directive:
+    """
+    Returns the map setting variable in the http block, or None.
+    """
+    for directive in http_block.find_all("map"):
+        if directive.args[1:] == (variable,):
+            return directive
+    return None
+
+def add_map_section(config: Block, compact_ua: bool = False) -> None:
+    """
+    Adds or updates map directives in the http section before the first server block.
+    Maps are matched by the variable they set.
+    """
+    http_block = get_http_section(config).block
+
     # Replace or insert map directives
-    maps_to_insert = [
-        map_http_user_agent,
-        map_args,
-        map_http_x_prerender,
-        map_uri
-    ]
+    maps_to_insert = build_map_directives(compact_ua)
     
     insert_index = 0
 
     for map_directive in maps_to_insert:
-        replaced = False
-        for i, directive in enumerate(http_section.get("block", [])):
-            if directive.get("directive") == "map" and directive.get("args", []) == map_directive["args"]:
-                http_section["block"][i] = map_directive
-                replaced = True
-                # if some of the map not present, insert it after the last map directive
-                insert_index = i
-                break
-        if not replaced:
-            http_section["block"].insert(insert_index, map_directive)
-            insert_index += 1                            
+        new_map = Directive.from_crossplane(map_directive)
+        existing = find_map(http_block, map_directive["args"][1])
+        if existing is not None:
+            existing.replace(new_map)
+            # if some of the map not present, insert it after the last map directive
+            insert_index = http_block.index(new_map) + 1
+        else:
+            http_block.insert(insert_index, new_map)
+            insert_index += 1
 
 """
 location / {
@@ -160,54 +344,344 @@ location / {
     ...
 }
 """
-def rewrite_root_location(server_block: dict):
+def build_root_rewrite() -> dict:
     """
-    Modifies the root location block in the given server block.
+    Builds the if block sending prerendered requests to /prerenderio.
     """
-    location_root_block = get_location_block(server_block, "/")
-
-    # Define the if block directive
-    if_block = {
+    return {
         "directive": "if",
         "args": ["$prerender", "=", "1"],
         "block": [
             {"directive": "rewrite", "args": ["(.*)", "/prerenderio", "last"]}
         ]
     }
-    
+
+def rewrite_root_location(server_block: Directive):
+    """
+    Modifies the root location block in the given server block.
+    """
+    location_root_block = get_location_block(server_block, "/").block
+    if_block = Directive.from_crossplane(build_root_rewrite())
+
     # Check if the if block directive is already present
-    replaced = False
-    for directive in location_root_block.get("block", []):
-        if directive.get("directive") == "if" and directive.get("args", []) == ["$prerender", "=", "1"]:
-            replaced = True
-            directive["block"] = if_block["block"]
-            break
-    
-    if not replaced:
+    existing = location_root_block.find("if", if_block.args)
+    if existing is not None:
+        existing.replace(if_block)
+    else:
         # prepend the if block directive to the location block
-        location_root_block.setdefault("block", []).insert(0, if_block)
+        location_root_block.insert(0, if_block)
 
-def add_location_prerenderio(server_block: dict, prerender_token: str) -> None:
-    if not prerender_token:
-        raise Exception("Prerender token is required to proceed.")
+PRERENDER_HOST = "service.prerender.io"
+PRERENDER_UPSTREAM = "prerender_io"
+DEFAULT_UPSTREAM_KEEPALIVE = 32
+DEFAULT_PROXY_CACHE_PATH = "/var/cache/nginx/prerender"
+PROXY_CACHE_ZONE = "prerender_cache"
+PROXY_CACHE_AVERAGE_PAGE_KB = 64
+# prerendered pages are buffered in PROXY_BUFFER_KB buffers, enough of them for a page this big unless measured
+DEFAULT_PRERENDERED_PAGE_KB = 256
+PROXY_BUFFER_KB = 16
+MIN_PROXY_BUFFERS = 8
+MAX_PROXY_BUFFERS = 256
+PROXY_BUFFER_DIRECTIVES = {
+    "buffer_size": "proxy_buffer_size",
+    "buffers": "proxy_buffers",
+    "busy_buffers_size": "proxy_busy_buffers_size",
+    "max_temp_file_size": "proxy_max_temp_file_size",
+}
 
+def find_http_directive(config: Block, new_directive: dict, match=None) -> Directive:
     """
-    Inserts a new location block for "/prerenderio" into the given server block.
+    Returns the http-level directive that upsert_http_directive would replace with new_directive, or None.
     """
-    # Locate the index of the location "/" block within the server block.
-    location_index = None
-    for idx, directive in enumerate(server_block.get("block", [])):
-        if directive.get("directive") == "location":
-            args = directive.get("args", [])
-            if args and args[0] == "/":
-                location_index = idx
-                break
-            
-    if location_index is None:
-        raise Exception("No location block found for / in the server block")
+    http_section = get_http_section(config)
+    if http_section is None:
+        return None
 
-    # Build the new location block for /prerenderio
-    location_prerenderio = {
+    for directive in http_section.block.find_all(new_directive["directive"]):
+        if (match(directive) if match else directive.args[:1] == tuple(new_directive["args"][:1])):
+            return directive
+
+    return None
+
+def upsert_http_directive(config: Block, new_directive: dict, match=None) -> None:
+    """
+    Replaces the http-level directive with the same name and first argument (or for which match returns True),
+    or inserts it before the first server block.
+    """
+    http_section = get_http_section(config)
+    if http_section is None:
+        raise Exception("No http section found in the nginx configuration")
+
+    existing = find_http_directive(config, new_directive, match)
+    if existing is not None:
+        existing.replace(Directive.from_crossplane(new_directive))
+        return
+
+    first_server = http_section.block.find("server")
+    insert_index = http_section.block.index(first_server) if first_server else len(http_section.block)
+
+    http_section.block.insert(insert_index, Directive.from_crossplane(new_directive))
+
+def build_upstream_directive(keepalive: int = DEFAULT_UPSTREAM_KEEPALIVE) -> dict:
+    """
+    Builds upstream prerender_io { ... } keeping idle TLS connections to Prerender open.
+    The server is re-resolved in the background with the resolver TTL (nginx 1.27.3+ or NGINX Plus).
+    """
+    return {
+        "directive": "upstream",
+        "args": [PRERENDER_UPSTREAM],
+        "block": [
+            {"directive": "zone", "args": [PRERENDER_UPSTREAM, "64k"]},
+            {"directive": "resolver", "args": ["8.8.8.8", "8.8.4.4", "valid=300s"]},
+            {"directive": "server", "args": [f"{PRERENDER_HOST}:443", "resolve"]},
+            {"directive": "keepalive", "args": [str(keepalive)]},
+            {"directive": "keepalive_timeout", "args": ["60s"]}
+        ]
+    }
+
+def add_upstream_section(config: Block, keepalive: int = DEFAULT_UPSTREAM_KEEPALIVE) -> None:
+    """
+    Adds or updates the prerender_io upstream in the http section.
+    """
+    upsert_http_directive(config, build_upstream_directive(keepalive))
+
+def get_cache_sizes(cache_path: str = DEFAULT_PROXY_CACHE_PATH) -> tuple:
+    """
+    Derives (zone_size, max_size) from the free space where the cache will live:
+    up to 10% of free space (100m..10g) and a keys zone big enough for that many average pages.
+    """
+    path = os.path.abspath(cache_path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+
+    free_mb = shutil.disk_usage(path).free // (1024 * 1024)
+    max_size_mb = max(100, min(free_mb // 10, 10 * 1024))
+
+    # one megabyte of keys zone holds about 8000 keys
+    pages = max_size_mb * 1024 // PROXY_CACHE_AVERAGE_PAGE_KB
+    zone_size_mb = max(1, math.ceil(pages / 8000))
+
+    return (f"{zone_size_mb}m", f"{max_size_mb}m")
+
+def build_proxy_cache_path_directive(cache: dict) -> dict:
+    """
+    Builds proxy_cache_path for the prerender_cache zone.
+    """
+    return {
+        "directive": "proxy_cache_path",
+        "args": [
+            cache.get("path", DEFAULT_PROXY_CACHE_PATH),
+            "levels=1:2",
+            f"keys_zone={PROXY_CACHE_ZONE}:{cache['zone_size']}",
+            f"max_size={cache['max_size']}",
+            f"inactive={cache.get('inactive', '24h')}",
+            "use_temp_path=off"
+        ]
+    }
+
+def _is_prerender_cache_path(directive: Directive) -> bool:
+    return any(arg.startswith(f"keys_zone={PROXY_CACHE_ZONE}:") for arg in directive.args)
+
+def resolve_cache_sizes(config: Block, cache: dict) -> dict:
+    """
+    Returns cache with zone_size and max_size filled in when they were not given: from the existing
+    proxy_cache_path of the zone, so re-runs don't change them as free disk space varies, otherwise from free disk space.
+    """
+    cache = dict(cache)
+    if cache.get("zone_size") and cache.get("max_size"):
+        return cache
+
+    existing = find_http_directive(config, {"directive": "proxy_cache_path", "args": []}, match=_is_prerender_cache_path)
+    sizes = {}
+    if existing:
+        for arg in existing.args:
+            if arg.startswith(f"keys_zone={PROXY_CACHE_ZONE}:"):
+                sizes["zone_size"] = arg.split(":", 1)[1]
+            elif arg.startswith("max_size="):
+                sizes["max_size"] = arg.split("=", 1)[1]
+
+    if not sizes.get("zone_size") or not sizes.get("max_size"):
+        sizes["zone_size"], sizes["max_size"] = get_cache_sizes(cache.get("path", DEFAULT_PROXY_CACHE_PATH))
+
+    cache["zone_size"] = cache.get("zone_size") or sizes["zone_size"]
+    cache["max_size"] = cache.get("max_size") or sizes["max_size"]
+    return cache
+
+def add_proxy_cache_path(config: Block, cache: dict) -> None:
+    """
+    Adds or updates proxy_cache_path in the http section. It is matched by zone name, so a changed path or size replaces it.
+    """
+    upsert_http_directive(config, build_proxy_cache_path_directive(cache), match=_is_prerender_cache_path)
+
+def build_proxy_cache_directives(cache: dict) -> list:
+    """
+    Directives caching prerendered pages locally. Upstream Cache-Control is already hidden from clients,
+    so it is ignored for caching too and proxy_cache_valid decides how long pages are kept.
+    """
+    valid = cache.get("valid", "10m")
+    return [
+        {"directive": "proxy_cache", "args": [PROXY_CACHE_ZONE]},
+        {"directive": "proxy_cache_key", "args": ["$scheme://$host$request_uri"]},
+        {"directive": "proxy_cache_valid", "args": ["200", "301", "302", valid]},
+        {"directive": "proxy_cache_valid", "args": ["404", "1m"]},
+        {"directive": "proxy_cache_lock", "args": ["on"]},
+        {"directive": "proxy_cache_use_stale", "args": ["error", "timeout", "updating", "http_500", "http_502", "http_503", "http_504"]},
+        {"directive": "proxy_cache_background_update", "args": ["on"]},
+        {"directive": "proxy_ignore_headers", "args": ["Cache-Control", "Expires"]},
+        {"directive": "add_header", "args": ["X-Prerender-Cache", "$upstream_cache_status"]},
+    ]
+
+def get_proxy_buffer_sizes(page_size_kb: int = DEFAULT_PRERENDERED_PAGE_KB) -> dict:
+    """
+    Derives proxy buffer sizes holding a prerendered page of page_size_kb in memory, between
+    MIN_PROXY_BUFFERS and MAX_PROXY_BUFFERS buffers. Larger pages are passed to the client
+    synchronously instead of being written to a temp file.
+    """
+    count = max(MIN_PROXY_BUFFERS, min(math.ceil(page_size_kb / PROXY_BUFFER_KB), MAX_PROXY_BUFFERS))
+    return {
+        "buffer_size": f"{PROXY_BUFFER_KB}k",
+        "buffers": f"{count} {PROXY_BUFFER_KB}k",
+        "busy_buffers_size": f"{PROXY_BUFFER_KB * 2}k",
+        "max_temp_file_size": "0",
+    }
+
+def parse_nginx_size(size: str) -> int:
+    """
+    Parses an nginx size like 16k, 1m or 4096 into bytes.
+    """
+    units = {'k': 1024, 'm': 1024 * 1024, 'g': 1024 * 1024 * 1024}
+    size = size.strip().lower()
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+def _format_nginx_size(size: int) -> str:
+    return f"{size // 1024}k" if size % 1024 == 0 else str(size)
+
+def _parse_proxy_buffers(buffer_sizes: dict) -> tuple:
+    """
+    Returns (buffer count, size of one buffer, largest of proxy_buffer_size and one buffer) in bytes.
+    """
+    try:
+        count, size = buffer_sizes["buffers"].split()
+        count, size = int(count), parse_nginx_size(size)
+        return (count, size, max(parse_nginx_size(buffer_sizes["buffer_size"]), size))
+    except ValueError:
+        raise Exception(f"Invalid proxy buffer sizes: proxy_buffer_size {buffer_sizes['buffer_size']!r}, proxy_buffers {buffer_sizes['buffers']!r} "
+                        f"(expected e.g. 16k and \"32 16k\")")
+
+def get_busy_buffers_size(buffer_sizes: dict) -> str:
+    """
+    Returns a proxy_busy_buffers_size nginx accepts with the buffer_size and buffers of buffer_sizes:
+    two of the largest buffer, or one when the buffers leave no room for two.
+    """
+    count, size, largest = _parse_proxy_buffers(buffer_sizes)
+    return _format_nginx_size(largest * 2 if largest * 2 < (count - 1) * size else largest)
+
+def check_buffer_sizes(buffer_sizes: dict) -> None:
+    """
+    Raises the error nginx -t would give for inconsistent sizes of PROXY_BUFFER_DIRECTIVES, before they are saved.
+    """
+    count, size, largest = _parse_proxy_buffers(buffer_sizes)
+    try:
+        busy_size = parse_nginx_size(buffer_sizes["busy_buffers_size"])
+        max_temp_file_size = parse_nginx_size(buffer_sizes["max_temp_file_size"])
+    except ValueError:
+        raise Exception(f"Invalid proxy buffer sizes: proxy_busy_buffers_size {buffer_sizes['busy_buffers_size']!r}, "
+                        f"proxy_max_temp_file_size {buffer_sizes['max_temp_file_size']!r}")
+
+    if count < 2:
+        raise Exception(f"There must be at least 2 proxy_buffers, got \"{buffer_sizes['buffers']}\"")
+    if busy_size < largest:
+        raise Exception(f"proxy_busy_buffers_size ({buffer_sizes['busy_buffers_size']}) must be equal to or greater than the maximum of "
+                        f"the value of proxy_buffer_size ({buffer_sizes['buffer_size']}) and one of the proxy_buffers ({buffer_sizes['buffers']})")
+    if busy_size >= (count - 1) * size:
+        raise Exception(f"proxy_busy_buffers_size ({buffer_sizes['busy_buffers_size']}) must be less than the size of all "
+                        f"proxy_buffers ({buffer_sizes['buffers']}) minus one buffer")
+    if max_temp_file_size and max_temp_file_size < largest:
+        raise Exception(f"proxy_max_temp_file_size ({buffer_sizes['max_temp_file_size']}) must be 0 or equal to or greater than the maximum of "
+                        f"the value of proxy_buffer_size ({buffer_sizes['buffer_size']}) and one of the proxy_buffers ({buffer_sizes['buffers']})")
+
+def resolve_buffer_sizes(server_block: Directive, buffers: dict) -> dict:
+    """
+    Returns the four sizes of PROXY_BUFFER_DIRECTIVES. Those not given in buffers are derived from its
+    page_size_kb (a measured page size) if set, else kept from the existing /prerenderio location,
+    so re-runs don't change them, else derived from DEFAULT_PRERENDERED_PAGE_KB.
+    A busy size that wasn't given is derived again when nginx would reject it with the other sizes,
+    inconsistent given sizes raise.
+    """
+    derived = get_proxy_buffer_sizes(buffers.get("page_size_kb") or DEFAULT_PRERENDERED_PAGE_KB)
+    existing = {}
+    location = server_block.block.find("location", ("/prerenderio",)) if server_block.block is not None else None
+    if location is not None and location.block is not None and not buffers.get("page_size_kb"):
+        for key, name in PROXY_BUFFER_DIRECTIVES.items():
+            directive = location.block.find(name)
+            if directive is not None:
+                existing[key] = " ".join(directive.args)
+
+    sizes = {key: buffers.get(key) or existing.get(key) or derived[key] for key in PROXY_BUFFER_DIRECTIVES}
+
+    if not buffers.get("busy_buffers_size"):
+        try:
+            check_buffer_sizes(sizes)
+        except Exception:
+            # kept or derived for other buffers, e.g. before --proxy-buffers "4 64k"
+            sizes["busy_buffers_size"] = get_busy_buffers_size(sizes)
+    check_buffer_sizes(sizes)
+
+    return sizes
+
+def build_proxy_buffer_directives(buffers: dict) -> list:
+    return [{"directive": name, "args": buffers[key].split()} for key, name in PROXY_BUFFER_DIRECTIVES.items()]
+
+def build_gzip_directives() -> list:
+    """
+    Compresses prerendered pages for crawlers. text/html is always compressed when gzip is on,
+    listing it in gzip_types would only make nginx warn about a duplicate MIME type.
+    """
+    return [
+        {"directive": "gzip", "args": ["on"]},
+        {"directive": "gzip_proxied", "args": ["any"]},
+        {"directive": "gzip_vary", "args": ["on"]},
+        {"directive": "gzip_comp_level", "args": ["5"]},
+        {"directive": "gzip_min_length", "args": ["1024"]},
+    ]
+
+def build_location_prerenderio(prerender_token: str, upstream: bool = False, cache: dict = None, buffers: dict = None,
+                               gzip: bool = False, accept_encoding: bool = False) -> dict:
+    """
+    Builds location /prerenderio { ... }.
+    With upstream, requests go through the keepalive prerender_io upstream instead of resolving
+    service.prerender.io and opening a new TLS connection per request.
+    With cache, prerendered pages are cached in the prerender_cache zone.
+    With buffers (resolved sizes), pages are buffered in memory instead of temp files.
+    With gzip, pages are compressed for clients accepting it. With accept_encoding, the client's
+    Accept-Encoding is passed to Prerender, which then sends compressed pages to nginx too.
+    """
+    if upstream:
+        proxy_directives = [
+            {"directive": "proxy_http_version", "args": ["1.1"]},
+            {"directive": "proxy_set_header", "args": ["Connection", ""]},
+            {"directive": "proxy_set_header", "args": ["Host", PRERENDER_HOST]},
+            {"directive": "proxy_ssl_server_name", "args": ["on"]},
+            {"directive": "proxy_ssl_name", "args": [PRERENDER_HOST]},
+            {"directive": "proxy_ssl_session_reuse", "args": ["on"]},
+            {"directive": "proxy_pass", "args": [f"https://{PRERENDER_UPSTREAM}"]},
+        ]
+    else:
+        proxy_directives = [
+            {"directive": "resolver", "args": ["8.8.8.8", "8.8.4.4"]},
+            {"directive": "set", "args": ["$prerender_host", PRERENDER_HOST]},
+            {"directive": "proxy_pass", "args": ["https://$prerender_host"]},
+        ]
+
+    tuning_directives = (build_proxy_cache_directives(cache) if cache else []) \
+        + (build_proxy_buffer_directives(buffers) if buffers else []) \
+        + (build_gzip_directives() if gzip else [])
+    if accept_encoding:
+        tuning_directives.append({"directive": "proxy_set_header", "args": ["Accept-Encoding", "$http_accept_encoding"]})
+
+    return {
         "directive": "location",
         "args": ["/prerenderio"],
         "block": [
@@ -222,21 +696,153 @@ def add_location_prerenderio(server_block: dict, prerender_token: str) -> None:
             {"directive": "proxy_set_header", "args": ["X-Prerender-Int-Type", "nginx_auto_installer"]},
             {"directive": "proxy_hide_header", "args": ["Cache-Control"]},
             {"directive": "add_header", "args": ["Cache-Control", "private,max-age=600,must-revalidate"]},
-            {"directive": "resolver", "args": ["8.8.8.8", "8.8.4.4"]},
-            {"directive": "set", "args": ["$prerender_host", "service.prerender.io"]},
-            {"directive": "proxy_pass", "args": ["https://$prerender_host"]},
+        ] + tuning_directives + proxy_directives + [
             {"directive": "rewrite", "args": [".*", "/$scheme://$host$request_uri?", "break"]}
         ]
     }
+
+def add_location_prerenderio(server_block: Directive, prerender_token: str, upstream: bool = False, cache: dict = None,
+                             buffers: dict = None, gzip: bool = False, accept_encoding: bool = False) -> None:
+    if not prerender_token:
+        raise Exception("Prerender token is required to proceed.")
+
+    """
+    Inserts a new location block for "/prerenderio" into the given server block.
+    """
+    location_root = get_location_block(server_block, "/")
+
+    # Build the new location block for /prerenderio
+    location_prerenderio = Directive.from_crossplane(build_location_prerenderio(prerender_token, upstream, cache, buffers, gzip, accept_encoding))
     
     # Check if the location /prerenderio block is already present
-    replaced = False
-    for directive in server_block.get("block", []):
-        if directive.get("directive") == "location" and directive.get("args", []) == ["/prerenderio"]:
-            replaced = True
-            directive["block"] = location_prerenderio["block"]
-            break
+    existing = server_block.block.find("location", location_prerenderio.args)
+    if existing is not None:
+        existing.replace(location_prerenderio)
+    else:
+        server_block.block.insert(server_block.block.index(location_root) + 1, location_prerenderio)
+
+def apply_integration(main_config: Block, server_blocks: list, prerender_token: str, options: dict = None) -> None:
+    """
+    Applies all Prerender changes: maps in the http section, the rewrite in location /
+    and the /prerenderio location in each of the server blocks (get_server_blocks items).
+    Options: compact_ua (bool) emits the user agent map as a single regex,
+    upstream (bool) proxies through a keepalive upstream,
+    cache (dict with path and optional zone_size, max_size) caches prerendered pages locally,
+    buffers (dict with optional sizes of PROXY_BUFFER_DIRECTIVES and page_size_kb) tunes proxy buffering,
+    gzip (bool) compresses prerendered pages and accept_encoding (bool) passes Accept-Encoding to Prerender.
+    """
+    options = options or {}
+    if options.get("cache"):
+        options = dict(options, cache=resolve_cache_sizes(main_config, options["cache"]))
+
+    add_map_section(main_config, compact_ua=options.get("compact_ua", False))
+    if options.get("upstream"):
+        add_upstream_section(main_config)
+    if options.get("cache"):
+        add_proxy_cache_path(main_config, options["cache"])
+    for server_block in server_blocks:
+        directive = server_block['block'][0]
+        buffers = resolve_buffer_sizes(directive, options["buffers"]) if options.get("buffers") else None
+        rewrite_root_location(directive)
+        add_location_prerenderio(directive, prerender_token, upstream=options.get("upstream", False), cache=options.get("cache"),
+                                 buffers=buffers, gzip=options.get("gzip", False), accept_encoding=options.get("accept_encoding", False))
+
+# differences listed per block, a replaced user agent map would otherwise print every entry
+MAX_DRIFT_ITEMS = 5
+
+def _normalize_directives(directives: list) -> list:
+    """
+    Strips parser details (line numbers, comments) so built and parsed directives compare equal.
+    """
+    normalized = []
+    for directive in directives:
+        if directive.get("directive") == "#":
+            continue
+        item = {"directive": directive["directive"], "args": list(directive.get("args", []))}
+        if "block" in directive:
+            item["block"] = _normalize_directives(directive["block"])
+        normalized.append(item)
+    return normalized
+
+def fingerprint_directives(directives: list) -> str:
+    return hashlib.sha256(json.dumps(_normalize_directives(directives), sort_keys=True).encode("utf-8")).hexdigest()
+
+def _format_directive(directive: dict) -> str:
+    args = [arg if arg else '""' for arg in directive.get("args", [])]
+    if directive["directive"] == "proxy_set_header" and args[:1] == ["X-Prerender-Token"]:
+        # tokens end up in logs and reports, only their end is shown
+        args = args[:1] + [f"...{arg[-4:]}" for arg in args[1:]]
+    text = " ".join([directive["directive"]] + args)
+    return text + (" { ... }" if "block" in directive else "")
+
+def _compare_directive(name: str, expected: dict, actual: Directive) -> list:
+    """
+    Returns drift messages for a single directive: missing, or which of its block entries differ.
+    """
+    if actual is None:
+        return [f"{name}: missing"]
+    actual = actual.to_crossplane()
+
+    if fingerprint_directives([expected]) == fingerprint_directives([actual]):
+        return []
+
+    if expected.get("args") != actual.get("args"):
+        return [f"{name}: is `{_format_directive(actual)}`, expected `{_format_directive(expected)}`"]
+
+    expected_block = _normalize_directives(expected.get("block", []))
+    actual_block = _normalize_directives(actual.get("block", []))
+    drift = []
+    for kind, directives in (("missing", [directive for directive in expected_block if directive not in actual_block]),
+                             ("unexpected", [directive for directive in actual_block if directive not in expected_block])):
+        drift += [f"{name}: {kind} `{_format_directive(directive)}`" for directive in directives[:MAX_DRIFT_ITEMS]]
+        if len(directives) > MAX_DRIFT_ITEMS:
+            drift.append(f"{name}: {len(directives) - MAX_DRIFT_ITEMS} more {kind} directives")
+
+    return drift or [f"{name}: directives are in a different order"]
+
+def get_integration_drift(main_config: Block, server_blocks: list, prerender_token: str, options: dict = None) -> list:
+    """
+    Compares the parsed config with what apply_integration would produce for the server blocks, using the same options.
+    Returns a list of human readable differences, empty when the config is already integrated.
+    """
+    options = options or {}
+    drift = []
+
+    http_section = get_http_section(main_config)
+    http_block = http_section.block if http_section else Block()
+
+    for map_directive in build_map_directives(options.get("compact_ua", False)):
+        drift += _compare_directive(f"map {map_directive['args'][1]}", map_directive, find_map(http_block, map_directive["args"][1]))
+
+    if options.get("upstream"):
+        upstream = build_upstream_directive()
+        drift += _compare_directive(f"upstream {PRERENDER_UPSTREAM}", upstream, find_http_directive(main_config, upstream))
+
+    cache = options.get("cache")
+    if cache:
+        cache_path = build_proxy_cache_path_directive(resolve_cache_sizes(main_config, cache))
+        drift += _compare_directive(f"proxy_cache_path {PROXY_CACHE_ZONE}", cache_path,
+                                    find_http_directive(main_config, cache_path, match=_is_prerender_cache_path))
+
+    cache = resolve_cache_sizes(main_config, cache) if cache else None
+    root_rewrite = build_root_rewrite()
+
+    for server_block in server_blocks:
+        # with several blocks, each difference says which one it is in
+        prefix = f"{server_block['name']}: " if len(server_blocks) > 1 else ""
+        directive = server_block['block'][0]
+        buffers = resolve_buffer_sizes(directive, options["buffers"]) if options.get("buffers") else None
+        expected_location = build_location_prerenderio(prerender_token, options.get("upstream", False), cache, buffers,
+                                                       options.get("gzip", False), options.get("accept_encoding", False))
+
+        try:
+            location_root = get_location_block(directive, "/")
+            drift += _compare_directive(f"{prefix}location / if ($prerender = 1)", root_rewrite,
+                                        location_root.block.find("if", root_rewrite["args"]))
+        except Exception as e:
+            drift.append(f"{prefix}{e}")
 
-    if not replaced:
-        server_block.setdefault("block", []).insert(location_index + 1, location_prerenderio)
+        drift += _compare_directive(f"{prefix}location /prerenderio", expected_location,
+                                    directive.block.find("location", expected_location["args"]))
 
+    return drift
@@ -0,0 +1,152 @@
+import math
+import time
+import logging
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+from defaults import DEFAULT_CONCURRENCY, DEFAULT_TIMEOUT
+from site_url import BOT_USER_AGENT, create_session
+from verification import get_sample_urls
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROBE_REQUESTS = 100
+DEFAULT_PROBE_DYNAMIC_URLS = 5
+
+PROBE_USER_AGENTS = {
+    "bot": [
+        BOT_USER_AGENT,
+        "Mozilla/5.0 (compatible; bingbot/2.0; +http://www.bing.com/bingbot.htm)",
+        "facebookexternalhit/1.1 (+http://www.facebook.com/externalhit_uatext.php)",
+        "Twitterbot/1.0",
+    ],
+    "browser": [
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+        "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 Safari/605.1.15",
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:121.0) Gecko/20100101 Firefox/121.0",
+    ],
+}
+
+# served by nginx directly for every user agent, whatever the integration does
+PROBE_STATIC_PATHS = ['/robots.txt', '/favicon.ico']
+
+PROBE_CLASSES = [("bot", "dynamic"), ("bot", "static"), ("browser", "dynamic"), ("browser", "static")]
+
+def percentile(values: list, fraction: float) -> float:
+    """
+    Nearest-rank percentile of values, None if there are none.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(1, math.ceil(len(values) * fraction))
+    return values[rank - 1]
+
+def build_probe_requests(site_url: str, session: requests.Session, count: int = DEFAULT_PROBE_REQUESTS,
+                         urls_file: str = None, timeout: float = DEFAULT_TIMEOUT) -> list:
+    """
+    Returns count (class, url, user_agent) tuples spread evenly over bot/browser user agents and dynamic/static paths.
+    Dynamic URLs are the site root and the first sitemap URLs (or urls_file), static ones are PROBE_STATIC_PATHS.
+    """
+    paths = {
+        "dynamic": list(get_sample_urls(site_url, session, DEFAULT_PROBE_DYNAMIC_URLS, urls_file, timeout)),
+        "static": [urljoin(site_url, path) for path in PROBE_STATIC_PATHS],
+    }
+
+    probe_requests = []
+    for i in range(count):
+        agent_class, path_class = PROBE_CLASSES[i % len(PROBE_CLASSES)]
+        turn = i // len(PROBE_CLASSES)
+        user_agents = PROBE_USER_AGENTS[agent_class]
+        urls = paths[path_class]
+        probe_requests.append(((agent_class, path_class), urls[turn % len(urls)], user_agents[turn % len(user_agents)]))
+
+    return probe_requests
+
+def probe_url(session: requests.Session, url: str, user_agent: str, timeout: float = DEFAULT_TIMEOUT) -> dict:
+    """
+    Fetches the whole response and returns its status, x-prerender presence and latency.
+    """
+    result = {"url": url, "status": None, "prerendered": False, "elapsed": None, "error": None}
+    started = time.perf_counter()
+
+    try:
+        response = session.get(url, headers={'User-Agent': user_agent}, timeout=timeout)
+        result["status"] = response.status_code
+        result["prerendered"] = 'x-prerender' in response.headers
+        if response.status_code >= 500:
+            result["error"] = f"status {response.status_code}"
+    except requests.exceptions.RequestException as e:
+        result["error"] = str(e)
+
+    result["elapsed"] = time.perf_counter() - started
+
+    return result
+
+def summarize_probe(results: list, elapsed: float) -> dict:
+    """
+    Aggregates (class, result) pairs into latency percentiles, error rate and throughput per class.
+    Throughput is requests per second of the class over the whole probe, as all classes run interleaved.
+    """
+    report = {}
+
+    for agent_class, path_class in PROBE_CLASSES:
+        class_results = [result for request_class, result in results if request_class == (agent_class, path_class)]
+        if not class_results:
+            continue
+
+        latencies = [result["elapsed"] for result in class_results if not result["error"]]
+        errors = len(class_results) - len(latencies)
+
+        report[f"{agent_class}/{path_class}"] = {
+            "requests": len(class_results),
+            "errors": errors,
+            "error_rate": round(errors / len(class_results), 4),
+            "prerendered": sum(1 for result in class_results if result["prerendered"]),
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "throughput": round(len(class_results) / elapsed, 2) if elapsed else None,
+        }
+
+    return report
+
+def probe_site(site_url: str, count: int = DEFAULT_PROBE_REQUESTS, concurrency: int = DEFAULT_CONCURRENCY,
+               timeout: float = DEFAULT_TIMEOUT, urls_file: str = None) -> dict:
+    """
+    Sends count requests with mixed bot/browser user agents to dynamic and static URLs of the site,
+    at most `concurrency` at a time, and returns the per-class summary.
+    Requests are not retried, so slow or failing upstreams show up in the numbers.
+    """
+    session = create_session(pool_size=concurrency, retries=0)
+    probe_requests = build_probe_requests(site_url, session, count, urls_file, timeout)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(
+            lambda probe_request: (probe_request[0], probe_url(session, probe_request[1], probe_request[2], timeout)),
+            probe_requests
+        ))
+    elapsed = time.perf_counter() - started
+
+    for request_class, result in results:
+        if result["error"]:
+            logger.debug("Probe %s %s: %s", '/'.join(request_class), result['url'], result['error'])
+
+    return summarize_probe(results, elapsed)
+
+def _format_ms(value: float) -> str:
+    return f"{value * 1000:.0f}ms" if value is not None else "-"
+
+def log_probe_report(report: dict) -> None:
+    logger.info("Latency probe:")
+    for name, stats in report.items():
+        logger.info(f"  {name}: {stats['requests']} requests, p50 {_format_ms(stats['p50'])}, p95 {_format_ms(stats['p95'])}, "
+                    f"p99 {_format_ms(stats['p99'])}, errors {stats['error_rate']:.1%}, {stats['throughput']} req/s"
+                    + (f", prerendered {stats['prerendered']}" if name.startswith("bot/") else ""))
+
+    bot = report.get("bot/dynamic")
+    browser = report.get("browser/dynamic")
+    if bot and browser and bot["p50"] is not None and browser["p50"] is not None:
+        logger.info(f"  Prerender overhead on dynamic pages: p50 {_format_ms(bot['p50'] - browser['p50'])}, "
+                    f"p95 {_format_ms(bot['p95'] - browser['p95'])}")
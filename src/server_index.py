@@ -0,0 +1,171 @@
+import re
+import logging
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+# listen parameters that are flags rather than key=value options
+LISTEN_FLAGS = ('default_server', 'default', 'ssl', 'http2', 'quic', 'proxy_protocol', 'deferred', 'bind', 'reuseport')
+
+def parse_listen(args: list) -> dict:
+    """
+    Parses listen directive arguments into address, port and flags.
+    """
+    address = args[0] if args else '*:80'
+    host = '*'
+    port = 80
+
+    if address.startswith('unix:'):
+        host = address
+        port = None
+    elif address.startswith('['):
+        # [::]:80 or [::1]
+        host, _, rest = address[1:].partition(']')
+        if rest.startswith(':') and rest[1:].isdigit():
+            port = int(rest[1:])
+    elif address.isdigit():
+        port = int(address)
+    elif ':' in address:
+        host, _, port_str = address.rpartition(':')
+        port = int(port_str) if port_str.isdigit() else 80
+    else:
+        host = address
+
+    flags = set(arg for arg in args[1:] if arg in LISTEN_FLAGS)
+
+    return {
+        'host': host,
+        'port': port,
+        'ssl': 'ssl' in flags,
+        'default_server': 'default_server' in flags or 'default' in flags,
+        'flags': sorted(flags),
+    }
+
+def compile_server_name_regex(name: str):
+    """
+    Compiles a ~regex server_name. PCRE named groups (?<name>...) are converted to Python syntax.
+    """
+    pattern = re.sub(r'\(\?<(?![=!])', '(?P<', name[1:])
+    try:
+        return re.compile(pattern, re.IGNORECASE)
+    except re.error as e:
+        logger.debug("Skipping server_name regex %s: %s", name, e)
+        return None
+
+class ServerIndex:
+    """
+    Index of all server blocks across parsed config files, resolving a host the way nginx does:
+    exact name, longest leading wildcard (*.example.com / .example.com), longest trailing wildcard
+    (www.example.*), first matching regex in config order, then the default_server of the port
+    or the first server listening on it.
+    """
+    def __init__(self, server_blocks: list):
+        """
+        server_blocks is the list returned by prerender.get_server_blocks.
+        """
+        self.server_blocks = server_blocks
+        self.ports = {}
+
+        for server_block in server_blocks:
+            directive = server_block['block'][0]
+            names = []
+            listens = []
+
+            for server_directive in directive.block:
+                if server_directive.name == "server_name":
+                    names.extend(server_directive.args)
+                elif server_directive.name == "listen":
+                    listens.append(parse_listen(server_directive.args))
+
+            if not listens:
+                listens.append(parse_listen([]))
+
+            server_block['server_names'] = names
+            server_block['listens'] = listens
+
+            for port in set(listen['port'] for listen in listens):
+                index = self.ports.setdefault(port, self._new_port_index())
+                index['servers'].append(server_block)
+                if any(listen['port'] == port and listen['default_server'] for listen in listens):
+                    index['default'] = index['default'] or server_block
+                for name in names:
+                    self._add_name(index, name, server_block)
+
+        self.all = self._new_port_index()
+        for server_block in server_blocks:
+            self.all['servers'].append(server_block)
+            for name in server_block['server_names']:
+                self._add_name(self.all, name, server_block)
+
+    def _new_port_index(self) -> dict:
+        return {'exact': {}, 'leading': {}, 'trailing': {}, 'regex': [], 'servers': [], 'default': None}
+
+    def _add_name(self, index: dict, name: str, server_block: dict) -> None:
+        # the first server defining a name wins, as nginx does with "conflicting server name"
+        if name.startswith('~'):
+            regex = compile_server_name_regex(name)
+            if regex:
+                index['regex'].append((regex, server_block))
+            return
+
+        name = name.lower().rstrip('.')
+
+        if name.startswith('*.'):
+            index['leading'].setdefault(name[2:], (False, server_block))
+        elif name.startswith('.'):
+            # .example.com matches example.com itself as well as its subdomains
+            index['leading'].setdefault(name[1:], (True, server_block))
+        elif name.endswith('.*'):
+            index['trailing'].setdefault(name[:-2], server_block)
+        else:
+            index['exact'].setdefault(name, server_block)
+
+    def _lookup(self, index: dict, host: str) -> tuple:
+        server_block = index['exact'].get(host)
+        if server_block:
+            return (server_block, 'exact')
+
+        leading = index['leading'].get(host)
+        if leading and leading[0]:
+            return (leading[1], 'wildcard')
+
+        labels = host.split('.')
+        for i in range(1, len(labels)):
+            leading = index['leading'].get('.'.join(labels[i:]))
+            if leading:
+                return (leading[1], 'wildcard')
+
+        for i in range(len(labels) - 1, 0, -1):
+            server_block = index['trailing'].get('.'.join(labels[:i]))
+            if server_block:
+                return (server_block, 'wildcard')
+
+        for regex, server_block in index['regex']:
+            if regex.search(host):
+                return (server_block, 'regex')
+
+        if index['default']:
+            return (index['default'], 'default_server')
+
+        if index['servers']:
+            return (index['servers'][0], 'first')
+
+        return (None, None)
+
+    def resolve(self, url: str) -> tuple:
+        """
+        Returns (server_block, reason) for the block nginx would serve for the URL.
+        When nothing listens on the URL port (e.g. TLS terminated in front of nginx), all servers are considered.
+        """
+        parts = urlsplit(url if '://' in url else f"http://{url}")
+        host = (parts.hostname or '').lower().rstrip('.')
+        port = parts.port or DEFAULT_PORTS.get(parts.scheme, 80)
+
+        index = self.ports.get(port)
+        if index is None:
+            logger.debug("No server listens on port %s, resolving %s across all servers", port, host)
+            index = self.all
+
+        return self._lookup(index, host)
@@ -1,38 +1,65 @@
 import requests
 import logging
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from defaults import DEFAULT_BACKOFF, DEFAULT_RETRIES, DEFAULT_TIMEOUT
 
 logger = logging.getLogger(__name__)
 
-def check_access(url):
+BOT_USER_AGENT = 'Googlebot/2.1 (+http://www.google.com/bot.html)'
+
+def create_session(pool_size: int = 10, retries: int = DEFAULT_RETRIES, backoff: float = DEFAULT_BACKOFF) -> requests.Session:
+    """
+    Returns a session with a keep-alive connection pool of pool_size connections per host,
+    retrying connection errors and 502/503/504 responses with exponential backoff.
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=("GET", "HEAD"),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+def check_access(url, session=None, timeout=DEFAULT_TIMEOUT):
+    session = session or create_session(pool_size=1)
     try:
-        response = requests.get(url)
-        logger.debug(f"The URL {url} responded with status code {response.status_code}.")
+        response = session.get(url, timeout=timeout)
+        logger.debug("The URL %s responded with status code %s.", url, response.status_code)
     except requests.exceptions.RequestException as e:
         logger.debug(e)
         return False
 
     return True
 
-def check_integration(url):
-    headers = {'User-Agent': 'Googlebot/2.1 (+http://www.google.com/bot.html)'}
+def check_integration(url, session=None, timeout=DEFAULT_TIMEOUT):
+    headers = {'User-Agent': BOT_USER_AGENT}
+    session = session or create_session(pool_size=1)
     try:
-        response = requests.get(url, headers=headers)
-        logger.debug(f"The URL {url} responded with status code {response.status_code}.")
-        
+        response = session.get(url, headers=headers, timeout=timeout)
+        logger.debug("The URL %s responded with status code %s.", url, response.status_code)
+
         result = True
-        
+
         if response.status_code != 200:
-            logger.debug(f"The URL {url} did not respond with status code 200")
+            logger.debug("The URL %s did not respond with status code 200", url)
             result = False
-        
+
         if 'x-prerender' in response.headers:
-            logger.debug(f"The URL {url} contains the 'x-prerender' header.")            
+            logger.debug("The URL %s contains the 'x-prerender' header.", url)
         else:
-            logger.debug(f"The URL {url} does not contain the 'x-prerender' header.")
+            logger.debug("The URL %s does not contain the 'x-prerender' header.", url)
             result = False
-        
+
         return result
-        
+
     except requests.exceptions.RequestException as e:
         logger.error(e)
         return False
@@ -0,0 +1,312 @@
+"""
+Content-addressed snapshots of nginx config trees.
+
+Every file is stored once per distinct content under objects/<sha256[:2]>/<sha256> (gzipped with a .gz suffix
+when compression is on) and each snapshot is a small JSON manifest listing paths, hashes and modes.
+Unchanged files are recognized by their stat data without being read again, new content is copied with
+reflink or copy_file_range where the filesystem supports it. Hardlinks are not used, since editing a
+config in place would then change the stored copy as well.
+"""
+
+import os
+import gzip
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import logging
+from contextlib import contextmanager
+from atomic_file import _fsync_dir, file_digest, write_atomic
+from defaults import DEFAULT_KEEP_SNAPSHOTS
+from state_store import get_default_state_dir
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+# linux/fs.h FICLONE, clones the whole file on btrfs, xfs and other reflink capable filesystems
+FICLONE = 0x40049409
+
+def get_default_snapshot_dir() -> str:
+    return os.path.join(get_default_state_dir(), 'snapshots')
+
+def clone_file(source_fd: int, target_fd: int) -> None:
+    """
+    Copies source to target with a reflink, copy_file_range or plain reads and writes, whichever works first.
+    """
+    try:
+        fcntl.ioctl(target_fd, FICLONE, source_fd)
+        return
+    except OSError:
+        pass
+
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while os.copy_file_range(source_fd, target_fd, 1024 * 1024 * 1024):
+                pass
+            return
+        except OSError:
+            # e.g. not supported across these filesystems, start over with the generic copy
+            os.lseek(source_fd, 0, os.SEEK_SET)
+            os.lseek(target_fd, 0, os.SEEK_SET)
+            os.ftruncate(target_fd, 0)
+
+    with os.fdopen(os.dup(source_fd), 'rb') as source, os.fdopen(os.dup(target_fd), 'wb') as target:
+        shutil.copyfileobj(source, target, 1024 * 1024)
+
+def _snapshot_path(file_path: str) -> str:
+    # restore replaces files, so symlinks (sites-enabled -> sites-available) are stored as their targets
+    return os.path.realpath(file_path) if os.path.islink(file_path) else os.path.abspath(file_path)
+
+def _stat_key(stat: os.stat_result) -> list:
+    return [stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns]
+
+class SnapshotStore:
+    def __init__(self, store_dir: str = None, compress: bool = False):
+        self.store_dir = store_dir or get_default_snapshot_dir()
+        self.objects_dir = os.path.join(self.store_dir, 'objects')
+        self.manifests_dir = os.path.join(self.store_dir, 'manifests')
+        self.index_path = os.path.join(self.store_dir, 'index.json')
+        self.compress = compress
+
+        os.makedirs(self.objects_dir, mode=0o700, exist_ok=True)
+        os.makedirs(self.manifests_dir, mode=0o700, exist_ok=True)
+
+        # path -> stat key and hash of the last stored content, so unchanged files are not read again
+        try:
+            with open(self.index_path, 'r') as file:
+                self.index = json.load(file)
+        except (OSError, ValueError):
+            self.index = {}
+
+    @contextmanager
+    def _locked(self, exclusive: bool = False):
+        # snapshots are created under a shared lock, pruning takes it exclusively so it can't drop objects being referenced
+        with open(os.path.join(self.store_dir, 'store.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def _find_object(self, digest: str) -> str:
+        path = self._object_path(digest)
+        for candidate in (path, f"{path}.gz"):
+            if os.path.exists(candidate):
+                return candidate
+        return None
+
+    def _store_copy(self, source, file_path: str) -> str:
+        # copy first and hash the copy, so a file changing meanwhile can't be stored under a wrong hash
+        temp_path = os.path.join(self.objects_dir, f".{os.getpid()}.{os.path.basename(file_path)}.tmp")
+        try:
+            target_fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                clone_file(source.fileno(), target_fd)
+            finally:
+                os.close(target_fd)
+
+            digest = file_digest(temp_path)
+            if self._find_object(digest):
+                os.remove(temp_path)
+            else:
+                object_path = self._object_path(digest)
+                os.makedirs(os.path.dirname(object_path), mode=0o700, exist_ok=True)
+                os.replace(temp_path, object_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        return digest
+
+    def _store_compressed(self, source) -> str:
+        # the content has to pass through user space for gzip anyway, so it is hashed from the same buffer
+        data = source.read()
+        digest = hashlib.sha256(data).hexdigest()
+        if self._find_object(digest):
+            return digest
+
+        object_path = f"{self._object_path(digest)}.gz"
+        os.makedirs(os.path.dirname(object_path), mode=0o700, exist_ok=True)
+        temp_path = f"{object_path}.{os.getpid()}.tmp"
+        try:
+            with gzip.GzipFile(temp_path, 'wb', compresslevel=6, mtime=0) as compressed:
+                compressed.write(data)
+            os.replace(temp_path, object_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        return digest
+
+    def _store_file(self, file_path: str) -> dict:
+        """
+        Adds the file content to the object store if it is not there yet. Returns its manifest entry.
+        """
+        with open(file_path, 'rb') as source:
+            stat = os.fstat(source.fileno())
+            entry = {
+                "path": file_path,
+                "size": stat.st_size,
+                "mode": stat.st_mode & 0o7777,
+                "uid": stat.st_uid,
+                "gid": stat.st_gid,
+            }
+
+            cached = self.index.get(file_path)
+            if cached and cached[:-1] == _stat_key(stat) and self._find_object(cached[-1]):
+                entry["sha256"] = cached[-1]
+                return entry
+
+            if self.compress:
+                digest = self._store_compressed(source)
+            else:
+                digest = self._store_copy(source, file_path)
+
+        self.index[file_path] = _stat_key(stat) + [digest]
+        entry["sha256"] = digest
+        return entry
+
+    def create(self, file_paths: list, main_config: str = None) -> dict:
+        """
+        Snapshots the files and writes a manifest. Returns the manifest, its "id" identifies the snapshot.
+        Paths that don't exist yet (e.g. an output file) are listed as "absent", restore removes them.
+        """
+        started = time.perf_counter()
+        file_paths = list(dict.fromkeys(_snapshot_path(file_path) for file_path in file_paths))
+
+        with self._locked():
+            manifest = {
+                "version": SNAPSHOT_VERSION,
+                "id": f"{time.strftime('%Y%m%dT%H%M%S')}-{os.urandom(3).hex()}",
+                "created": time.time(),
+                "main_config": os.path.abspath(main_config) if main_config else None,
+                "files": [self._store_file(file_path) for file_path in file_paths if os.path.exists(file_path)],
+                "absent": [file_path for file_path in file_paths if not os.path.exists(file_path)],
+            }
+            write_atomic(os.path.join(self.manifests_dir, f"{manifest['id']}.json"), json.dumps(manifest).encode('utf-8'))
+
+        # the index is only an optimization, a concurrent run overwriting it costs a re-read next time
+        write_atomic(self.index_path, json.dumps(self.index).encode('utf-8'))
+
+        logger.debug("Snapshot %s of %d files created in %.3fs", manifest['id'], len(file_paths), time.perf_counter() - started)
+        return manifest
+
+    def get(self, snapshot_id: str) -> dict:
+        try:
+            with open(os.path.join(self.manifests_dir, f"{os.path.basename(snapshot_id)}.json"), 'r') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            raise Exception(f"Snapshot {snapshot_id} not found in {self.store_dir}")
+
+    def list(self) -> list:
+        """
+        Returns all manifests, oldest first.
+        """
+        manifests = []
+        for name in os.listdir(self.manifests_dir):
+            if name.endswith('.json'):
+                try:
+                    manifests.append(self.get(name[:-len('.json')]))
+                except (OSError, ValueError) as e:
+                    logger.debug("Skipping unreadable snapshot manifest %s: %s", name, e)
+        return sorted(manifests, key=lambda manifest: manifest["created"])
+
+    def _stage(self, entry: dict) -> str:
+        """
+        Writes the stored content of entry to a temp file next to its path and returns the temp path.
+        """
+        object_path = self._find_object(entry["sha256"])
+        if not object_path:
+            raise Exception(f"Snapshot object {entry['sha256']} of {entry['path']} is missing")
+
+        temp_path = os.path.join(os.path.dirname(entry["path"]), f".{os.path.basename(entry['path'])}.restore.tmp")
+        target_fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            if object_path.endswith('.gz'):
+                with gzip.open(object_path, 'rb') as compressed, os.fdopen(os.dup(target_fd), 'wb') as target:
+                    shutil.copyfileobj(compressed, target, 1024 * 1024)
+            else:
+                with open(object_path, 'rb') as source:
+                    clone_file(source.fileno(), target_fd)
+            os.fsync(target_fd)
+        finally:
+            os.close(target_fd)
+
+        os.chmod(temp_path, entry["mode"])
+        try:
+            os.chown(temp_path, entry["uid"], entry["gid"])
+        except OSError as e:
+            logger.debug("Failed to restore ownership of %s: %s", entry['path'], e)
+
+        return temp_path
+
+    def restore(self, snapshot_id: str, paths: list = None) -> list:
+        """
+        Puts the files of the snapshot back, only those in paths if given, and removes the ones created since.
+        All contents are staged next to their targets first and then renamed into place, so each file is
+        replaced atomically and a failed staging leaves the tree untouched.
+        Returns the paths that changed.
+        """
+        manifest = self.get(snapshot_id)
+        selected = set(_snapshot_path(path) for path in paths) if paths is not None else None
+        entries = [entry for entry in manifest["files"]
+                   if (selected is None or entry["path"] in selected) and file_digest(entry["path"]) != entry["sha256"]]
+        created = [path for path in manifest.get("absent", [])
+                   if (selected is None or path in selected) and os.path.lexists(path)]
+        staged = []
+
+        try:
+            for entry in entries:
+                staged.append((self._stage(entry), entry["path"]))
+        except BaseException:
+            for temp_path, _ in staged:
+                os.remove(temp_path)
+            raise
+
+        for temp_path, file_path in staged:
+            os.replace(temp_path, file_path)
+        for file_path in created:
+            os.remove(file_path)
+        for dir_path in set(os.path.dirname(file_path) for file_path in [file_path for _, file_path in staged] + created):
+            _fsync_dir(dir_path)
+
+        for _, file_path in staged:
+            logger.info(f"Restored {file_path} from snapshot {snapshot_id}")
+        for file_path in created:
+            logger.info(f"Removed {file_path}, it did not exist in snapshot {snapshot_id}")
+
+        return [file_path for _, file_path in staged] + created
+
+    def prune(self, keep: int = DEFAULT_KEEP_SNAPSHOTS, protect: list = None) -> None:
+        """
+        Removes all but the newest keep snapshots (and those in protect) and the objects only they used.
+        """
+        with self._locked(exclusive=True):
+            self._prune(keep, set(protect or []))
+
+    def _prune(self, keep: int, protect: set) -> None:
+        manifests = self.list()
+        removed = [manifest for manifest in manifests[:max(0, len(manifests) - keep)] if manifest["id"] not in protect]
+        if not removed:
+            return
+
+        for manifest in removed:
+            os.remove(os.path.join(self.manifests_dir, f"{manifest['id']}.json"))
+
+        removed_ids = set(manifest["id"] for manifest in removed)
+        used = set(entry["sha256"] for manifest in manifests if manifest["id"] not in removed_ids for entry in manifest["files"])
+        for manifest in removed:
+            for entry in manifest["files"]:
+                if entry["sha256"] not in used:
+                    object_path = self._find_object(entry["sha256"])
+                    if object_path:
+                        os.remove(object_path)
+                    used.add(entry["sha256"])
+
+        logger.debug("Pruned %d snapshots", len(removed))
@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import fcntl
+import logging
+from contextlib import contextmanager
+from atomic_file import write_atomic
+
+logger = logging.getLogger(__name__)
+
+STATE_VERSION = 1
+STATE_FILE = 'state.json'
+LOCK_FILE = 'state.lock'
+# the state holds Prerender tokens
+STATE_FILE_MODE = 0o600
+
+# dot-files the previous versions kept in the working directory, one value each
+LEGACY_STATE_FILES = {
+    'site_url': './.prerender_site_url',
+    'token': './.prerender_token',
+    'main_config': './.prerender_nginx_conf',
+    'server_config': './.prerender_server_conf',
+}
+
+def get_default_state_dir() -> str:
+    state_home = os.environ.get('XDG_STATE_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'state')
+    return os.path.join(state_home, 'prerender-nginx')
+
+def _normalize_path(file_path: str) -> str:
+    return os.path.abspath(file_path) if file_path else file_path
+
+class StateStore:
+    """
+    Integrations done on this host, one record per (main config, site URL) with the server config
+    and the token used. The state is read once when the store is created. Updates take an exclusive
+    lock, re-read the file so parallel runs don't lose each other's records, and replace it atomically.
+    """
+    def __init__(self, state_dir: str = None, migrate: bool = True):
+        self.state_dir = state_dir or get_default_state_dir()
+        self.state_path = os.path.join(self.state_dir, STATE_FILE)
+        self.lock_path = os.path.join(self.state_dir, LOCK_FILE)
+
+        os.makedirs(self.state_dir, mode=0o700, exist_ok=True)
+        self.state = self._read()
+
+        if migrate:
+            self.migrate_legacy_files()
+
+    def _read(self) -> dict:
+        try:
+            with open(self.state_path, 'r') as file:
+                state = json.load(file)
+        except FileNotFoundError:
+            return {"version": STATE_VERSION, "integrations": []}
+        except ValueError as e:
+            raise Exception(f"State file {self.state_path} is corrupted: {e}")
+
+        if state.get("version") != STATE_VERSION:
+            raise Exception(f"State file {self.state_path} has unsupported version {state.get('version')}")
+
+        return state
+
+    @contextmanager
+    def _locked(self):
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _find(self, integrations: list, main_config: str, site_url: str) -> dict:
+        for integration in integrations:
+            if integration.get("main_config") == main_config and integration.get("site_url") == site_url:
+                return integration
+        return None
+
+    def record_many(self, records: list) -> None:
+        """
+        Adds or updates integrations in one locked write. Each record has main_config, site_url
+        and any other fields to store (server_config, token); None values don't overwrite stored ones.
+        """
+        with self._locked():
+            state = self._read()
+
+            for record in records:
+                main_config = _normalize_path(record.get("main_config"))
+                site_url = record.get("site_url")
+                integration = self._find(state["integrations"], main_config, site_url)
+                if integration is None:
+                    integration = {"main_config": main_config, "site_url": site_url}
+                    state["integrations"].append(integration)
+
+                for key, value in record.items():
+                    if value is not None and key not in ("main_config", "site_url"):
+                        if key in ("server_config", "output"):
+                            value = _normalize_path(value)
+                        elif key == "server_configs":
+                            value = [_normalize_path(path) for path in value]
+                        integration[key] = value
+                integration["updated"] = time.time()
+
+            write_atomic(self.state_path, json.dumps(state, indent=2).encode('utf-8'), mode=STATE_FILE_MODE)
+            self.state = state
+
+    def record(self, main_config: str, site_url: str, **fields) -> None:
+        self.record_many([dict(fields, main_config=main_config, site_url=site_url)])
+
+    def get(self, main_config: str, site_url: str) -> dict:
+        return dict(self._find(self.state["integrations"], _normalize_path(main_config), site_url) or {})
+
+    def last(self, main_config: str = None) -> dict:
+        """
+        Returns the most recently updated integration, of main_config if given, or an empty dict.
+        """
+        integrations = [
+            integration for integration in self.state["integrations"]
+            if main_config is None or integration.get("main_config") == _normalize_path(main_config)
+        ]
+        if not integrations:
+            return {}
+        return dict(max(integrations, key=lambda integration: integration.get("updated", 0)))
+
+    def migrate_legacy_files(self) -> None:
+        """
+        Moves the state of the working directory's dot-files into the store and removes them.
+        """
+        legacy = {}
+        for key, file_path in LEGACY_STATE_FILES.items():
+            try:
+                with open(file_path, 'r') as file:
+                    legacy[key] = file.read().strip() or None
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                logger.debug("Failed to read legacy state file %s: %s", file_path, e)
+
+        if not legacy:
+            return
+
+        self.record(legacy.pop("main_config", None), legacy.pop("site_url", None), **legacy)
+
+        for file_path in LEGACY_STATE_FILES.values():
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+
+        logger.info(f"Moved the saved state from {os.getcwd()} to {self.state_path}")
@@ -0,0 +1,145 @@
+import time
+import logging
+import requests
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urljoin
+from defaults import DEFAULT_BACKOFF, DEFAULT_CONCURRENCY, DEFAULT_RETRIES, DEFAULT_TIMEOUT
+from site_url import BOT_USER_AGENT, create_session
+
+logger = logging.getLogger(__name__)
+
+MAX_SITEMAP_DEPTH = 3
+
+def _local_name(tag: str) -> str:
+    return tag.rsplit('}', 1)[-1]
+
+def iter_sitemap_urls(sitemap_url: str, session: requests.Session, timeout: float = DEFAULT_TIMEOUT, depth: int = 0):
+    """
+    Streams page URLs from a sitemap (or sitemap index) without loading the whole document.
+    Nested sitemaps of a sitemap index are followed up to MAX_SITEMAP_DEPTH levels.
+    """
+    with session.get(sitemap_url, timeout=timeout, stream=True) as response:
+        if response.status_code != 200:
+            logger.debug("Sitemap %s responded with status code %s.", sitemap_url, response.status_code)
+            return
+
+        # let urllib3 undo gzip/deflate transfer encoding while streaming
+        response.raw.decode_content = True
+
+        root = None
+        for event, element in ET.iterparse(response.raw, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = _local_name(element.tag)
+                continue
+
+            if _local_name(element.tag) == 'loc' and element.text:
+                url = element.text.strip()
+                if root == 'sitemapindex':
+                    if depth < MAX_SITEMAP_DEPTH:
+                        yield from iter_sitemap_urls(url, session, timeout, depth + 1)
+                else:
+                    yield url
+            elif _local_name(element.tag) in ('url', 'sitemap'):
+                # drop processed entries to keep memory flat on large sitemaps
+                element.clear()
+
+def load_url_list(file_path: str) -> list:
+    with open(file_path, 'r') as file:
+        return [line.strip() for line in file if line.strip() and not line.startswith('#')]
+
+def check_url(session: requests.Session, url: str, timeout: float = DEFAULT_TIMEOUT, user_agent: str = BOT_USER_AGENT) -> dict:
+    """
+    Requests the URL as a bot and returns status, x-prerender presence and elapsed time.
+    """
+    result = {"url": url, "status": None, "prerendered": False, "elapsed": None, "error": None}
+    started = time.perf_counter()
+
+    try:
+        with session.get(url, headers={'User-Agent': user_agent}, timeout=timeout, stream=True) as response:
+            result["status"] = response.status_code
+            result["prerendered"] = 'x-prerender' in response.headers
+            # headers are all we need, but a response closed unread closes its connection instead of returning it to the pool
+            for _ in response.iter_content(64 * 1024):
+                pass
+    except requests.exceptions.RequestException as e:
+        result["error"] = str(e)
+
+    result["elapsed"] = round(time.perf_counter() - started, 4)
+    result["ok"] = result["status"] == 200 and result["prerendered"]
+
+    return result
+
+def verify_urls(urls, concurrency: int = DEFAULT_CONCURRENCY, timeout: float = DEFAULT_TIMEOUT,
+                retries: int = DEFAULT_RETRIES, backoff: float = DEFAULT_BACKOFF, session: requests.Session = None) -> list:
+    """
+    Checks URLs from any iterable with at most `concurrency` requests in flight over a pooled session.
+    The iterable is consumed lazily, so a streamed sitemap is never fully materialized.
+    Results are returned in input order.
+    """
+    session = session or create_session(pool_size=concurrency, retries=retries, backoff=backoff)
+    results = []
+    in_flight = {}
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for index, url in enumerate(urls):
+            if len(in_flight) >= concurrency:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results.append((in_flight.pop(future), future.result()))
+
+            in_flight[executor.submit(check_url, session, url, timeout)] = index
+
+        for future in in_flight:
+            results.append((in_flight[future], future.result()))
+
+    return [result for _, result in sorted(results, key=lambda item: item[0])]
+
+def get_sample_urls(site_url: str, session: requests.Session, sample: int = 1, urls_file: str = None, timeout: float = DEFAULT_TIMEOUT):
+    """
+    Yields up to `sample` URLs to verify: from urls_file if given, otherwise the site root followed by the sitemap URLs.
+    """
+    if urls_file:
+        yield from load_url_list(urls_file)[:sample]
+        return
+
+    yield site_url
+    if sample <= 1:
+        return
+
+    count = 1
+    try:
+        for url in iter_sitemap_urls(urljoin(site_url, '/sitemap.xml'), session, timeout):
+            if url.rstrip('/') == site_url.rstrip('/'):
+                continue
+            yield url
+            count += 1
+            if count >= sample:
+                return
+    except (requests.exceptions.RequestException, ET.ParseError) as e:
+        logger.debug("Failed to read sitemap of %s: %s", site_url, e)
+
+def verify_site(site_url: str, sample: int = 1, urls_file: str = None, concurrency: int = DEFAULT_CONCURRENCY,
+                timeout: float = DEFAULT_TIMEOUT, retries: int = DEFAULT_RETRIES) -> tuple:
+    """
+    Verifies Prerender integration on a sample of site URLs.
+    Returns (all_verified, results).
+    """
+    session = create_session(pool_size=concurrency, retries=retries)
+    urls = get_sample_urls(site_url, session, sample, urls_file, timeout)
+    results = verify_urls(urls, concurrency=concurrency, timeout=timeout, session=session)
+
+    for result in results:
+        logger.debug("Verification of %s: status %s, x-prerender %s, %ss%s", result['url'], result['status'],
+                     result['prerendered'], result['elapsed'], f", error {result['error']}" if result['error'] else "")
+
+    return (len(results) > 0 and all(result["ok"] for result in results), results)
+
+def log_verification_report(results: list) -> None:
+    verified = [result for result in results if result["ok"]]
+
+    logger.info(f"Verified {len(verified)} of {len(results)} URLs:")
+    for result in results:
+        status = "ok" if result["ok"] else (result["error"] or f"status {result['status']}, x-prerender {result['prerendered']}")
+        logger.info(f"  {result['url']} - {status} ({result['elapsed']}s)")
@@ -0,0 +1,249 @@
+"""
+Watch mode: keeps a Prerender integration in place while config management rewrites vhost files.
+
+The directories of all files of the include tree are watched with inotify. The process sleeps in
+select() until a file changes, waits for the burst of writes to settle, then re-parses the tree
+through the parse cache (so only changed files are parsed again) and re-applies the integration
+if it drifted. Changes are validated with nginx -t and nginx is reloaded once per burst.
+"""
+
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+from defaults import DEFAULT_DEBOUNCE
+from fleet import integrate_entry
+from nginx import DEFAULT_NGINX_BINARY, reload_nginx, test_config
+from snapshots import SnapshotStore
+
+logger = logging.getLogger(__name__)
+
+# a file rewritten continuously still gets re-checked after this many debounce periods
+MAX_DEBOUNCE_PERIODS = 10
+
+# linux/inotify.h
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# files are replaced by renames or rewritten in place, the directory itself may be removed
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct('iIII')
+
+# temp and backup files of editors, config management and our own atomic writes
+IGNORED_SUFFIXES = ('.tmp', '.swp', '.swx', '~', '.bak', '.prerender.backup')
+
+class InotifyWatcher:
+    """
+    Watches directories with inotify and reports which of their entries changed.
+    """
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise Exception("Watch mode needs inotify, which is only available on Linux")
+
+        self._libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise Exception(f"inotify_init1 failed: {os.strerror(ctypes.get_errno())}")
+
+        # watch descriptor -> directory, and back
+        self.dirs = {}
+        self.descriptors = {}
+
+    def watch(self, dir_paths: set) -> None:
+        """
+        Makes the watched directories exactly dir_paths.
+        """
+        for dir_path in set(self.descriptors) - dir_paths:
+            self._libc.inotify_rm_watch(self.fd, self.descriptors.pop(dir_path))
+
+        for dir_path in dir_paths - set(self.descriptors):
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(dir_path), WATCH_MASK)
+            if wd < 0:
+                logger.warning(f"Can't watch {dir_path}: {os.strerror(ctypes.get_errno())}")
+                continue
+            self.descriptors[dir_path] = wd
+            self.dirs[wd] = dir_path
+
+    def _read_events(self) -> list:
+        """
+        Returns the paths of all queued events, None for a path when the queue overflowed.
+        """
+        paths = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return paths
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, name_length = EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + name_length].rstrip(b'\0')
+                offset += EVENT_HEADER.size + name_length
+
+                if mask & IN_Q_OVERFLOW:
+                    paths.append(None)
+                    continue
+                if mask & IN_IGNORED:
+                    dir_path = self.dirs.pop(wd, None)
+                    if dir_path and self.descriptors.get(dir_path) == wd:
+                        del self.descriptors[dir_path]
+                    continue
+
+                dir_path = self.dirs.get(wd)
+                if dir_path:
+                    paths.append(os.path.join(dir_path, os.fsdecode(name)) if name else dir_path)
+
+    def drain(self, ignored_paths: set) -> set:
+        """
+        Reads the queued events without waiting and returns their paths, except ignored_paths (e.g. files we just wrote).
+        """
+        return set(path for path in self._read_events()
+                   if path is None or (path not in ignored_paths and not is_ignored_path(path)))
+
+    def wait(self, debounce: float = DEFAULT_DEBOUNCE, changed: set = None) -> set:
+        """
+        Blocks until something changes in the watched directories, then until there has been no event
+        for debounce seconds. Returns the changed paths (added to changed, if given), with None in it if events were lost.
+        """
+        changed = set(changed or ())
+        deadline = time.monotonic() + debounce * MAX_DEBOUNCE_PERIODS if changed else None
+
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = min(debounce, deadline - time.monotonic())
+                if timeout <= 0:
+                    return changed
+
+            try:
+                readable, _, _ = select.select([self.fd], [], [], timeout)
+            except InterruptedError:
+                continue
+
+            if not readable:
+                return changed
+
+            paths = [path for path in self._read_events() if path is None or not is_ignored_path(path)]
+            if paths:
+                changed.update(paths)
+                if deadline is None:
+                    deadline = time.monotonic() + debounce * MAX_DEBOUNCE_PERIODS
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+def is_ignored_path(file_path: str) -> bool:
+    name = os.path.basename(file_path)
+    return name.startswith('.') or name.endswith(IGNORED_SUFFIXES)
+
+def get_watch_dirs(file_paths: list) -> set:
+    """
+    Returns the directories to watch for the files, including those of symlink targets
+    (sites-enabled -> sites-available), so edits of either are seen.
+    """
+    dir_paths = set()
+    for file_path in file_paths:
+        dir_paths.add(os.path.dirname(os.path.abspath(file_path)))
+        dir_paths.add(os.path.dirname(os.path.realpath(file_path)))
+    return set(dir_path for dir_path in dir_paths if os.path.isdir(dir_path))
+
+def reconcile(entry: dict, cache_dir: str = None, options: dict = None, reload_options: dict = None,
+              snapshot_options: dict = None) -> dict:
+    """
+    Re-applies the integration if it drifted and reloads nginx after validating the config.
+    If validation fails, the files are restored from the snapshot taken before saving and nginx is not reloaded.
+    A reload failing after validation passed keeps the files, nginx may have applied them already.
+    Returns the integrate_entry result with "reloaded" set.
+    """
+    result = integrate_entry(entry, cache_dir, options, snapshot_options)
+    result["reloaded"] = False
+
+    if result["status"] != "ok":
+        logger.error(f"Integration of {entry['file']} failed: {result['error']}")
+        return result
+
+    if not result["changed"]:
+        logger.debug("Prerender integration of %s is in place", entry['file'])
+        return result
+
+    logger.info(f"Prerender integration of {entry['file']} drifted, re-applied:")
+    for item in result["drift"]:
+        logger.info(f"  {item}")
+
+    config_path = entry.get("output") or entry["file"]
+    reload_options = reload_options or {}
+    try:
+        test_config(config_path, reload_options.get("nginx_bin", DEFAULT_NGINX_BINARY))
+    except Exception as e:
+        logger.error(f"Nginx rejected the re-applied configuration: {e}")
+        logger.info(f"Restoring the nginx configuration from snapshot {result['snapshot']}")
+        SnapshotStore(**(snapshot_options or {})).restore(result["snapshot"])
+        result["status"] = "failed"
+        result["error"] = str(e)
+        return result
+
+    try:
+        reload_nginx(config_path, validate=False, **reload_options)
+        result["reloaded"] = True
+    except Exception as e:
+        # the config is valid and nginx may already run it, so the files are kept to match it
+        logger.error(f"Error reloading nginx: {e}")
+        result["status"] = "failed"
+        result["error"] = str(e)
+
+    return result
+
+def watch_integration(entry: dict, cache_dir: str, options: dict = None, reload_options: dict = None,
+                      snapshot_options: dict = None, debounce: float = DEFAULT_DEBOUNCE, on_change=None) -> None:
+    """
+    Runs reconcile for the manifest-style entry ({file, token, url and/or server}) now and after every
+    change of the include tree, until interrupted. on_change is called with each result that changed files.
+    """
+    watcher = InotifyWatcher()
+    file_paths = [entry["file"]]
+
+    try:
+        while True:
+            # watch before parsing, so changes made while reconciling are not missed
+            watcher.watch(get_watch_dirs(file_paths))
+
+            result = reconcile(entry, cache_dir, options, reload_options, snapshot_options)
+            file_paths = result.get("files") or file_paths
+            if result["changed"] and on_change:
+                on_change(result)
+
+            # our own writes don't need another check, anything else that happened meanwhile does
+            pending = watcher.drain(set(os.path.abspath(path) for path in result["changed"]))
+
+            watcher.watch(get_watch_dirs(file_paths))
+            logger.debug("Watching %d directories of %d config files", len(watcher.descriptors), len(file_paths))
+
+            changed = watcher.wait(debounce, pending)
+            if None in changed:
+                logger.info("Watch events were lost, checking the whole configuration")
+            else:
+                logger.info(f"Configuration changed: {', '.join(sorted(changed)[:5])}{' ...' if len(changed) > 5 else ''}")
+    finally:
+        watcher.close()